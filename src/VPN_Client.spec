@@ -10,6 +10,7 @@ a = Analysis(
         ('index.html', '.'),
         ('styles.css', '.'),
         ('app.js', '.'),
+        ('icon.ico', '.'),
         ('vpn_handler.py', '.')
     ],
     hiddenimports=[],
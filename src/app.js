@@ -178,6 +178,23 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
+    function applyStatus(data) {
+        if (data.success) {
+            const status = data.status;
+            isConnected = status.running;
+            statusText.textContent = isConnected ? 'Connected' : 'Disconnected';
+            connectButton.textContent = isConnected ? 'Disconnect' : 'Connect';
+            connectButton.className = isConnected ? 'btn btn-danger' : 'btn btn-success';
+            
+            if (status.current_node) {
+                countrySelect.value = status.current_node.country;
+            }
+        } else {
+            statusText.textContent = 'Error';
+            console.error('Status error:', data.error);
+        }
+    }
+
     // Update status periodically
     function updateStatus() {
         fetch('http://localhost:8000', {
@@ -188,31 +205,25 @@ document.addEventListener('DOMContentLoaded', function() {
             body: JSON.stringify({ action: 'status' })
         })
         .then(response => response.json())
-        .then(data => {
-            if (data.success) {
-                const status = data.status;
-                isConnected = status.running;
-                statusText.textContent = isConnected ? 'Connected' : 'Disconnected';
-                connectButton.textContent = isConnected ? 'Disconnect' : 'Connect';
-                connectButton.className = isConnected ? 'btn btn-danger' : 'btn btn-success';
-                
-                if (status.current_node) {
-                    countrySelect.value = status.current_node.country;
-                }
-            } else {
-                statusText.textContent = 'Error';
-                console.error('Status error:', data.error);
-            }
-        })
+        .then(applyStatus)
         .catch(error => {
             console.error('Error updating status:', error);
             statusText.textContent = 'Error';
         });
     }
 
-    // Update status every 5 seconds
-    setInterval(updateStatus, 5000);
-    updateStatus(); // Initial status check
+    // Let the server push status changes; only poll where EventSource is unavailable
+    if (window.EventSource) {
+        const events = new EventSource('http://localhost:8000/api/events');
+        events.addEventListener('status', event => applyStatus(JSON.parse(event.data)));
+        events.onerror = () => {
+            // EventSource reconnects on its own and resumes from the last event id
+            statusText.textContent = 'Error';
+        };
+    } else {
+        setInterval(updateStatus, 5000);
+        updateStatus(); // Initial status check
+    }
     populateCountrySelect(); // Populate country select
 
     connectButton.addEventListener('click', function() {
@@ -248,9 +259,30 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 
     countrySelect.addEventListener('change', function() {
-        if (isConnected) {
-            // If connected, disconnect first
-            connectButton.click();
+        if (!isConnected) {
+            return;
         }
+        // Switch in place: the proxy keeps accepting while old connections drain
+        fetch('http://localhost:8000', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({
+                action: 'switch',
+                country: countrySelect.value
+            })
+        })
+        .then(response => response.json())
+        .then(data => {
+            if (!data.success) {
+                statusText.textContent = 'Switch failed';
+                console.error('Switch error:', data.error);
+            }
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            statusText.textContent = 'Error';
+        });
     });
 }); 
\ No newline at end of file
@@ -0,0 +1,122 @@
+import bisect
+import hashlib
+import logging
+import random
+import threading
+import time
+from typing import Callable, List
+
+logger = logging.getLogger(__name__)
+
+STRATEGIES = ('least_connections', 'latency_weighted', 'consistent_hash')
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class NodeBalancer:
+    """Spreads new connections across healthy VPN nodes and orders fallbacks for failover"""
+
+    def __init__(self, nodes: Callable[[], List], prober=None, strategy: str = 'least_connections',
+                 failure_cooldown: float = 10.0, replicas: int = 64, default_latency_ms: float = 100.0):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown balancing strategy: {strategy}")
+        self.nodes = nodes
+        self.prober = prober
+        self.strategy = strategy
+        self.failure_cooldown = failure_cooldown
+        self.replicas = replicas
+        self.default_latency_ms = default_latency_ms
+        self._lock = threading.Lock()
+        self._down_until = {}
+        # (node ids, sorted points, node per point), swapped in whole so readers never mix two rings
+        self._ring = (None, [], [])
+        self._ring_lock = threading.Lock()
+
+    def acquire(self, node):
+        """Count a new active connection against node.load"""
+        with self._lock:
+            node.load += 1
+
+    def release(self, node):
+        with self._lock:
+            node.load = max(0, node.load - 1)
+
+    def mark_failed(self, node):
+        """Take a node out of rotation for failure_cooldown seconds after a failed connect"""
+        self._down_until[node] = time.monotonic() + self.failure_cooldown
+        logger.warning("Node %s (%s:%s) failed, cooling down", node.country, node.host, node.port,
+                       extra={'event': 'node_failed'})
+
+    def forget(self, node):
+        """Drop state kept for a node that was removed from the catalog"""
+        self._down_until.pop(node, None)
+
+    def is_healthy(self, node) -> bool:
+        if node.status == 'offline':
+            return False
+        until = self._down_until.get(node)
+        return until is None or until <= time.monotonic()
+
+    def candidates(self, client_address=None, exclude=()) -> List:
+        """Nodes to try for a new connection, best first"""
+        catalog = list(self.nodes())  # once: a reload may swap the list under us
+        nodes = [node for node in catalog if node not in exclude]
+        healthy = [node for node in nodes if self.is_healthy(node)]
+        if not healthy:
+            # Every node is cooling down; trying one beats refusing the client outright
+            healthy = nodes
+        if self.strategy == 'consistent_hash':
+            return self._hash_order(catalog, healthy, client_address)
+        ordered = sorted(healthy, key=lambda node: (node.load, self._latency(node)))
+        if self.strategy == 'latency_weighted' and len(ordered) > 1:
+            primary = self._weighted_pick(ordered)
+            ordered.remove(primary)
+            ordered.insert(0, primary)
+        return ordered
+
+    def _latency(self, node) -> float:
+        stats = self.prober.get_stats(node) if self.prober else None
+        if stats is None or stats.ewma is None:
+            return self.default_latency_ms
+        return stats.ewma
+
+    def _weighted_pick(self, nodes: List):
+        """Random choice weighted by 1 / (latency * (active connections + 1))"""
+        weights = [1.0 / (max(self._latency(node), 0.1) * (node.load + 1)) for node in nodes]
+        return random.choices(nodes, weights=weights)[0]
+
+    def _build_ring(self, nodes: List) -> tuple:
+        """The hash ring for nodes, rebuilt only when the node list changed"""
+        key = tuple(id(node) for node in nodes)
+        ring = self._ring
+        if ring[0] == key:
+            return ring
+        with self._ring_lock:
+            ring = self._ring
+            if ring[0] == key:
+                return ring  # another thread built it while we waited
+            points = sorted(
+                (_hash(f"{node.country}|{node.host}:{node.port}#{i}"), index)
+                for index, node in enumerate(nodes) for i in range(self.replicas)
+            )
+            ring = self._ring = (key, [point for point, _ in points], [nodes[index] for _, index in points])
+        return ring
+
+    def _hash_order(self, catalog: List, healthy: List, client_address) -> List:
+        """Walk the hash ring from the client's point so a client sticks to one node"""
+        _, points, ring_nodes = self._build_ring(catalog)
+        host = client_address[0] if client_address else ''
+        start = bisect.bisect(points, _hash(host))
+        allowed = set(map(id, healthy))
+        ordered, seen = [], set()
+        for offset in range(len(ring_nodes)):
+            node = ring_nodes[(start + offset) % len(ring_nodes)]
+            if id(node) in allowed and id(node) not in seen:
+                seen.add(id(node))
+                ordered.append(node)
+                if len(ordered) == len(allowed):
+                    break
+        return ordered
+
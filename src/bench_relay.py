@@ -0,0 +1,303 @@
+"""Throughput / latency benchmark for the VPNHandler proxy relay
+
+Starts a local echo or sink "VPN node" and a VPNHandler proxy in separate
+processes, drives the proxy listener with N concurrent clients and prints a
+JSON report (MB/s, connections/s, p50/p99 connect and round-trip latency,
+proxy CPU and RSS) so engines and revisions can be compared.
+
+With --compression or --encryption the node is fronted by node_server.py and
+the proxy talks the framed tunnel protocol to it; the report then adds bytes on
+the wire and handshake counts. --multiplex carries every client over one
+shared tunnel connection instead of one tunnel per client.
+
+    python bench_relay.py --engine selector --mode stream --concurrency 64
+    python bench_relay.py --engine thread --mode churn --duration 5 --output thread.json
+    python bench_relay.py --compression zlib --payload text --node sink
+    python bench_relay.py --encryption aes-256-gcm --compression none --mode churn
+    python bench_relay.py --encryption aes-256-gcm --multiplex --mode churn
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+from typing import Dict, List
+
+import psutil
+
+# Both ends of the loopback tunnel; encrypted tunnels refuse to run without one
+BENCH_PSK = 'bench'
+
+def _run_node(mode: str, tunnel: bool, port_queue):
+    """Echo (or discard) everything received on each connection"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1024)
+    if tunnel:
+        from node_server import NodeServer
+        endpoint = NodeServer('127.0.0.1', 0, forward=f"127.0.0.1:{server.getsockname()[1]}", psk=BENCH_PSK)
+        endpoint.start()
+        port_queue.put(endpoint.port)
+    else:
+        port_queue.put(server.getsockname()[1])
+
+    def serve(conn):
+        buffer = bytearray(65536)
+        view = memoryview(buffer)
+        with conn:
+            while True:
+                n = conn.recv_into(buffer)
+                if not n:
+                    break
+                if mode == 'echo':
+                    conn.sendall(view[:n])
+
+    while True:
+        conn, _ = server.accept()
+        threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+
+def _run_proxy(engine: str, workers: int, port: int, node_port: int, tunnel: dict, log_level: str,
+               ready, stop, results):
+    from vpn_handler import VPNHandler, VPNNode
+    import log_pipeline
+    log_pipeline.set_level(log_level)
+    handler = VPNHandler()
+    handler.relay_engine = engine
+    handler.workers = workers
+    handler.listener_config.port = port
+    protocol = 'tunnel' if tunnel else 'tcp'
+    if tunnel:
+        settings = dict(tunnel)
+        handler.multiplex = settings.pop('multiplex', False)
+        handler.fingerprint.update(settings)
+        handler.tunnel_psk = BENCH_PSK
+    handler.vpn_nodes = [VPNNode('Benchmark', '127.0.0.1', node_port, protocol)]
+    if not handler.start_vpn('Benchmark'):
+        print(f"Proxy failed to start: {handler.last_error}", file=sys.stderr)
+        return
+    ready.set()
+    stop.wait()
+    results.put(handler.get_vpn_status()['tunnel'] if tunnel else None)
+    handler.stop_vpn()
+
+
+def _recv_exactly(sock: socket.socket, buffer: bytearray, size: int):
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:size])
+        if not n:
+            raise ConnectionError("Proxy closed the connection")
+        received += n
+
+
+def _make_payload(kind: str, size: int) -> bytes:
+    if kind == 'random':
+        return os.urandom(size)  # incompressible, like TLS traffic
+    if kind == 'text':
+        line = b'{"id": 1042, "user": "tyler", "status": "ok", "items": [1, 2, 3], "note": "lorem ipsum"}\n'
+        return (line * (size // len(line) + 1))[:size]
+    return b'\x5a' * size
+
+
+def _percentile(values: List[float], p: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))], 3)
+
+
+class _Worker(threading.Thread):
+    def __init__(self, args, deadline: float):
+        super().__init__(daemon=True)
+        self.args = args
+        self.deadline = deadline
+        self.payload = _make_payload(args.payload, args.payload_size)
+        self.buffer = bytearray(args.payload_size)
+        self.bytes = 0
+        self.connections = 0
+        self.errors = 0
+        self.connect_ms = []
+        self.rtt_ms = []
+
+    def _connect(self) -> socket.socket:
+        started = time.perf_counter()
+        sock = socket.create_connection(('127.0.0.1', self.args.port), timeout=10)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connect_ms.append((time.perf_counter() - started) * 1000)
+        self.connections += 1
+        return sock
+
+    def _exchange(self, sock: socket.socket):
+        started = time.perf_counter()
+        sock.sendall(self.payload)
+        if self.args.node == 'echo':
+            _recv_exactly(sock, self.buffer, len(self.payload))
+            self.rtt_ms.append((time.perf_counter() - started) * 1000)
+        self.bytes += len(self.payload)
+
+    def run(self):
+        while time.perf_counter() < self.deadline:
+            try:
+                sock = self._connect()
+                with sock:
+                    if self.args.mode == 'churn':
+                        self._exchange(sock)
+                    else:
+                        while time.perf_counter() < self.deadline:
+                            self._exchange(sock)
+                    sock.shutdown(socket.SHUT_WR)
+                    # Wait for the relay to finish so sink-mode bytes were really delivered
+                    while sock.recv(65536):
+                        pass
+            except OSError:
+                self.errors += 1
+
+
+def _cpu_seconds(processes: List[psutil.Process]) -> float:
+    total = 0.0
+    for process in processes:
+        try:
+            times = process.cpu_times()
+            total += times.user + times.system
+        except psutil.Error:
+            pass
+    return total
+
+
+def _rss(processes: List[psutil.Process]) -> int:
+    total = 0
+    for process in processes:
+        try:
+            total += process.memory_info().rss
+        except psutil.Error:
+            pass
+    return total
+
+
+def _sample_rss(processes: List[psutil.Process], stop: threading.Event, samples: List[int]):
+    while not stop.wait(0.2):
+        samples.append(_rss(processes))
+
+
+def run_benchmark(args) -> Dict:
+    ctx = multiprocessing.get_context('spawn')
+    port_queue = ctx.Queue()
+    tunnel = {}
+    if args.compression or args.encryption or args.multiplex:
+        tunnel = {'compression': args.compression or 'none', 'encryption': args.encryption or 'none',
+                  'multiplex': args.multiplex}
+    node = ctx.Process(target=_run_node, args=(args.node, bool(tunnel), port_queue), daemon=True)
+    node.start()
+    node_port = port_queue.get(timeout=10)
+
+    ready, stop = ctx.Event(), ctx.Event()
+    results = ctx.Queue()
+    proxy = ctx.Process(target=_run_proxy, args=(args.engine, args.workers, args.port, node_port,
+                                                 tunnel, args.log_level, ready, stop, results))
+    proxy.start()
+    try:
+        if not ready.wait(timeout=15):
+            raise RuntimeError("Proxy did not start")
+        # The proxy process plus any SO_REUSEPORT workers it spawned
+        root = psutil.Process(proxy.pid)
+        processes = [root] + root.children(recursive=True)
+        cpu_before = _cpu_seconds(processes)
+        rss_samples = [_rss(processes)]
+        sampler_stop = threading.Event()
+        sampler = threading.Thread(target=_sample_rss, args=(processes, sampler_stop, rss_samples),
+                                   daemon=True)
+        sampler.start()
+
+        started = time.perf_counter()
+        workers = [_Worker(args, started + args.duration) for _ in range(args.concurrency)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+        cpu_seconds = _cpu_seconds(processes) - cpu_before
+        sampler_stop.set()
+        sampler.join()
+    finally:
+        stop.set()
+        try:
+            tunnel = results.get(timeout=10)
+        except Exception:
+            tunnel = None
+        proxy.join(timeout=10)
+        if proxy.is_alive():
+            proxy.terminate()
+        node.terminate()
+
+    total_bytes = sum(worker.bytes for worker in workers)
+    connect_ms = [value for worker in workers for value in worker.connect_ms]
+    rtt_ms = [value for worker in workers for value in worker.rtt_ms]
+    # Echo traffic crosses the relay twice
+    relayed = total_bytes * (2 if args.node == 'echo' else 1)
+    return {
+        'config': vars(args),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': psutil.cpu_count()
+        },
+        'results': {
+            'elapsed_s': round(elapsed, 3),
+            'relayed_mb_per_s': round(relayed / elapsed / 1e6, 2),
+            'connections': sum(worker.connections for worker in workers),
+            'connections_per_s': round(sum(worker.connections for worker in workers) / elapsed, 1),
+            'errors': sum(worker.errors for worker in workers),
+            'connect_ms_p50': _percentile(connect_ms, 50),
+            'connect_ms_p99': _percentile(connect_ms, 99),
+            'rtt_ms_p50': _percentile(rtt_ms, 50),
+            'rtt_ms_p99': _percentile(rtt_ms, 99),
+            'proxy_cpu_percent': round(cpu_seconds / elapsed * 100, 1),
+            'proxy_rss_mb_max': round(max(rss_samples) / 1e6, 1),
+            'proxy_processes': len(processes),
+            # Client -> node direction only; with workers > 1 only the parent process is counted
+            'tunnel': tunnel
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--engine', choices=('selector', 'thread'), default='selector')
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Relay processes sharing the port via SO_REUSEPORT")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--mode', choices=('stream', 'churn'), default='stream',
+                        help="stream: long-lived connections; churn: one exchange per connection")
+    parser.add_argument('--node', choices=('echo', 'sink'), default='echo')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--payload-size', type=int, default=65536)
+    parser.add_argument('--payload', choices=('fill', 'text', 'random'), default='fill',
+                        help="fill: one repeated byte; text: JSON lines; random: incompressible")
+    parser.add_argument('--compression', choices=('none', 'zlib', 'lz4', 'zstd'),
+                        help="Talk the framed tunnel protocol to a node_server with this codec")
+    parser.add_argument('--encryption', choices=('none', 'aes-256-gcm', 'chacha20-poly1305'),
+                        help="Tunnel to a node_server with this AEAD cipher")
+    parser.add_argument('--multiplex', action='store_true',
+                        help="Share one tunnel connection between all clients")
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', help="Also write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = json.dumps(run_benchmark(args), indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+
+
+if __name__ == '__main__':
+    main()
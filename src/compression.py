@@ -0,0 +1,227 @@
+import collections
+import logging
+import math
+import struct
+import zlib
+from typing import Callable, Dict, Optional
+
+from metrics import ShardedCounter
+
+logger = logging.getLogger(__name__)
+
+try:
+    import lz4.block as _lz4
+except ImportError:
+    _lz4 = None
+
+try:
+    import zstandard as _zstd
+except ImportError:
+    _zstd = None
+
+# flags, payload length, uncompressed length
+FRAME_HEADER = struct.Struct('!BHH')
+FRAME_MAX = 0xFFFF
+FLAG_COMPRESSED = 0x01
+
+
+class FrameError(Exception):
+    """The peer sent a frame that cannot be decoded"""
+
+
+class Codec:
+    """A block compressor: compress(data) and decompress(data, uncompressed_size)"""
+
+    def __init__(self, name: str, compress: Callable[[bytes], bytes],
+                 decompress: Callable[[bytes, int], bytes]):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+def _zlib_codec(level: int) -> Codec:
+    return Codec('zlib', lambda data: zlib.compress(data, level), lambda data, size: zlib.decompress(data))
+
+
+def _lz4_codec() -> Codec:
+    return Codec('lz4', lambda data: _lz4.compress(data, store_size=False),
+                 lambda data, size: _lz4.decompress(data, uncompressed_size=size))
+
+
+def _zstd_codec(level: int) -> Codec:
+    compressor = _zstd.ZstdCompressor(level=level)
+    decompressor = _zstd.ZstdDecompressor()
+    return Codec('zstd', compressor.compress,
+                 lambda data, size: decompressor.decompress(data, max_output_size=size))
+
+
+def available_codecs() -> tuple:
+    return ('none', 'zlib') + (('lz4',) if _lz4 else ()) + (('zstd',) if _zstd else ())
+
+
+def get_codec(name: str, level: int = 1) -> Optional[Codec]:
+    """Codec for a fingerprint['compression'] value; None means frames are sent raw
+
+    lz4 and zstd are optional packages; when missing, zlib from the standard library
+    is used instead.
+    """
+    name = (name or 'none').lower()
+    if name in ('none', 'off'):
+        return None
+    if name == 'lz4' and _lz4:
+        return _lz4_codec()
+    if name == 'zstd' and _zstd:
+        return _zstd_codec(level)
+    if name not in ('zlib', 'lz4', 'zstd'):
+        raise ValueError(f"Unknown compression: {name}")
+    if name != 'zlib':
+        logger.warning("%s is not installed, falling back to zlib compression", name)
+    return _zlib_codec(level)
+
+
+def shannon_entropy(sample: bytes) -> float:
+    """Bits per byte of sample; close to 8 for encrypted or already-compressed data"""
+    if not sample:
+        return 0.0
+    total = len(sample)
+    return -sum(count / total * math.log2(count / total)
+                for count in collections.Counter(sample).values())
+
+
+class CompressionStats:
+    """Wire savings across every frame encoder sharing this object"""
+    __slots__ = ('raw_bytes', 'wire_bytes', 'frames', 'compressed_frames', 'skipped_frames')
+
+    def __init__(self):
+        self.raw_bytes = ShardedCounter()
+        self.wire_bytes = ShardedCounter()
+        self.frames = ShardedCounter()
+        self.compressed_frames = ShardedCounter()
+        self.skipped_frames = ShardedCounter()
+
+    def to_dict(self) -> Dict:
+        raw = self.raw_bytes.value
+        wire = self.wire_bytes.value
+        return {
+            'raw_bytes': raw,
+            'wire_bytes': wire,
+            'ratio': round(wire / raw, 3) if raw else None,
+            'frames': self.frames.value,
+            'compressed_frames': self.compressed_frames.value,
+            'skipped_frames': self.skipped_frames.value
+        }
+
+
+class FrameEncoder:
+    """Cuts a byte stream into length-prefixed frames, compressing those worth it
+
+    Small frames go out raw. Larger ones are first screened by the byte entropy of a
+    sample, then compressed; a frame that does not shrink below max_ratio is sent raw
+    and compression is skipped for an exponentially growing run of frames, so
+    encrypted or pre-compressed streams cost almost nothing.
+    """
+
+    def __init__(self, codec: Optional[Codec], stats: Optional[CompressionStats] = None,
+                 min_size: int = 128, max_entropy: float = 7.2, max_ratio: float = 0.9,
+                 sample_size: int = 1024, max_backoff: int = 64):
+        self.codec = codec
+        self.stats = stats
+        self.min_size = min_size
+        self.max_entropy = max_entropy
+        self.max_ratio = max_ratio
+        self.sample_size = sample_size
+        self.max_backoff = max_backoff
+        self._skip = 0
+        self._backoff = 1
+
+    def encode(self, data) -> bytes:
+        """Frame (and maybe compress) data, splitting it at FRAME_MAX"""
+        if len(data) <= FRAME_MAX:
+            return self._frame(data)
+        view = memoryview(data)
+        return b''.join(self._frame(view[i:i + FRAME_MAX]) for i in range(0, len(data), FRAME_MAX))
+
+    def _frame(self, data) -> bytes:
+        size = len(data)
+        payload = self._compress(data) if self.codec and size >= self.min_size else None
+        stats = self.stats
+        if stats:
+            stats.raw_bytes.add(size)
+            stats.frames.add()
+        if payload is None:
+            if stats:
+                stats.wire_bytes.add(size + FRAME_HEADER.size)
+            return FRAME_HEADER.pack(0, size, size) + data
+        if stats:
+            stats.wire_bytes.add(len(payload) + FRAME_HEADER.size)
+            stats.compressed_frames.add()
+        return FRAME_HEADER.pack(FLAG_COMPRESSED, len(payload), size) + payload
+
+    def _compress(self, data) -> Optional[bytes]:
+        if self._skip:
+            self._skip -= 1
+            self._count_skipped()
+            return None
+        if len(data) > self.sample_size:
+            # Four slices spread across the frame, so a text header cannot mask a binary body
+            step = len(data) // 4
+            quarter = self.sample_size // 4
+            sample = b''.join(data[i:i + quarter] for i in range(0, step * 4, step))
+        else:
+            sample = data
+        if shannon_entropy(sample) > self.max_entropy:
+            self._back_off()
+            return None
+        payload = self.codec.compress(data)
+        if len(payload) > len(data) * self.max_ratio:
+            self._back_off()
+            return None
+        self._backoff = 1
+        return payload
+
+    def _back_off(self):
+        self._count_skipped()
+        self._skip = self._backoff
+        self._backoff = min(self._backoff * 2, self.max_backoff)
+
+    def _count_skipped(self):
+        if self.stats:
+            self.stats.skipped_frames.add()
+
+
+class FrameDecoder:
+    """Reassembles frames from arbitrary stream chunks and returns the decoded bytes"""
+
+    def __init__(self, codec: Optional[Codec]):
+        self.codec = codec
+        self._buffer = bytearray()
+
+    @property
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def decode(self, data) -> bytes:
+        buffer = self._buffer
+        buffer += data
+        out = []
+        offset = 0
+        header_size = FRAME_HEADER.size
+        while len(buffer) - offset >= header_size:
+            flags, length, size = FRAME_HEADER.unpack_from(buffer, offset)
+            end = offset + header_size + length
+            if end > len(buffer):
+                break
+            payload = bytes(buffer[offset + header_size:end])
+            if flags & FLAG_COMPRESSED:
+                if self.codec is None:
+                    raise FrameError("Compressed frame on an uncompressed tunnel")
+                try:
+                    payload = self.codec.decompress(payload, size)
+                except Exception as e:
+                    raise FrameError(f"Corrupt {self.codec.name} frame: {e}")
+                if len(payload) != size:
+                    raise FrameError(f"Frame decoded to {len(payload)} bytes, expected {size}")
+            out.append(payload)
+            offset = end
+        del buffer[:offset]
+        return b''.join(out)
@@ -0,0 +1,365 @@
+import collections
+import json
+import logging
+import marshal
+import sys
+import threading
+import time
+import traceback
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Control-API actions the launcher forwards to Diagnostics.run()
+DEBUG_ACTIONS = ('profile_start', 'profile_stop', 'thread_stacks', 'memory_start', 'memory_snapshot',
+                 'memory_stop', 'trace_start', 'trace_stop')
+# Files served by the launcher under /api/debug/
+DOWNLOADS = {
+    'profile.pstats': 'application/octet-stream',
+    'profile.json': 'application/json',
+    'stacks.json': 'application/json',
+    'memory.json': 'application/json',
+    'traces.json': 'application/json',
+}
+
+
+def _percentiles(values: List[float]) -> Optional[Dict[str, float]]:
+    if not values:
+        return None
+    values = sorted(values)
+    last = len(values) - 1
+    return {f'p{q}': round(values[min(last, int(last * q / 100 + 0.5))], 3) for q in (50, 90, 99)}
+
+
+class ConnectionTrace:
+    """Timestamps of one proxied connection: accept, upstream connect, first byte back, close"""
+    __slots__ = ('client', 'node', 'accepted', 'connected', 'first_byte', 'closed', 'bytes_up', 'bytes_down',
+                 'wall_time')
+
+    def __init__(self, client):
+        self.client = client
+        self.node = None
+        self.accepted = time.perf_counter()
+        self.wall_time = time.time()
+        self.connected = None
+        self.first_byte = None
+        self.closed = None
+        self.bytes_up = 0
+        self.bytes_down = 0
+
+    def sent_up(self, n: int):
+        self.bytes_up += n
+
+    def sent_down(self, n: int):
+        if self.first_byte is None:
+            self.first_byte = time.perf_counter()
+        self.bytes_down += n
+
+    def _since_accept(self, when: Optional[float]) -> Optional[float]:
+        return None if when is None else round((when - self.accepted) * 1000, 3)
+
+    def to_dict(self) -> Dict:
+        return {
+            'client': f'{self.client[0]}:{self.client[1]}' if self.client else None,
+            'node': getattr(self.node, 'country', None),
+            'started': self.wall_time,
+            'connect_ms': self._since_accept(self.connected),
+            'first_byte_ms': self._since_accept(self.first_byte),
+            'duration_ms': self._since_accept(self.closed),
+            'bytes_up': self.bytes_up,
+            'bytes_down': self.bytes_down
+        }
+
+
+class ConnectionTracer:
+    """Per-connection timing traces for the last capacity connections, recorded only while enabled
+
+    Relays call begin() on accept and get None while disabled, so the only cost
+    then is that call and the None checks.
+    """
+
+    def __init__(self, capacity: int = 2000):
+        self.enabled = False
+        self._finished = collections.deque(maxlen=capacity)
+
+    def start(self):
+        self._finished.clear()
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    def begin(self, client) -> Optional[ConnectionTrace]:
+        return ConnectionTrace(client) if self.enabled else None
+
+    def finish(self, trace: ConnectionTrace, node, bytes_up: Optional[int] = None,
+               bytes_down: Optional[int] = None):
+        trace.closed = time.perf_counter()
+        trace.node = node
+        if bytes_up is not None:
+            trace.bytes_up = bytes_up
+        if bytes_down is not None:
+            trace.bytes_down = bytes_down
+        self._finished.append(trace)
+
+    def to_dict(self) -> Dict:
+        traces = [trace.to_dict() for trace in list(self._finished)]
+        return {
+            'enabled': self.enabled,
+            'connections': len(traces),
+            'summary': {
+                phase: _percentiles([t[phase] for t in traces if t[phase] is not None])
+                for phase in ('connect_ms', 'first_byte_ms', 'duration_ms')
+            },
+            'traces': traces
+        }
+
+
+class SamplingProfiler:
+    """Statistical profiler over every thread in the process
+
+    A background thread reads sys._current_frames() every interval seconds and
+    counts each thread's stack, so the relay threads run untouched: nothing is
+    hooked while it is stopped and sampling costs one stack walk per thread per
+    interval while it runs. Results convert to a pstats file (time estimated as
+    samples x interval) or a JSON summary with folded stacks for flame graphs.
+    """
+
+    def __init__(self, interval: float = 0.005, max_depth: int = 64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        self.started = None
+        self.duration = 0.0
+        self._stacks = collections.Counter()  # (thread name, stack leaf first) -> samples
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return bool(self._thread and self._thread.is_alive())
+
+    def start(self, interval: Optional[float] = None):
+        """Start a fresh profile, discarding the previous one"""
+        if self.running:
+            return
+        if interval:
+            self.interval = max(0.001, interval)
+        self._stacks = collections.Counter()
+        self.samples = 0
+        self.duration = 0.0
+        self.started = time.perf_counter()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample_loop, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        logger.info("Sampling profiler started (%.1f ms interval)", self.interval * 1000,
+                    extra={'event': 'profiler_started'})
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join()
+        logger.info("Sampling profiler stopped after %d samples", self.samples, extra={'event': 'profiler_stopped'})
+
+    def _sample_loop(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            sampled = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                sampled.append((names.get(ident, str(ident)), tuple(stack)))
+            with self._lock:
+                self._stacks.update(sampled)
+            self.samples += 1
+            self.duration = time.perf_counter() - self.started
+
+    def pstats_data(self) -> Dict:
+        """{function: (cc, nc, tt, ct, callers)} as pstats.Stats loads it from a marshal file"""
+        entries = {}
+        callers = collections.defaultdict(lambda: collections.defaultdict(lambda: [0, 0, 0.0, 0.0]))
+        with self._lock:
+            stacks = list(self._stacks.items())
+        for (_, stack), count in stacks:
+            seconds = count * self.interval
+            seen = set()
+            for depth, function in enumerate(stack):
+                entry = entries.setdefault(function, [0, 0, 0.0, 0.0])
+                if depth == 0:
+                    entry[2] += seconds
+                if function not in seen:
+                    # Recursion counts once towards cumulative time
+                    seen.add(function)
+                    entry[0] += count
+                    entry[1] += count
+                    entry[3] += seconds
+                if depth + 1 < len(stack):
+                    edge = callers[function][stack[depth + 1]]
+                    edge[0] += count
+                    edge[1] += count
+                    edge[2] += seconds if depth == 0 else 0.0
+                    edge[3] += seconds
+        return {function: (cc, nc, tt, ct, {caller: tuple(edge) for caller, edge in callers[function].items()})
+                for function, (cc, nc, tt, ct) in entries.items()}
+
+    def pstats_bytes(self) -> bytes:
+        return marshal.dumps(self.pstats_data())
+
+    def status(self) -> Dict:
+        return {'running': self.running, 'interval_ms': self.interval * 1000, 'samples': self.samples,
+                'duration_s': round(self.duration, 3)}
+
+    def to_dict(self, top: int = 40) -> Dict:
+        """Per-thread sample counts, hottest functions by self and cumulative samples, folded stacks"""
+        with self._lock:
+            stacks = list(self._stacks.items())
+        threads = collections.Counter()
+        own = collections.Counter()
+        cumulative = collections.Counter()
+        for (thread, stack), count in stacks:
+            threads[thread] += count
+            if stack:
+                own[stack[0]] += count
+            for function in set(stack):
+                cumulative[function] += count
+        total = sum(threads.values()) or 1
+
+        def rows(counter):
+            return [{'function': f'{name} ({filename}:{line})', 'samples': count,
+                     'percent': round(100.0 * count / total, 2)}
+                    for (filename, line, name), count in counter.most_common(top)]
+
+        folded = collections.Counter()
+        for (thread, stack), count in stacks:
+            folded[';'.join([thread] + [name for _, _, name in reversed(stack)])] += count
+        return {
+            **self.status(),
+            'threads': dict(threads.most_common()),
+            'top_self': rows(own),
+            'top_cumulative': rows(cumulative),
+            'folded': [f'{stack} {count}' for stack, count in folded.most_common(top * 5)]
+        }
+
+
+class MemoryTracer:
+    """tracemalloc snapshots, each compared with the one before it"""
+
+    def __init__(self):
+        self._previous = None
+
+    @property
+    def tracing(self) -> bool:
+        import tracemalloc
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 10):
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self._previous = None
+            logger.info("tracemalloc started (%d frames)", frames, extra={'event': 'tracemalloc_started'})
+
+    def stop(self):
+        import tracemalloc
+        tracemalloc.stop()
+        self._previous = None
+
+    def snapshot(self, top: int = 25, key: str = 'lineno', advance: bool = True) -> Optional[Dict]:
+        """Top allocations, as growth since the previous snapshot once there is one; None unless tracing
+
+        advance=False leaves the previous snapshot as the baseline for the next diff.
+        """
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            return None
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        if self._previous is None:
+            rows = [{'location': str(stat.traceback), 'size': stat.size, 'count': stat.count}
+                    for stat in snapshot.statistics(key)[:top]]
+        else:
+            rows = [{'location': str(stat.traceback), 'size': stat.size, 'size_diff': stat.size_diff,
+                     'count': stat.count, 'count_diff': stat.count_diff}
+                    for stat in snapshot.compare_to(self._previous, key)[:top]]
+        diff = self._previous is not None
+        if advance:
+            self._previous = snapshot
+        return {'traced_bytes': current, 'peak_bytes': peak, 'diff': diff, 'top': rows}
+
+
+def thread_stacks() -> List[Dict]:
+    """Current stack of every thread, innermost call last"""
+    frames = sys._current_frames()
+    return [{'name': thread.name, 'ident': thread.ident, 'daemon': thread.daemon,
+             'stack': traceback.format_stack(frames[thread.ident]) if thread.ident in frames else []}
+            for thread in threading.enumerate()]
+
+
+class Diagnostics:
+    """The launcher's profiling and tracing controls: debug actions and downloadable results"""
+
+    def __init__(self, tracer: Callable[[], ConnectionTracer]):
+        self.profiler = SamplingProfiler()
+        self.memory = MemoryTracer()
+        self._tracer = tracer
+
+    def run(self, action: str, params: Dict) -> Dict:
+        if action == 'profile_start':
+            self.profiler.start(float(params['interval_ms']) / 1000 if params.get('interval_ms') else None)
+            return {'success': True, 'profiler': self.profiler.status()}
+        if action == 'profile_stop':
+            self.profiler.stop()
+            return {'success': True, 'profiler': self.profiler.to_dict(top=int(params.get('top', 20)))}
+        if action == 'thread_stacks':
+            return {'success': True, 'threads': thread_stacks()}
+        if action == 'memory_start':
+            self.memory.start(int(params.get('frames', 10)))
+            return {'success': True, 'tracing': True}
+        if action == 'memory_snapshot':
+            self.memory.start()
+            return {'success': True, 'memory': self.memory.snapshot(top=int(params.get('top', 25)))}
+        if action == 'memory_stop':
+            self.memory.stop()
+            return {'success': True, 'tracing': False}
+        if action == 'trace_start':
+            self._tracer().start()
+            return {'success': True, 'tracing': True}
+        if action == 'trace_stop':
+            tracer = self._tracer()
+            tracer.stop()
+            return {'success': True, 'traces': tracer.to_dict()['summary']}
+        raise ValueError(f"Unknown debug action {action}")
+
+    def download(self, name: str) -> Optional[Tuple[str, bytes]]:
+        """(content type, body) of a result file, or None if there is no such file or no data yet"""
+        content_type = DOWNLOADS.get(name)
+        if content_type is None:
+            return None
+        if name == 'profile.pstats':
+            if not self.profiler.samples:
+                return None
+            return content_type, self.profiler.pstats_bytes()
+        if name == 'profile.json':
+            data = self.profiler.to_dict()
+        elif name == 'stacks.json':
+            data = thread_stacks()
+        elif name == 'memory.json':
+            # Reading never turns tracemalloc on or moves the baseline memory_snapshot diffs against
+            data = self.memory.snapshot(advance=False)
+            if data is None:
+                return None
+        else:
+            data = self._tracer().to_dict()
+        return content_type, json.dumps(data, indent=2).encode('utf-8')
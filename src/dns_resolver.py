@@ -0,0 +1,370 @@
+import collections
+import ipaddress
+import logging
+import os
+import random
+import selectors
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+QTYPE_A = 1
+QTYPE_AAAA = 28
+_QTYPE_CNAME = 5
+_QTYPE_SOA = 6
+_RCODE_NXDOMAIN = 3
+
+HOSTS_FILE = (os.path.join(os.environ.get('SystemRoot', r'C:\Windows'), r'System32\drivers\etc\hosts')
+              if os.name == 'nt' else '/etc/hosts')
+
+
+class DNSError(socket.gaierror):
+    """Name could not be resolved: NXDOMAIN, no records, or no server answered"""
+
+
+class _Entry:
+    __slots__ = ('addresses', 'expires', 'ttl', 'hits', 'error')
+
+    def __init__(self, addresses: List[str], ttl: float, error: Optional[str] = None):
+        self.addresses = addresses
+        self.ttl = ttl
+        self.expires = time.monotonic() + ttl
+        self.hits = 0
+        self.error = error
+
+
+def _encode_name(name: str) -> bytes:
+    try:
+        encoded = name.rstrip('.').encode('idna')
+    except UnicodeError:
+        raise DNSError(f"Invalid hostname {name!r}")
+    out = bytearray()
+    for label in encoded.split(b'.'):
+        if not label or len(label) > 63:
+            raise DNSError(f"Invalid hostname {name!r}")
+        out.append(len(label))
+        out += label
+    return bytes(out) + b'\0'
+
+
+def _skip_name(data: bytes, offset: int) -> int:
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2  # compression pointer ends the name
+        offset += length + 1
+
+
+def build_query(query_id: int, name: str, qtype: int) -> bytes:
+    """Standard recursive query for one name"""
+    return struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0) + _encode_name(name) + struct.pack('!HH', qtype, 1)
+
+
+def parse_response(data: bytes, query_id: int, qtype: int) -> Optional[Tuple[List[str], Optional[int], int]]:
+    """Parse an answer to our query into (addresses, ttl, rcode); None if it is not one
+
+    ttl is the smallest TTL on the answer chain, or the SOA negative TTL when there are
+    no addresses (None if the server gave neither).
+    """
+    if len(data) < 12:
+        return None
+    rid, flags, qdcount, ancount, nscount, _ = struct.unpack_from('!HHHHHH', data)
+    if rid != query_id or not flags & 0x8000:
+        return None
+    rcode = flags & 0x000F
+    offset = 12
+    for _ in range(qdcount):
+        offset = _skip_name(data, offset) + 4
+    addresses = []
+    ttl = None
+    for index in range(ancount + nscount):
+        offset = _skip_name(data, offset)
+        rtype, _, rttl, rdlength = struct.unpack_from('!HHIH', data, offset)
+        offset += 10
+        rdata = data[offset:offset + rdlength]
+        offset += rdlength
+        if index < ancount:
+            if rtype == qtype == QTYPE_A and rdlength == 4:
+                addresses.append(socket.inet_ntop(socket.AF_INET, rdata))
+            elif rtype == qtype == QTYPE_AAAA and rdlength == 16:
+                addresses.append(socket.inet_ntop(socket.AF_INET6, rdata))
+            elif rtype != _QTYPE_CNAME:
+                continue
+            ttl = rttl if ttl is None else min(ttl, rttl)
+        elif rtype == _QTYPE_SOA and not addresses:
+            # RFC 2308: negative answers live for min(SOA TTL, SOA MINIMUM)
+            minimum = struct.unpack_from('!I', rdata, rdlength - 4)[0]
+            ttl = min(rttl, minimum)
+    return addresses, ttl, rcode
+
+
+def _server_address(server) -> Tuple[str, int]:
+    if isinstance(server, (tuple, list)):
+        return server[0], int(server[1])
+    host, _, port = server.rpartition(':')
+    if host and port.isdigit() and ':' not in host:
+        return host, int(port)
+    return server, 53
+
+
+class DNSResolver:
+    """Caching stub resolver that queries every configured server at once
+
+    The first usable answer wins. Answers are cached for their TTL (clamped to
+    min_ttl..max_ttl), NXDOMAIN / no-data answers for their SOA negative TTL, in an
+    LRU bounded to cache_size names. Hot entries close to expiry are refreshed in the
+    background so connects keep hitting the cache. Concurrent lookups of the same name
+    share one query.
+    """
+
+    def __init__(self, servers: Callable[[], List], timeout: float = 2.0, attempts: int = 2,
+                 cache_size: int = 4096, min_ttl: float = 5.0, max_ttl: float = 3600.0,
+                 negative_ttl: float = 30.0, prefetch_ratio: float = 0.1, prefetch_min_hits: int = 2,
+                 hosts_file: Optional[str] = HOSTS_FILE):
+        self.servers = servers
+        self.timeout = timeout
+        self.attempts = attempts
+        self.cache_size = cache_size
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.prefetch_ratio = prefetch_ratio
+        self.prefetch_min_hits = prefetch_min_hits
+        self.counters = collections.Counter()
+        self._hosts = self._load_hosts(hosts_file) if hosts_file else {}
+        self._cache = collections.OrderedDict()  # (name, qtype) -> _Entry
+        self._lock = threading.Lock()
+        self._inflight: Dict[Tuple[str, int], threading.Event] = {}
+        self._prefetcher = None
+
+    @staticmethod
+    def _load_hosts(path: str) -> Dict[str, str]:
+        hosts = {}
+        try:
+            with open(path, encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    parts = line.split('#', 1)[0].split()
+                    for name in parts[1:]:
+                        hosts.setdefault(name.lower(), parts[0])
+        except OSError as e:
+            logger.debug("Could not read hosts file %s: %s", path, e)
+        return hosts
+
+    def resolve(self, host: str, qtype: int = QTYPE_A) -> List[str]:
+        """Addresses for host, from the cache if fresh; raises DNSError"""
+        static = self._static(host, qtype)
+        if static is not None:
+            return static
+        key = (host.lower().rstrip('.'), qtype)
+        while True:
+            entry = self._cached(key)
+            if entry is not None:
+                return self._answer(key, entry)
+            with self._lock:
+                event = self._inflight.get(key)
+                if event is None:
+                    self._inflight[key] = threading.Event()
+                    self.counters['misses'] += 1
+                    break
+            # Someone else is already asking; share their answer
+            event.wait(self.timeout * self.attempts)
+        try:
+            entry = self._query(key)
+        finally:
+            with self._lock:
+                self._inflight.pop(key).set()
+        return self._answer(key, entry)
+
+    def resolve_cached(self, host: str, qtype: int = QTYPE_A) -> Optional[List[str]]:
+        """Never blocks: cached (possibly stale) addresses, or None after scheduling a lookup
+
+        Meant for event loops. Stale answers are served while the refresh runs.
+        """
+        static = self._static(host, qtype)
+        if static is not None:
+            return static
+        key = (host.lower().rstrip('.'), qtype)
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry is not None and not entry.error:
+            if entry.expires <= time.monotonic():
+                self.counters['stale_hits'] += 1
+                self._prefetch(key)
+                return entry.addresses
+            entry = self._cached(key)
+            if entry is not None:
+                return self._answer(key, entry)
+        self.counters['misses'] += 1
+        self._prefetch(key)
+        return None
+
+    def prefetch(self, host: str, qtype: int = QTYPE_A):
+        """Warm the cache for host in the background"""
+        if self._static(host, qtype) is None:
+            self._prefetch((host.lower().rstrip('.'), qtype))
+
+    def _static(self, host: str, qtype: int) -> Optional[List[str]]:
+        try:
+            return [str(ipaddress.ip_address(host))]
+        except ValueError:
+            pass
+        address = self._hosts.get(host.lower().rstrip('.'))
+        if address is not None and (':' in address) == (qtype == QTYPE_AAAA):
+            return [address]
+        return None
+
+    def _cached(self, key) -> Optional[_Entry]:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None or entry.expires <= time.monotonic():
+                return None
+            self._cache.move_to_end(key)
+            entry.hits += 1
+        self.counters['negative_hits' if entry.error else 'hits'] += 1
+        remaining = entry.expires - time.monotonic()
+        if (not entry.error and entry.hits >= self.prefetch_min_hits
+                and remaining < entry.ttl * self.prefetch_ratio):
+            self._prefetch(key)
+        return entry
+
+    def _answer(self, key, entry: _Entry) -> List[str]:
+        if entry.error:
+            raise DNSError(f"Cannot resolve {key[0]}: {entry.error}")
+        return entry.addresses
+
+    def _store(self, key, entry: _Entry):
+        with self._lock:
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _prefetch(self, key):
+        with self._lock:
+            if key in self._inflight:
+                return
+            if self._prefetcher is None:
+                self._prefetcher = ThreadPoolExecutor(2, thread_name_prefix='dns-prefetch')
+            event = self._inflight[key] = threading.Event()
+            try:
+                # Submitted under the lock so close() cannot shut the pool down in between
+                future = self._prefetcher.submit(self._refresh, key)
+            except RuntimeError:
+                # Pool shut down underneath us (interpreter exit): nobody will answer this key
+                del self._inflight[key]
+                event.set()
+                return
+            self.counters['prefetches'] += 1
+        # Also runs when close() cancels the refresh before it starts, so waiters never hang
+        future.add_done_callback(lambda _: self._release(key, event))
+
+    def _release(self, key, event: threading.Event):
+        with self._lock:
+            if self._inflight.get(key) is event:
+                del self._inflight[key]
+        event.set()
+
+    def _refresh(self, key):
+        try:
+            self._query(key)
+        except DNSError as e:
+            logger.debug("DNS prefetch of %s failed: %s", key[0], e)
+
+    def _query(self, key) -> _Entry:
+        """Ask all servers in parallel, first answer wins; caches and returns the result"""
+        name, qtype = key
+        servers = [_server_address(server) for server in self.servers()]
+        if not servers:
+            raise DNSError("No DNS servers configured")
+        query_id = random.getrandbits(16)
+        query = build_query(query_id, name, qtype)
+        self.counters['queries'] += 1
+        for _ in range(self.attempts):
+            result = self._exchange(servers, query, query_id, qtype)
+            if result is None:
+                continue
+            addresses, ttl, rcode = result
+            if addresses:
+                ttl = min(max(ttl or 0, self.min_ttl), self.max_ttl)
+                entry = _Entry(addresses, ttl)
+            else:
+                error = 'NXDOMAIN' if rcode == _RCODE_NXDOMAIN else 'no address records'
+                entry = _Entry([], min(ttl if ttl is not None else self.negative_ttl, self.negative_ttl),
+                               error)
+            self._store(key, entry)
+            return entry
+        # Timeouts are not cached: the next caller retries
+        self.counters['timeouts'] += 1
+        raise DNSError(f"Cannot resolve {name}: no DNS server answered")
+
+    def _exchange(self, servers, query: bytes, query_id: int, qtype: int):
+        selector = selectors.DefaultSelector()
+        sockets = []
+        try:
+            for server in servers:
+                family = socket.AF_INET6 if ':' in server[0] else socket.AF_INET
+                sock = socket.socket(family, socket.SOCK_DGRAM)
+                sockets.append(sock)
+                sock.setblocking(False)
+                try:
+                    sock.connect(server)
+                    sock.send(query)
+                except OSError as e:
+                    logger.debug("DNS query to %s failed: %s", server[0], e)
+                    continue
+                selector.register(sock, selectors.EVENT_READ)
+            deadline = time.monotonic() + self.timeout
+            while selector.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                for key, _ in selector.select(remaining):
+                    try:
+                        result = parse_response(key.fileobj.recv(4096), query_id, qtype)
+                    except (OSError, struct.error, IndexError):
+                        # Unreachable server or garbled answer: keep waiting for the others
+                        selector.unregister(key.fileobj)
+                        continue
+                    if result is None:
+                        continue  # not an answer to this query
+                    if result[2] not in (0, _RCODE_NXDOMAIN):
+                        selector.unregister(key.fileobj)  # SERVFAIL / REFUSED
+                        continue
+                    return result
+            return None
+        finally:
+            selector.close()
+            for sock in sockets:
+                sock.close()
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def close(self):
+        """Stop background refreshes; queued ones are cancelled and release their waiters"""
+        with self._lock:
+            prefetcher, self._prefetcher = self._prefetcher, None
+        if prefetcher:
+            # Outside the lock: cancelling runs the done callbacks, which take it
+            prefetcher.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict:
+        return {
+            'servers': list(self.servers()),
+            'cache_entries': len(self._cache),
+            'hits': self.counters['hits'],
+            'negative_hits': self.counters['negative_hits'],
+            'stale_hits': self.counters['stale_hits'],
+            'misses': self.counters['misses'],
+            'queries': self.counters['queries'],
+            'timeouts': self.counters['timeouts'],
+            'prefetches': self.counters['prefetches']
+        }
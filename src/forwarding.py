@@ -0,0 +1,87 @@
+import errno
+import os
+import socket
+import sys
+from typing import Callable, Optional
+
+SPLICE_AVAILABLE = sys.platform.startswith('linux') and hasattr(os, 'splice')
+
+# fcntl command to resize a pipe (Linux only, not exported by the fcntl module)
+F_SETPIPE_SZ = 1031
+
+
+class SpliceUnsupported(Exception):
+    """Raised when the kernel refuses to splice between the given sockets"""
+
+
+def splice_forward(source: socket.socket, destination: socket.socket, buffer_size: int,
+                   running: Callable[[], bool], on_bytes: Optional[Callable[[int], None]] = None) -> int:
+    """Move bytes socket -> pipe -> socket inside the kernel, returning the number forwarded"""
+    read_fd, write_fd = os.pipe()
+    total = 0
+    try:
+        try:
+            import fcntl
+            fcntl.fcntl(write_fd, F_SETPIPE_SZ, buffer_size)
+        except OSError:
+            pass  # keep the default pipe size if the limit is lower than buffer_size
+        src_fd = source.fileno()
+        dst_fd = destination.fileno()
+        while running():
+            try:
+                n = os.splice(src_fd, write_fd, buffer_size, flags=os.SPLICE_F_MOVE)
+            except OSError as e:
+                if e.errno == errno.EINVAL and total == 0:
+                    raise SpliceUnsupported(str(e))
+                raise
+            if not n:
+                break
+            pending = n
+            while pending:
+                pending -= os.splice(read_fd, dst_fd, pending, flags=os.SPLICE_F_MOVE)
+            total += n
+            if on_bytes:
+                on_bytes(n)
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+    return total
+
+
+def buffered_forward(source: socket.socket, destination: socket.socket, buffer_size: int,
+                     running: Callable[[], bool], on_bytes: Optional[Callable[[int], None]] = None,
+                     transform: Optional[Callable[[memoryview], bytes]] = None) -> int:
+    """Portable path: recv_into one preallocated buffer and sendall out of a memoryview
+
+    transform, if given, rewrites each chunk before it is sent (e.g. tunnel framing).
+    """
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    total = 0
+    while running():
+        n = source.recv_into(buffer)
+        if not n:
+            break
+        if transform:
+            data = transform(view[:n])
+            if data:
+                destination.sendall(data)
+        else:
+            destination.sendall(view[:n])
+        total += n
+        if on_bytes:
+            on_bytes(n)
+    return total
+
+
+def forward_stream(source: socket.socket, destination: socket.socket, buffer_size: int = 65536,
+                   running: Callable[[], bool] = lambda: True, zero_copy: bool = True,
+                   on_bytes: Optional[Callable[[int], None]] = None,
+                   transform: Optional[Callable[[memoryview], bytes]] = None) -> int:
+    """Forward source to destination until EOF, using splice() where the platform allows"""
+    if zero_copy and SPLICE_AVAILABLE and not transform:
+        try:
+            return splice_forward(source, destination, buffer_size, running, on_bytes)
+        except SpliceUnsupported:
+            pass
+    return buffered_forward(source, destination, buffer_size, running, on_bytes, transform)
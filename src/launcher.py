@@ -1,17 +1,86 @@
 import os
 import sys
+import time
+
+_started = time.perf_counter()
+startup_profile = None
+if "--profile-startup" in sys.argv:
+    # Installed before anything else is imported so every import is accounted for
+    from startup_profile import StartupProfile
+    startup_profile = StartupProfile(_started)
+    startup_profile.install()
+
 import http.server
-import socketserver
-import webbrowser
 import json
-from vpn_handler import VPNHandler
+import threading
+from urllib.parse import urlsplit, parse_qs
+from static_assets import StaticAssets
+from status_feed import StatusFeed
 
 # Add current directory to Python path
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, current_dir)
 
-# Initialize VPN handler globally
-vpn_handler = VPNHandler()
+# The VPN handler (and the relay modules behind it) is created on first use, so the
+# control UI can serve its static pages before any of that is imported
+_vpn_handler = None
+_vpn_handler_lock = threading.Lock()
+
+
+def get_vpn_handler():
+    """The process-wide VPNHandler, created on first use"""
+    global _vpn_handler
+    if _vpn_handler is None:
+        with _vpn_handler_lock:
+            if _vpn_handler is None:
+                from vpn_handler import VPNHandler
+                _vpn_handler = VPNHandler()
+    return _vpn_handler
+
+
+_diagnostics = None
+
+
+def get_diagnostics():
+    """Profiler, memory and connection tracing controls, created on first use"""
+    global _diagnostics
+    if _diagnostics is None:
+        with _vpn_handler_lock:
+            if _diagnostics is None:
+                from diagnostics import Diagnostics
+                _diagnostics = Diagnostics(lambda: get_vpn_handler().tracer)
+    return _diagnostics
+
+# Longest a long-poll or SSE wait blocks before answering / sending a keepalive
+LONG_POLL_TIMEOUT = 30
+SSE_KEEPALIVE = 15
+# The full status, counters included, is rebuilt at most this often however many clients ask
+STATS_MAX_AGE = 5
+
+
+def build_status():
+    """State pushed through /api/status and /api/events; changes only on real events"""
+    vpn_handler = get_vpn_handler()
+    return {
+        "success": True,
+        "status": vpn_handler.get_vpn_state(),
+        "servers": vpn_handler.node_catalog.listing()
+    }
+
+
+def build_stats():
+    """Full status with traffic and other counters, for /api/stats and the POST status action"""
+    vpn_handler = get_vpn_handler()
+    return {
+        "success": True,
+        "status": vpn_handler.get_vpn_status(),
+        "servers": vpn_handler.node_catalog.listing()
+    }
+
+
+status_feed = StatusFeed(build_status)
+# No background thread: rebuilt on request, at most every STATS_MAX_AGE seconds
+stats_feed = StatusFeed(build_stats)
 
 def resource_path(relative_path):
     """Get absolute path to resource, works for dev and for PyInstaller"""
@@ -22,29 +91,162 @@ def resource_path(relative_path):
         base_path = os.path.abspath(".")
     return os.path.join(base_path, relative_path)
 
+
+static_assets = StaticAssets(resource_path("."))
+
 class Handler(http.server.SimpleHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.vpn_handler = vpn_handler
+    # The request is handled inside __init__, so this must be set at class level
+    status_feed = status_feed
+    stats_feed = stats_feed
+    static_assets = static_assets
+    # Set while answering a debug route, which must never be readable cross-origin
+    debug_request = False
+
+    @property
+    def vpn_handler(self):
+        return get_vpn_handler()
 
     def end_headers(self):
         """Add CORS headers"""
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        if not self.debug_request:
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+            self.send_header('Access-Control-Allow-Headers', 'Content-Type')
         super().end_headers()
 
     def do_OPTIONS(self):
         """Handle OPTIONS request for CORS"""
+        self.debug_request = urlsplit(self.path).path.startswith("/api/debug/")
         self.send_response(200)
         self.end_headers()
 
     def do_GET(self):
         """Handle GET requests"""
+        url = urlsplit(self.path)
+        if url.path == "/api/status":
+            return self._send_status(parse_qs(url.query))
+        if url.path == "/api/events":
+            return self._stream_events()
+        if url.path == "/api/stats":
+            return self._send_stats()
+        if url.path == "/metrics":
+            return self._send_metrics()
+        if url.path.startswith("/api/debug/"):
+            return self._send_debug_file(url.path[len("/api/debug/"):])
+        if self.static_assets.serve(self, url.path):
+            return
         if self.path == "/":
             self.path = "/index.html"
         return super().do_GET()
 
+    def do_HEAD(self):
+        """Handle HEAD requests"""
+        if self.static_assets.serve(self, urlsplit(self.path).path, head=True):
+            return
+        return super().do_HEAD()
+
+    def _send_status(self, query):
+        """Serve the cached snapshot with ETag/304; ?wait=N long-polls for a change"""
+        client_etag = self.headers.get("If-None-Match")
+        if client_etag and "wait" in query:
+            try:
+                wait = min(float(query["wait"][0]), LONG_POLL_TIMEOUT)
+            except ValueError:
+                wait = LONG_POLL_TIMEOUT
+            etag, body = self.status_feed.wait_for_change(client_etag, wait)
+        else:
+            etag, body = self.status_feed.snapshot()
+        if client_etag == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stats(self):
+        """Full status with counters, throttled to one rebuild per STATS_MAX_AGE"""
+        etag, body = self.stats_feed.snapshot(max_age=STATS_MAX_AGE)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self._send_json(body, etag)
+
+    def _send_metrics(self):
+        """Prometheus text exposition of the relay's per-node metrics"""
+        body = self.vpn_handler.metrics.prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _is_local_client(self):
+        """Debug actions and downloads expose process internals, so only local clients get them"""
+        host = self.client_address[0]
+        return host in ("127.0.0.1", "::1") or host.startswith("::ffff:127.")
+
+    def _debug_allowed(self):
+        """A local client talking to the control UI itself, not a page from another origin
+
+        Any web page open in the user's browser is also a local client, so the Host
+        must name the control UI (which defeats DNS rebinding) and the Origin, when
+        the browser sends one, must be the control UI's own.
+        """
+        self.debug_request = True
+        if not self._is_local_client():
+            return False
+        port = self.server.server_address[1]
+        control_hosts = {f"localhost:{port}", f"127.0.0.1:{port}", f"[::1]:{port}"}
+        if self.headers.get("Host", "").lower() not in control_hosts:
+            return False
+        origin = self.headers.get("Origin")
+        if origin is not None and origin.lower() not in {f"http://{host}" for host in control_hosts}:
+            return False
+        return self.headers.get("Sec-Fetch-Site", "same-origin") in ("same-origin", "none")
+
+    def _send_debug_file(self, name):
+        """Download profiler, stack, memory or connection-trace results"""
+        if not self._debug_allowed():
+            return self.send_error(403)
+        result = get_diagnostics().download(name)
+        if result is None:
+            return self.send_error(404)
+        content_type, body = result
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Content-Disposition", f'attachment; filename="{name}"')
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream_events(self):
+        """Server-Sent Events stream pushing the snapshot whenever it changes"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        etag = self.headers.get("Last-Event-ID")
+        try:
+            while True:
+                new_etag, body = self.status_feed.wait_for_change(etag, SSE_KEEPALIVE)
+                if new_etag == etag:
+                    self.wfile.write(b": keepalive\n\n")
+                else:
+                    etag = new_etag
+                    self.wfile.write(b"id: " + etag.encode("utf-8") + b"\nevent: status\ndata: " + body + b"\n\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
     def do_POST(self):
         """Handle POST requests"""
         content_length = int(self.headers["Content-Length"])
@@ -58,28 +260,47 @@ class Handler(http.server.SimpleHTTPRequestHandler):
                 country = data.get("country")
                 success = self.vpn_handler.start_vpn(country)
                 response = {"success": success}
+                self.status_feed.refresh()
+                self.stats_feed.expire()
+            elif data.get("action") == "switch":
+                # Keeps the listener up; sessions on the old node drain in the background
+                success = self.vpn_handler.switch_node(data.get("country"))
+                response = {"success": success}
+                self.status_feed.refresh()
+                self.stats_feed.expire()
             elif data.get("action") == "disconnect":
                 success = self.vpn_handler.stop_vpn()
                 response = {"success": success}
+                self.status_feed.refresh()
+                self.stats_feed.expire()
             elif data.get("action") == "status":
-                status = self.vpn_handler.get_vpn_status()
-                response = {
-                    "success": True,
-                    "status": status,
-                    "servers": [{'country': node.country, 'host': node.host, 'port': node.port} 
-                              for node in self.vpn_handler.vpn_nodes]
-                }
+                etag, body = self.stats_feed.snapshot(max_age=STATS_MAX_AGE)
+                return self._send_json(body, etag)
+            else:
+                from diagnostics import DEBUG_ACTIONS
+                if data.get("action") in DEBUG_ACTIONS:
+                    if not self._debug_allowed():
+                        return self.send_error(403)
+                    response = get_diagnostics().run(data["action"], data)
         except Exception as e:
             response = {'success': False, 'error': str(e)}
         
+        self._send_json(json.dumps(response).encode("utf-8"))
+
+    def _send_json(self, body: bytes, etag: str = None):
         self.send_response(200)
         self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", etag)
         self.end_headers()
-        self.wfile.write(json.dumps(response).encode("utf-8"))
+        self.wfile.write(body)
 
 def main():
     """Main function to start the server"""
     PORT = 8000
+    if startup_profile:
+        startup_profile.mark("imports")
     Handler.extensions_map = {
         '': 'application/octet-stream',
         '.html': 'text/html',
@@ -92,10 +313,35 @@ def main():
         '.svg': 'image/svg+xml',
         '.ico': 'image/x-icon',
     }
-    with socketserver.TCPServer(("", PORT), Handler) as httpd:
+    # One thread per request so a slow client or an open event stream never blocks the others
+    with http.server.ThreadingHTTPServer(("", PORT), Handler) as httpd:
+        if startup_profile:
+            startup_profile.mark("listening")
         print(f"VPN Server running at http://localhost:{PORT}")
-        webbrowser.open(f"http://localhost:{PORT}")
+        threading.Thread(target=_warm_up, args=(f"http://localhost:{PORT}",), daemon=True).start()
         httpd.serve_forever()
 
+
+def _warm_up(url):
+    """Bring up the heavyweight parts after the UI is already serving"""
+    import webbrowser
+    static_assets.preload()
+    webbrowser.open(url)
+    try:
+        get_vpn_handler()
+        status_feed.refresh()
+    except Exception as e:
+        print(f"VPN handler failed to initialise: {e}")
+    status_feed.start()
+    if startup_profile:
+        startup_profile.mark("vpn_handler_ready")
+        startup_profile.uninstall()
+        print(startup_profile.report())
+
+
 if __name__ == "__main__":
+    if getattr(sys, "frozen", False):
+        # Relay workers are spawned from the PyInstaller exe itself: let it act as the child
+        import multiprocessing
+        multiprocessing.freeze_support()
     main() 
\ No newline at end of file
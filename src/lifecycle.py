@@ -0,0 +1,255 @@
+import logging
+import socket
+import struct
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+from metrics import ShardedCounter
+
+logger = logging.getLogger(__name__)
+
+IDLE, READ, WRITE, CONNECT = 'idle', 'read', 'write', 'connect'
+
+
+class TimeoutPolicy:
+    """Deadlines for proxied connections in seconds; 0 disables one
+
+    idle: nothing moved in either direction.
+    read: one side half-closed and the other has not sent anything since.
+    write: buffered bytes made no progress towards a peer that stopped reading.
+    connect: an upstream connect has not completed.
+    """
+    __slots__ = ('idle', 'read', 'write', 'connect')
+
+    def __init__(self, idle: float = 300.0, read: float = 60.0, write: float = 60.0, connect: float = 5.0):
+        self.idle = idle
+        self.read = read
+        self.write = write
+        self.connect = connect
+
+    def expired(self, now: float, last_active: float, half_closed: Optional[float] = None,
+                stalled: Optional[float] = None) -> Optional[str]:
+        """Which deadline a connection has passed, if any
+
+        half_closed and stalled are the times the first EOF was seen and a write
+        stopped making progress, or None.
+        """
+        if stalled is not None and self.write and now - stalled > self.write:
+            return WRITE
+        if half_closed is not None and self.read and now - max(half_closed, last_active) > self.read:
+            return READ
+        if self.idle and now - last_active > self.idle:
+            return IDLE
+        return None
+
+    def apply_send_timeout(self, sock: socket.socket):
+        """Make blocking sends on sock fail after the write timeout instead of hanging"""
+        if not self.write or not hasattr(socket, 'SO_SNDTIMEO'):
+            return
+        if sys.platform == 'win32':
+            value = struct.pack('I', int(self.write * 1000))
+        else:
+            seconds = int(self.write)
+            value = struct.pack('ll', seconds, int((self.write - seconds) * 1e6))
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, value)
+        except OSError as e:
+            logger.debug("Could not set send timeout: %s", e)
+
+    def to_dict(self) -> Dict:
+        return {'idle': self.idle, 'read': self.read, 'write': self.write, 'connect': self.connect}
+
+
+class ProxySession:
+    """A client and upstream socket pair relayed by two blocking forwarder threads"""
+    __slots__ = ('client', 'upstream', 'address', 'node', 'started', 'last_active', 'half_closed',
+                 'aborted')
+
+    def __init__(self, client: socket.socket, upstream: Optional[socket.socket], address, node):
+        self.client = client
+        self.upstream = upstream
+        self.address = address
+        self.node = node
+        self.started = self.last_active = time.monotonic()
+        self.half_closed = None
+        self.aborted = None
+
+    def touch(self, n: int = 0):
+        self.last_active = time.monotonic()
+
+    def eof(self):
+        """One direction reached EOF; the other now has to finish within the read timeout"""
+        if self.half_closed is None:
+            self.half_closed = time.monotonic()
+
+    def abort_upstream(self):
+        try:
+            self.upstream.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def abort(self, reason: str):
+        """Shut both sockets down so blocked forwarders return; the owner still closes them"""
+        if self.aborted:
+            return
+        self.aborted = reason
+        for sock in (self.client, self.upstream):
+            if sock is None:
+                continue
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class LifecycleManager:
+    """Live proxy sessions, their timeouts and a graceful drain on shutdown
+
+    Thread-engine sessions are registered here and swept by a reaper thread. The
+    selector relay keeps its own connections on its event loop but applies the
+    same policy and reports into the same counters.
+    """
+
+    def __init__(self, policy: Optional[TimeoutPolicy] = None, sweep_interval: float = 1.0):
+        self.policy = policy or TimeoutPolicy()
+        self.sweep_interval = sweep_interval
+        self.timeouts = {reason: ShardedCounter() for reason in (IDLE, READ, WRITE, CONNECT)}
+        self.aborted_on_drain = 0
+        self._retiring = {}  # node -> [deadline, live sessions at the last sweep]
+        self._sessions = set()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._wake = threading.Event()
+        self._running = False
+        self._thread = None
+
+    @property
+    def active(self) -> int:
+        return len(self._sessions)
+
+    def start(self):
+        """Start the reaper thread"""
+        if self._running:
+            return
+        self._running = True
+        self._wake.clear()
+        self._thread = threading.Thread(target=self._reap_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+
+    def register(self, client: socket.socket, address) -> ProxySession:
+        """Track a freshly accepted client; attach() its upstream once connected"""
+        session = ProxySession(client, None, address, None)
+        self.policy.apply_send_timeout(client)
+        with self._lock:
+            self._sessions.add(session)
+        return session
+
+    def attach(self, session: ProxySession, upstream: socket.socket, node):
+        self.policy.apply_send_timeout(upstream)
+        session.upstream = upstream
+        session.node = node
+        session.touch()
+        if session.aborted:
+            session.abort_upstream()
+
+    def unregister(self, session: ProxySession):
+        with self._lock:
+            self._sessions.discard(session)
+            if not self._sessions:
+                self._idle.notify_all()
+
+    def record_timeout(self, reason: str):
+        self.timeouts[reason].add()
+        logger.debug("Connection timed out (%s)", reason, extra={'event': 'connection_timeout'})
+
+    def retire(self, node, timeout: float):
+        """Abort sessions still on node once timeout seconds have passed; the node takes no new ones"""
+        with self._lock:
+            self._retiring[node] = [time.monotonic() + timeout, None]
+        self._wake.set()
+
+    def retiring(self) -> Dict:
+        """{node: live sessions} for nodes still draining after retire()"""
+        with self._lock:
+            return {node: live for node, (_, live) in self._retiring.items()}
+
+    def drain(self, timeout: float) -> bool:
+        """Wait up to timeout for registered sessions to finish, then abort the rest
+
+        Returns True if every session ended on its own.
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while self._sessions:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._idle.wait(remaining)
+            leftover = list(self._sessions)
+        for session in leftover:
+            session.abort('drain')
+        self.aborted_on_drain += len(leftover)
+        if leftover:
+            logger.warning("Drain deadline passed, aborted %d connections", len(leftover),
+                           extra={'event': 'drain_aborted'})
+            # Give the forwarders a moment to notice and close their sockets
+            with self._lock:
+                if self._sessions:
+                    self._idle.wait(1.0)
+        return not leftover
+
+    def _sweep_retired(self, now: float, sessions: list, retiring: list) -> list:
+        """Abort sessions of retired nodes past their deadline; returns the sessions left to check"""
+        remaining = sessions
+        for node, entry in retiring:
+            on_node = [session for session in sessions if session.node is node and not session.aborted]
+            entry[1] = len(on_node)
+            if on_node and now < entry[0]:
+                continue
+            if on_node:
+                logger.warning("Node %s drain deadline passed, aborted %d connections", node.country, len(on_node),
+                               extra={'event': 'drain_aborted', 'node': node.country})
+                self.aborted_on_drain += len(on_node)
+                for session in on_node:
+                    session.abort('drain')
+                remaining = [session for session in remaining if session.node is not node]
+            else:
+                logger.info("Node %s drained", node.country, extra={'event': 'node_drained', 'node': node.country})
+            with self._lock:
+                if self._retiring.get(node) is entry:
+                    del self._retiring[node]
+        return remaining
+
+    def stats(self) -> Dict:
+        return {
+            'active_sessions': self.active,
+            'policy': self.policy.to_dict(),
+            'timeouts': {reason: counter.value for reason, counter in self.timeouts.items()},
+            'aborted_on_drain': self.aborted_on_drain
+        }
+
+    def _reap_loop(self):
+        while self._running:
+            self._wake.wait(self.sweep_interval)
+            self._wake.clear()
+            if not self._running:
+                break
+            now = time.monotonic()
+            with self._lock:
+                sessions = list(self._sessions)
+                retiring = list(self._retiring.items())
+            if retiring:
+                sessions = self._sweep_retired(now, sessions, retiring)
+            for session in sessions:
+                if session.aborted:
+                    continue
+                reason = self.policy.expired(now, session.last_active, session.half_closed)
+                if reason:
+                    self.record_timeout(reason)
+                    session.abort(reason)
@@ -0,0 +1,70 @@
+import logging
+import socket
+import sys
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+REUSE_PORT_AVAILABLE = hasattr(socket, 'SO_REUSEPORT') and sys.platform != 'win32'
+
+
+class ListenerConfig:
+    """Address and socket options for the local proxy listener and the connections it relays"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8080, backlog: int = 1024,
+                 nodelay: bool = True, keepalive: bool = True, keepalive_idle: int = 60,
+                 recv_buffer: Optional[int] = None, send_buffer: Optional[int] = None,
+                 reuse_port: bool = False):
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.nodelay = nodelay
+        self.keepalive = keepalive
+        self.keepalive_idle = keepalive_idle
+        self.recv_buffer = recv_buffer
+        self.send_buffer = send_buffer
+        self.reuse_port = reuse_port
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+
+def create_listener(config: ListenerConfig) -> socket.socket:
+    """Bind and listen according to config; reuse_port lets several processes share the port"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        if sys.platform != 'win32':
+            # Windows SO_REUSEADDR allows port hijacking, elsewhere it only skips TIME_WAIT
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if config.reuse_port:
+            if not REUSE_PORT_AVAILABLE:
+                raise OSError("SO_REUSEPORT is not supported on this platform")
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # Accepted sockets inherit buffer sizes from the listener
+        if config.recv_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, config.recv_buffer)
+        if config.send_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, config.send_buffer)
+        sock.bind((config.host, config.port))
+        sock.listen(config.backlog)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def tune_connection(sock: socket.socket, config: ListenerConfig):
+    """Apply per-connection options to an accepted client or upstream socket"""
+    try:
+        if config.nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if config.keepalive:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, config.keepalive_idle)
+        if config.recv_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, config.recv_buffer)
+        if config.send_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, config.send_buffer)
+    except OSError as e:
+        logger.debug("Could not tune socket: %s", e)
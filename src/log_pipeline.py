@@ -0,0 +1,146 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+# Attributes every LogRecord has; anything else came in through extra= and is emitted as a field
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional['DroppingQueueHandler'] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: timestamp, level, logger, message plus any extra= fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': round(record.created, 6),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per message type, plus optional random sampling per event
+
+    A record's type is its ``event`` extra field if given, otherwise its unformatted
+    message template, so "New connection from %s" is one type however many clients
+    there are. Suppressed records are counted and reported on the next one let through.
+    At most max_buckets types are tracked: past that, buckets idle long enough to have
+    refilled are dropped (they equal a fresh one), then the least recently used.
+    """
+
+    def __init__(self, rate: float = 20.0, burst: int = 50, sample_rates: Dict[str, float] = None,
+                 max_buckets: int = 1024):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample_rates = sample_rates or {}
+        self.max_buckets = max_buckets
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, 'event', None) or (record.name, record.msg)
+        sample_rate = self.sample_rates.get(key)
+        if sample_rate is not None and random.random() >= sample_rate:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, suppressed = self._buckets.get(key, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now, suppressed + 1)
+                return False
+            self._buckets[key] = (tokens - 1, now, 0)
+            if len(self._buckets) > self.max_buckets:
+                self._prune(now)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+    def _prune(self, now: float):
+        """Drop refilled buckets, then the least recently used, until at most half of max_buckets remain"""
+        refill = self.burst / self.rate if self.rate else float('inf')
+        buckets = {key: bucket for key, bucket in self._buckets.items()
+                   if now - bucket[1] < refill or bucket[2]}
+        if len(buckets) > self.max_buckets // 2:
+            newest = sorted(buckets.items(), key=lambda item: item[1][1])[-(self.max_buckets // 2):]
+            buckets = dict(newest)
+        self._buckets = buckets
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue records without formatting them and drop instead of blocking when full"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting happens on the listener thread; the record never leaves this process
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(level='INFO', json_format: bool = True, rate: float = 20.0, burst: int = 50,
+                  sample_rates: Dict[str, float] = None, max_queue: int = 10000, stream=None):
+    """Route all logging through a bounded queue drained by one background listener thread"""
+    global _listener, _queue_handler
+    shutdown_logging()
+    output = logging.StreamHandler(stream or sys.stderr)
+    if json_format:
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    _queue_handler = DroppingQueueHandler(queue.Queue(maxsize=max_queue))
+    _queue_handler.addFilter(RateLimitFilter(rate, burst, sample_rates))
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def set_level(level):
+    """Change the root log level at runtime"""
+    logging.getLogger().setLevel(level)
+
+
+def dropped_records() -> int:
+    return _queue_handler.dropped if _queue_handler else 0
+
+
+def shutdown_logging():
+    """Flush queued records and stop the listener thread"""
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
@@ -0,0 +1,233 @@
+import bisect
+import threading
+import time
+from typing import Callable, Dict, List, Sequence
+
+# Connect latency buckets in milliseconds (upper bounds, +Inf is implicit)
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class _Lease:
+    """Held in a thread's local storage; hands the shard back to the pool when the thread ends"""
+    __slots__ = ('pool', 'shard')
+
+    def __init__(self, pool: List, shard: List):
+        self.pool = pool
+        self.shard = shard
+
+    def __del__(self):
+        self.pool.append(self.shard)
+
+
+class _Sharded:
+    """Per-thread shards summed on read
+
+    A finished thread's shard keeps its counts and goes back to a pool for the next new
+    thread, so there are only as many shards as threads ever ran at once and neither the
+    hot path nor a thread's first update walks the others.
+    """
+    __slots__ = ('_local', '_new_shard', '_shards', '_free', '_lock')
+
+    def __init__(self, new_shard: Callable[[], List]):
+        self._local = threading.local()
+        self._new_shard = new_shard
+        self._shards = []
+        self._free = []
+        self._lock = threading.Lock()
+
+    def _shard(self) -> List:
+        try:
+            shard = self._free.pop()
+        except IndexError:
+            shard = self._new_shard()
+            with self._lock:
+                self._shards.append(shard)
+        self._local.shard = shard
+        self._local.lease = _Lease(self._free, shard)
+        return shard
+
+    def totals(self) -> List:
+        with self._lock:
+            shards = list(self._shards)
+        totals = self._new_shard()
+        for shard in shards:
+            for i, n in enumerate(shard):
+                totals[i] += n
+        return totals
+
+
+class ShardedCounter(_Sharded):
+    """Counter where each thread increments its own shard, so the hot path takes no lock"""
+    __slots__ = ()
+
+    def __init__(self):
+        super().__init__(lambda: [0])
+
+    def add(self, n: int = 1):
+        try:
+            self._local.shard[0] += n
+        except AttributeError:
+            self._shard()[0] += n
+
+    @property
+    def value(self) -> int:
+        return self.totals()[0]
+
+
+class Histogram(_Sharded):
+    """Fixed-bucket histogram with per-thread shards of bucket counts"""
+    __slots__ = ('bounds',)
+
+    def __init__(self, bounds: Sequence[float] = LATENCY_BUCKETS_MS):
+        self.bounds = tuple(bounds)
+        # bucket counts (last one is +Inf) followed by [sum, count]
+        super().__init__(lambda: [0] * (len(self.bounds) + 1) + [0.0, 0])
+
+    def observe(self, value: float):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._shard()
+        shard[bisect.bisect_left(self.bounds, value)] += 1
+        shard[-2] += value
+        shard[-1] += 1
+
+    def quantile(self, q: float, totals: List = None):
+        """Upper bound of the bucket holding the q-th observation"""
+        totals = totals or self.totals()
+        count = totals[-1]
+        if not count:
+            return None
+        rank, seen = q * count, 0
+        for bound, n in zip(self.bounds + (float('inf'),), totals):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class NodeMetrics:
+    """Traffic and connection counters for one VPN node"""
+
+    def __init__(self, node):
+        self.node = node
+        self.bytes_in = ShardedCounter()      # node -> client
+        self.bytes_out = ShardedCounter()     # client -> node
+        self.connections_opened = ShardedCounter()
+        self.connections_closed = ShardedCounter()
+        self.udp_flows_opened = ShardedCounter()
+        self.udp_flows_closed = ShardedCounter()
+        self.connect_errors = ShardedCounter()
+        self.relay_errors = ShardedCounter()
+        self.connect_latency = Histogram()
+        self._rate_sample = (time.monotonic(), 0, 0)
+        self.rate_in = 0.0
+        self.rate_out = 0.0
+
+    def update_rates(self, min_interval: float = 1.0):
+        """Recompute bytes/s from the change since the previous sample"""
+        now = time.monotonic()
+        then, prev_in, prev_out = self._rate_sample
+        if now - then < min_interval:
+            return
+        bytes_in, bytes_out = self.bytes_in.value, self.bytes_out.value
+        self.rate_in = (bytes_in - prev_in) / (now - then)
+        self.rate_out = (bytes_out - prev_out) / (now - then)
+        self._rate_sample = (now, bytes_in, bytes_out)
+
+    def snapshot(self) -> Dict:
+        self.update_rates()
+        opened, closed = self.connections_opened.value, self.connections_closed.value
+        flows_opened, flows_closed = self.udp_flows_opened.value, self.udp_flows_closed.value
+        latency = self.connect_latency.totals()
+        return {
+            'bytes_in': self.bytes_in.value,
+            'bytes_out': self.bytes_out.value,
+            'rate_in_bps': round(self.rate_in, 1),
+            'rate_out_bps': round(self.rate_out, 1),
+            'active_connections': opened - closed,
+            'total_connections': opened,
+            'active_udp_flows': flows_opened - flows_closed,
+            'total_udp_flows': flows_opened,
+            'connect_errors': self.connect_errors.value,
+            'relay_errors': self.relay_errors.value,
+            'connect_latency_p50_ms': self.connect_latency.quantile(0.5, latency),
+            'connect_latency_p99_ms': self.connect_latency.quantile(0.99, latency)
+        }
+
+
+class MetricsRegistry:
+    """Per-node metrics, created on first use"""
+
+    def __init__(self):
+        self._nodes = {}
+        self._lock = threading.Lock()
+
+    def node(self, node) -> NodeMetrics:
+        metrics = self._nodes.get(node)
+        if metrics is None:
+            with self._lock:
+                metrics = self._nodes.get(node)
+                if metrics is None:
+                    metrics = self._nodes[node] = NodeMetrics(node)
+        return metrics
+
+    def snapshot(self) -> Dict:
+        """Totals over every node and one entry per node, keyed by host:port as a country has many"""
+        totals = dict.fromkeys(('bytes_in', 'bytes_out', 'rate_in_bps', 'rate_out_bps', 'active_connections',
+                                'total_connections', 'active_udp_flows', 'total_udp_flows', 'connect_errors',
+                                'relay_errors'), 0)
+        nodes = {}
+        for metrics in list(self._nodes.values()):
+            values = metrics.snapshot()
+            # Summed per metrics object, so nodes sharing an address are still all counted
+            for key in totals:
+                totals[key] += values[key]
+            nodes[metrics.node.address] = {'country': metrics.node.country, **values}
+        return {'totals': totals, 'nodes': nodes}
+
+    def prometheus(self) -> str:
+        """Render every node's metrics in the Prometheus text exposition format"""
+        counters = (
+            ('vpn_bytes_received_total', 'Bytes relayed from VPN nodes to clients', 'counter', 'bytes_in'),
+            ('vpn_bytes_sent_total', 'Bytes relayed from clients to VPN nodes', 'counter', 'bytes_out'),
+            ('vpn_connections_total', 'Upstream connections established', 'counter', 'connections_opened'),
+            ('vpn_udp_flows_total', 'UDP flows opened through the node', 'counter', 'udp_flows_opened'),
+            ('vpn_connect_errors_total', 'Failed upstream connects', 'counter', 'connect_errors'),
+            ('vpn_relay_errors_total', 'Connections aborted by a socket error', 'counter', 'relay_errors'),
+        )
+        nodes = list(self._nodes.values())
+        lines = []
+        for name, help_text, kind, attr in counters:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for metrics in nodes:
+                lines.append(f"{name}{{{_labels(metrics.node)}}} {getattr(metrics, attr).value}")
+        lines.append("# HELP vpn_active_connections Connections currently relayed")
+        lines.append("# TYPE vpn_active_connections gauge")
+        for metrics in nodes:
+            active = metrics.connections_opened.value - metrics.connections_closed.value
+            lines.append(f"vpn_active_connections{{{_labels(metrics.node)}}} {active}")
+        lines.append("# HELP vpn_active_udp_flows UDP flows currently relayed")
+        lines.append("# TYPE vpn_active_udp_flows gauge")
+        for metrics in nodes:
+            active = metrics.udp_flows_opened.value - metrics.udp_flows_closed.value
+            lines.append(f"vpn_active_udp_flows{{{_labels(metrics.node)}}} {active}")
+        lines.append("# HELP vpn_connect_latency_ms Upstream connect latency")
+        lines.append("# TYPE vpn_connect_latency_ms histogram")
+        for metrics in nodes:
+            labels = _labels(metrics.node)
+            totals = metrics.connect_latency.totals()
+            cumulative = 0
+            for bound, n in zip(metrics.connect_latency.bounds, totals):
+                cumulative += n
+                lines.append(f'vpn_connect_latency_ms_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'vpn_connect_latency_ms_bucket{{{labels},le="+Inf"}} {totals[-1]}')
+            lines.append(f"vpn_connect_latency_ms_sum{{{labels}}} {totals[-2]}")
+            lines.append(f"vpn_connect_latency_ms_count{{{labels}}} {totals[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(node) -> str:
+    country = node.country.replace('\\', '\\\\').replace('"', '\\"')
+    return f'node="{country}",host="{node.host}",port="{node.port}"'
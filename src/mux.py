@@ -0,0 +1,497 @@
+import collections
+import errno
+import logging
+import selectors
+import socket
+import struct
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+# type, stream id, payload length
+FRAME_HEADER = struct.Struct('!BIH')
+OPEN, DATA, WINDOW, FIN, RST = 1, 2, 3, 4, 5
+_WINDOW_PAYLOAD = struct.Struct('!I')
+# Credit every stream starts with in each direction, whatever either side's window;
+# a larger receive window is granted with a WINDOW frame once the stream exists
+INITIAL_WINDOW = 65536
+
+_TUNNEL = object()
+_WAKEUP = object()
+
+
+class MuxError(Exception):
+    """The peer broke the multiplexing protocol"""
+
+
+class SessionPending(OSError):
+    """No shared tunnel is up yet; one is being opened in the background"""
+
+
+def encode_target(target: Optional[str]) -> bytes:
+    """OPEN payload for target; raises OSError for a name that cannot be sent
+
+    The frame length must count these bytes: an IDN host is longer encoded than
+    it is in characters.
+    """
+    try:
+        payload = (target or '').encode('idna')
+    except UnicodeError as e:
+        raise OSError(errno.EINVAL, f"Invalid stream target {target!r}") from e
+    if len(payload) > 0xFFFF:
+        raise OSError(errno.EINVAL, "Stream target too long")
+    return payload
+
+
+class _Stream:
+    """One multiplexed stream and the local socket it is bridged to"""
+    __slots__ = ('id', 'sock', 'events', 'connecting', 'pending', 'outbuf', 'send_window',
+                 'unacked', 'eof', 'fin_sent', 'fin_received', 'shut_wr', 'queued')
+
+    def __init__(self, stream_id: int, sock: socket.socket, window: int, connecting: bool = False):
+        self.id = stream_id
+        self.sock = sock
+        self.events = 0
+        self.connecting = connecting
+        self.pending = bytearray()   # read locally, not yet framed for the tunnel
+        self.outbuf = bytearray()    # received from the tunnel, not yet written locally
+        self.send_window = window    # bytes the peer can still accept for this stream
+        self.unacked = 0             # delivered locally since our last WINDOW update
+        self.eof = False
+        self.fin_sent = False
+        self.fin_received = False
+        self.shut_wr = False
+        self.queued = False          # waiting in the scheduler's round-robin queue
+
+    @property
+    def finished(self) -> bool:
+        return self.fin_sent and self.fin_received and self.shut_wr and not self.outbuf
+
+
+class MuxSession:
+    """Many streams over one tunnel connection, driven by a selector loop on its own thread
+
+    Every stream gets a credit-based flow-control window in each direction, so a slow
+    reader stalls only its own stream. Outgoing data is scheduled round-robin in
+    quantum-sized slices and the tunnel send buffer is kept short, so one bulk
+    transfer cannot starve interactive streams sharing the tunnel.
+
+    stage supplies encode()/decode() for the tunnel bytes (compression, encryption)
+    after its handshake has finished. The proxy side calls open_stream(); the node
+    side passes on_open(target) returning a connecting socket for each OPEN frame,
+    or a Future of one when getting it would block the loop (a name lookup). Data
+    for such a stream is buffered, within its window, until the socket arrives.
+
+    window is this side's receive window per stream, at least INITIAL_WINDOW, so
+    the two ends of a tunnel need not be configured alike.
+    """
+
+    def __init__(self, tunnel: socket.socket, stage=None,
+                 on_open: Optional[Callable[[Optional[str]], Union[socket.socket, Future]]] = None,
+                 window: int = 262144, quantum: int = 16384, high_water: int = 65536,
+                 buffer_size: int = 65536, on_closed: Optional[Callable[['MuxSession'], None]] = None):
+        self.tunnel = tunnel
+        self.stage = stage
+        self.on_open = on_open
+        self.window = max(window, INITIAL_WINDOW)
+        self.quantum = quantum
+        self.high_water = high_water
+        self.on_closed = on_closed
+        self.closed = False
+        self.total_streams = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._streams: Dict[int, _Stream] = {}
+        self._ready = collections.deque()      # streams with pending data or a FIN to send
+        self._control = []                     # OPEN / WINDOW / RST frames, sent before data
+        self._outbuf = bytearray()             # encoded bytes waiting for the tunnel
+        self._inbuf = bytearray()              # decoded bytes waiting to be parsed into frames
+        self._tunnel_events = 0
+        self._next_id = 1
+        self._opens = collections.deque()
+        self._attached = collections.deque()   # (stream id, socket or error) from on_open futures
+        self._lock = threading.Lock()
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._thread = None
+
+    @property
+    def active_streams(self) -> int:
+        return len(self._streams) + len(self._opens)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def open_stream(self, target: Optional[str] = None) -> socket.socket:
+        """Open a stream to target (None: the node's default) and return the local end; thread-safe
+
+        Reads and writes on the returned socket travel over the tunnel.
+        """
+        payload = encode_target(target)
+        local, remote = socket.socketpair()
+        local.setblocking(False)
+        with self._lock:
+            if self.closed:
+                local.close()
+                remote.close()
+                raise OSError(errno.ECONNRESET, "Tunnel session is closed")
+            stream_id = self._next_id
+            self._next_id += 1
+            self._opens.append((stream_id, local, payload))
+        self._wake()
+        return remote
+
+    def stop(self):
+        self.closed = True
+        self._wake()
+
+    def stats(self) -> Dict:
+        return {
+            'active_streams': self.active_streams,
+            'total_streams': self.total_streams,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'tunnel_buffered': len(self._outbuf)
+        }
+
+    def _wake(self):
+        try:
+            self._wakeup_w.send(b'\0')
+        except OSError:
+            pass
+
+    def run(self, early: bytes = b''):
+        """Run the session loop until the tunnel closes or stop() is called"""
+        self.tunnel.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, _WAKEUP)
+        self._update_tunnel()
+        try:
+            if early:
+                self._dispatch(early)
+            while not self.closed:
+                for key, mask in self._selector.select(timeout=1.0):
+                    if key.data is _WAKEUP:
+                        self._drain_wakeup()
+                    elif key.data is _TUNNEL:
+                        if mask & selectors.EVENT_READ:
+                            self._read_tunnel()
+                        if mask & selectors.EVENT_WRITE and not self.closed:
+                            self._write_tunnel()
+                    else:
+                        self._service(key.data, mask)
+                if not self.closed:
+                    self._flush()
+        except (OSError, MuxError) as e:
+            if not self.closed:
+                logger.warning("Tunnel session failed: %s", e, extra={'event': 'mux_session_failed'})
+        except Exception as e:
+            logger.error("Tunnel session error: %s", e, extra={'event': 'mux_session_failed'})
+        finally:
+            self._shutdown()
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_r.recv(512):
+                pass
+        except OSError:
+            pass
+        while self._attached:
+            stream_id, result = self._attached.popleft()
+            self._attach(stream_id, result)
+        while self._opens:
+            stream_id, sock, payload = self._opens.popleft()
+            self._add_stream(stream_id, sock)
+            self._control.append(FRAME_HEADER.pack(OPEN, stream_id, len(payload)) + payload)
+            self._grant_window(stream_id)
+
+    def _attach(self, stream_id: int, result):
+        """Give a stream opened with a Future its socket, or reset it when opening failed"""
+        stream = self._streams.get(stream_id)
+        if isinstance(result, Exception):
+            logger.warning("Stream %d could not be opened: %s", stream_id, result,
+                           extra={'event': 'mux_open_failed'})
+            if stream:
+                self._close_stream(stream, reset=True)
+            return
+        if stream is None or stream.sock is not None:
+            result.close()  # reset while the socket was on its way
+            return
+        stream.sock = result
+        self._update_stream(stream)
+
+    def _deferred(self, stream_id: int, future: Future):
+        """Done callback of an on_open Future; hands the result to the loop thread"""
+        try:
+            result = future.result()
+        except Exception as e:
+            result = e
+        with self._lock:
+            if self.closed:
+                if not isinstance(result, Exception):
+                    result.close()
+                return
+            self._attached.append((stream_id, result))
+        self._wake()
+
+    def _add_stream(self, stream_id: int, sock: Optional[socket.socket], connecting: bool = False) -> _Stream:
+        stream = _Stream(stream_id, sock, INITIAL_WINDOW, connecting)
+        self._streams[stream_id] = stream
+        self.total_streams += 1
+        self._update_stream(stream)
+        return stream
+
+    def _grant_window(self, stream_id: int):
+        """Raise the peer's credit for a new stream from INITIAL_WINDOW to our window"""
+        if self.window > INITIAL_WINDOW:
+            self._control.append(FRAME_HEADER.pack(WINDOW, stream_id, _WINDOW_PAYLOAD.size)
+                                 + _WINDOW_PAYLOAD.pack(self.window - INITIAL_WINDOW))
+
+    # -- tunnel side --
+
+    def _update_tunnel(self):
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if self._outbuf else 0)
+        if events == self._tunnel_events:
+            return
+        if self._tunnel_events:
+            self._selector.modify(self.tunnel, events, _TUNNEL)
+        else:
+            self._selector.register(self.tunnel, events, _TUNNEL)
+        self._tunnel_events = events
+
+    def _read_tunnel(self):
+        try:
+            n = self.tunnel.recv_into(self._buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        if not n:
+            logger.debug("Tunnel session closed by peer")
+            self.closed = True
+            return
+        self.bytes_received += n
+        data = self.stage.decode(self._view[:n]) if self.stage else bytes(self._view[:n])
+        if data:
+            self._dispatch(data)
+
+    def _write_tunnel(self):
+        try:
+            sent = self.tunnel.send(self._outbuf)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        del self._outbuf[:sent]
+        self.bytes_sent += sent
+
+    def _flush(self):
+        """Frame control messages and a fair share of stream data while the tunnel has room"""
+        if len(self._outbuf) < self.high_water and (self._control or self._ready):
+            batch = self._control
+            self._control = []
+            size = sum(len(frame) for frame in batch)
+            budget = self.high_water - len(self._outbuf)
+            ready = self._ready
+            while ready and size < budget:
+                stream = ready.popleft()
+                stream.queued = False
+                if stream.id not in self._streams:
+                    continue
+                take = min(len(stream.pending), stream.send_window, self.quantum)
+                if take:
+                    batch.append(FRAME_HEADER.pack(DATA, stream.id, take))
+                    batch.append(bytes(stream.pending[:take]))
+                    del stream.pending[:take]
+                    stream.send_window -= take
+                    size += take + FRAME_HEADER.size
+                if stream.pending and stream.send_window:
+                    # Back of the queue: everyone else gets a slice before this stream's next one
+                    stream.queued = True
+                    ready.append(stream)
+                elif stream.eof and not stream.pending and not stream.fin_sent:
+                    batch.append(FRAME_HEADER.pack(FIN, stream.id, 0))
+                    stream.fin_sent = True
+                    size += FRAME_HEADER.size
+                    self._maybe_finish(stream)
+                    if stream.id not in self._streams:
+                        continue
+                self._update_stream(stream)
+            if batch:
+                data = b''.join(batch)
+                self._outbuf += self.stage.encode(data) if self.stage else data
+        if self._outbuf:
+            self._write_tunnel()
+        self._update_tunnel()
+
+    def _dispatch(self, data):
+        buffer = self._inbuf
+        buffer += data
+        offset = 0
+        header_size = FRAME_HEADER.size
+        while len(buffer) - offset >= header_size:
+            kind, stream_id, length = FRAME_HEADER.unpack_from(buffer, offset)
+            end = offset + header_size + length
+            if end > len(buffer):
+                break
+            payload = bytes(buffer[offset + header_size:end])
+            offset = end
+            self._on_frame(kind, stream_id, payload)
+        del buffer[:offset]
+
+    def _on_frame(self, kind: int, stream_id: int, payload: bytes):
+        if kind == OPEN:
+            if self.on_open is None or stream_id in self._streams:
+                raise MuxError(f"Unexpected OPEN for stream {stream_id}")
+            try:
+                sock = self.on_open(payload.decode('idna') or None)
+            except Exception as e:
+                logger.warning("Stream %d could not be opened: %s", stream_id, e,
+                               extra={'event': 'mux_open_failed'})
+                self._control.append(FRAME_HEADER.pack(RST, stream_id, 0))
+                return
+            if isinstance(sock, Future):
+                self._add_stream(stream_id, None, connecting=True)
+                sock.add_done_callback(lambda future: self._deferred(stream_id, future))
+            else:
+                self._add_stream(stream_id, sock, connecting=True)
+            self._grant_window(stream_id)
+            return
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            return  # frames still in flight for a stream we already reset
+        if kind == DATA:
+            if len(payload) > self.window - len(stream.outbuf):
+                raise MuxError(f"Peer overran the window of stream {stream_id}")
+            stream.outbuf += payload
+            self._write_stream(stream)
+        elif kind == WINDOW:
+            stream.send_window += _WINDOW_PAYLOAD.unpack(payload)[0]
+            self._schedule(stream)
+        elif kind == FIN:
+            stream.fin_received = True
+            self._write_stream(stream)
+        elif kind == RST:
+            self._close_stream(stream, reset=False)
+            return
+        else:
+            raise MuxError(f"Unknown frame type {kind}")
+        if stream.id in self._streams:
+            self._update_stream(stream)
+
+    # -- stream side --
+
+    def _update_stream(self, stream: _Stream):
+        if stream.sock is None:
+            return  # still waiting for on_open's Future
+        events = 0
+        if stream.connecting or stream.outbuf:
+            events |= selectors.EVENT_WRITE
+        if (not stream.connecting and not stream.eof and len(stream.pending) < self.quantum
+                and stream.send_window > len(stream.pending)):
+            events |= selectors.EVENT_READ
+        if events == stream.events:
+            return
+        if not stream.events:
+            self._selector.register(stream.sock, events, stream)
+        elif not events:
+            self._selector.unregister(stream.sock)
+        else:
+            self._selector.modify(stream.sock, events, stream)
+        stream.events = events
+
+    def _schedule(self, stream: _Stream):
+        if not stream.queued and ((stream.pending and stream.send_window)
+                                  or (stream.eof and not stream.pending and not stream.fin_sent)):
+            stream.queued = True
+            self._ready.append(stream)
+
+    def _service(self, stream: _Stream, mask: int):
+        try:
+            if mask & selectors.EVENT_WRITE:
+                if stream.connecting:
+                    err = stream.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err:
+                        raise OSError(err, "Stream target connect failed")
+                    stream.connecting = False
+                self._write_stream(stream)
+            if mask & selectors.EVENT_READ and stream.id in self._streams:
+                self._read_stream(stream)
+        except OSError as e:
+            if e.errno not in (errno.ECONNRESET, errno.EPIPE):
+                logger.debug("Stream %d failed: %s", stream.id, e)
+            self._close_stream(stream, reset=True)
+            return
+        if stream.id in self._streams:
+            self._update_stream(stream)
+
+    def _read_stream(self, stream: _Stream):
+        room = min(self.quantum - len(stream.pending), stream.send_window - len(stream.pending),
+                   len(self._buffer))
+        try:
+            n = stream.sock.recv_into(self._buffer, room)
+        except (BlockingIOError, InterruptedError):
+            return
+        if not n:
+            stream.eof = True
+        else:
+            stream.pending += self._view[:n]
+        self._schedule(stream)
+
+    def _write_stream(self, stream: _Stream):
+        if stream.outbuf and not stream.connecting:
+            try:
+                sent = stream.sock.send(stream.outbuf)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            del stream.outbuf[:sent]
+            stream.unacked += sent
+            # Return credit in batches rather than per write
+            if stream.unacked >= self.window // 4 or (stream.unacked and not stream.outbuf
+                                                       and stream.unacked >= self.quantum):
+                self._control.append(FRAME_HEADER.pack(WINDOW, stream.id, _WINDOW_PAYLOAD.size)
+                                     + _WINDOW_PAYLOAD.pack(stream.unacked))
+                stream.unacked = 0
+        if stream.fin_received and not stream.outbuf and not stream.shut_wr and not stream.connecting:
+            stream.shut_wr = True
+            try:
+                stream.sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+        self._maybe_finish(stream)
+
+    def _maybe_finish(self, stream: _Stream):
+        if stream.finished:
+            self._close_stream(stream, reset=False)
+
+    def _close_stream(self, stream: _Stream, reset: bool):
+        if self._streams.pop(stream.id, None) is None:
+            return
+        if reset:
+            self._control.append(FRAME_HEADER.pack(RST, stream.id, 0))
+        if stream.events:
+            self._selector.unregister(stream.sock)
+            stream.events = 0
+        if stream.sock is not None:
+            stream.sock.close()
+
+    def _shutdown(self):
+        with self._lock:
+            self.closed = True
+            opens, self._opens = list(self._opens), collections.deque()
+            attached, self._attached = list(self._attached), collections.deque()
+        for _, sock, _ in opens:
+            sock.close()
+        for _, result in attached:
+            if not isinstance(result, Exception):
+                result.close()
+        for stream in list(self._streams.values()):
+            self._close_stream(stream, reset=False)
+        self._selector.close()
+        self.tunnel.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+        if self.on_closed:
+            self.on_closed(self)
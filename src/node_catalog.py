@@ -0,0 +1,287 @@
+import csv
+import io
+import json
+import logging
+import os
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+INDEXED_FIELDS = ('country', 'region', 'protocol', 'status')
+
+
+class VPNNode:
+    # protocol 'tunnel' marks a bundled node_server endpoint speaking the framed tunnel protocol
+    __slots__ = ('country', 'host', 'port', 'protocol', 'region', 'latency', 'load', '_status', '_catalog',
+                 '__weakref__')
+
+    def __init__(self, country: str, host: str, port: int, protocol: str = 'tcp', region: Optional[str] = None):
+        self.country = country
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self.region = region
+        self._status = 'unknown'
+        self.latency = 0
+        self.load = 0
+        self._catalog = None
+
+    @property
+    def address(self) -> str:
+        """host:port, which tells apart the many nodes a country can have"""
+        return f"{self.host}:{self.port}"
+
+    @property
+    def status(self) -> str:
+        return self._status
+
+    @status.setter
+    def status(self, value: str):
+        if value == self._status:
+            return
+        previous, self._status = self._status, value
+        if self._catalog is not None:
+            self._catalog._status_changed(self, previous)
+
+
+def _node_key(country: str, host: str, port: int, protocol: str) -> Tuple:
+    return country.lower(), host.lower(), port, protocol
+
+
+class NodeCatalog:
+    """VPN nodes indexed by country, region, protocol and health, reloadable in place
+
+    Nodes are loaded from a JSON or CSV file or an http(s) URL. A reload is applied
+    as a diff: unchanged nodes keep their object (and with it their pool, metrics
+    and load), removed ones leave every index, and on_change(added, removed) is
+    called. Lookups are dictionary hits; nodes() and listing() return snapshots
+    rebuilt only when the catalog changes.
+
+    JSON is a list of objects (or {"nodes": [...]}) and CSV has a header row, both
+    with country, host, port and optional protocol and region.
+    """
+
+    def __init__(self, on_change: Optional[Callable[[List[VPNNode], List[VPNNode]], None]] = None,
+                 timeout: float = 10.0):
+        self.on_change = on_change
+        self.timeout = timeout
+        self.source = None
+        self.reloads = 0
+        self.skipped_entries = 0
+        self._nodes: Dict[Tuple, VPNNode] = {}
+        self._indexes: Dict[str, Dict[str, Dict[VPNNode, None]]] = {field: {} for field in INDEXED_FIELDS}
+        self._snapshot: List[VPNNode] = []
+        self._listing: List[Dict] = []
+        self._fingerprint = None  # mtime/size or ETag of the last loaded source
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def nodes(self) -> List[VPNNode]:
+        """Every node in catalog order; the list is shared, do not modify it"""
+        return self._snapshot
+
+    def listing(self) -> List[Dict]:
+        """Plain-dict view of the catalog for the control UI"""
+        return self._listing
+
+    def first(self, country: str) -> Optional[VPNNode]:
+        """First node in a country (case-insensitive)"""
+        with self._lock:
+            nodes = self._indexes['country'].get(country.lower())
+            return next(iter(nodes), None) if nodes else None
+
+    def get(self, address: str) -> Optional[VPNNode]:
+        """The node at host:port, whichever country it is listed under"""
+        return next((node for node in self._snapshot if node.address == address), None)
+
+    def find(self, country: Optional[str] = None, region: Optional[str] = None,
+             protocol: Optional[str] = None, status: Optional[str] = None) -> List[VPNNode]:
+        """Nodes matching every given field, starting from the smallest index
+
+        Under the lock: the prober moves nodes between status buckets from its own thread.
+        """
+        wanted = {'country': country, 'region': region, 'protocol': protocol, 'status': status}
+        with self._lock:
+            buckets = []
+            for field, value in wanted.items():
+                if value is None:
+                    continue
+                key = value.lower() if field in ('country', 'region') else value
+                bucket = self._indexes[field].get(key)
+                if not bucket:
+                    return []
+                buckets.append(bucket)
+            if not buckets:
+                return list(self._snapshot)
+            buckets.sort(key=len)
+            smallest, rest = buckets[0], buckets[1:]
+            return [node for node in smallest if all(node in bucket for bucket in rest)]
+
+    def counts(self, field: str) -> Dict[str, int]:
+        """Number of nodes per value of an indexed field"""
+        with self._lock:
+            return {value: len(nodes) for value, nodes in self._indexes[field].items()}
+
+    def replace(self, nodes: Iterable[VPNNode]) -> Dict[str, int]:
+        """Make the catalog hold exactly these nodes, keeping existing objects for known ones"""
+        nodes = list(nodes)
+        entries = [(n.country, n.host, n.port, n.protocol, n.region) for n in nodes]
+        return self._apply(entries, {_node_key(*entry[:4]): node for entry, node in zip(entries, nodes)})
+
+    def load(self, source: str, force: bool = False) -> Optional[Dict[str, int]]:
+        """Load or reload from a file path or URL; None when the source has not changed"""
+        text, fingerprint, kind = self._read(source, None if force or source != self.source else self._fingerprint)
+        if text is None:
+            return None
+        entries = self._parse(text, kind)
+        with self._lock:
+            diff = self._apply(entries)
+            self.source = source
+            self._fingerprint = fingerprint
+        logger.info("Node catalog loaded from %s: %d nodes (+%d -%d ~%d)", source, len(self._nodes),
+                    diff['added'], diff['removed'], diff['updated'], extra={'event': 'catalog_loaded'})
+        return diff
+
+    def watch(self, interval: float = 60.0):
+        """Reload from the current source every interval seconds when it changed"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch_loop, args=(interval,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> Dict:
+        return {
+            'source': self.source,
+            'nodes': len(self._nodes),
+            'reloads': self.reloads,
+            'skipped_entries': self.skipped_entries,
+            'by_protocol': self.counts('protocol'),
+            'by_status': self.counts('status')
+        }
+
+    def _watch_loop(self, interval: float):
+        while not self._stop.wait(interval):
+            if not self.source:
+                continue
+            try:
+                self.load(self.source)
+            except Exception as e:
+                logger.error("Node catalog reload from %s failed: %s", self.source, e,
+                             extra={'event': 'catalog_reload_failed'})
+
+    def _read(self, source: str, known) -> Tuple[Optional[str], object, str]:
+        """(text or None if unchanged, fingerprint, 'json' or 'csv')"""
+        if source.startswith(('http://', 'https://')):
+            import requests
+            headers = {'If-None-Match': known} if known else {}
+            response = requests.get(source, headers=headers, timeout=self.timeout)
+            if response.status_code == 304:
+                return None, known, ''
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type', '')
+            kind = 'csv' if 'csv' in content_type or source.lower().endswith('.csv') else 'json'
+            return response.text, response.headers.get('ETag'), kind
+        stat = os.stat(source)
+        fingerprint = (stat.st_mtime_ns, stat.st_size)
+        if fingerprint == known:
+            return None, known, ''
+        with open(source, encoding='utf-8', newline='') as f:
+            text = f.read()
+        return text, fingerprint, 'csv' if source.lower().endswith('.csv') else 'json'
+
+    def _parse(self, text: str, kind: str) -> List[Tuple]:
+        if kind == 'csv':
+            rows = list(csv.DictReader(io.StringIO(text)))
+        else:
+            rows = json.loads(text)
+            if isinstance(rows, dict):
+                rows = rows.get('nodes', [])
+        entries = []
+        skipped = 0
+        for row in rows:
+            try:
+                port = int(row['port'])
+                if not row['country'] or not row['host'] or not 0 < port < 65536:
+                    raise ValueError("empty country/host or port out of range")
+                entries.append((row['country'].strip(), row['host'].strip(), port,
+                                (row.get('protocol') or 'tcp').strip(), (row.get('region') or '').strip() or None))
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                skipped += 1
+                logger.debug("Skipping node catalog entry %r: %s", row, e)
+        if skipped:
+            logger.warning("Skipped %d invalid node catalog entries", skipped, extra={'event': 'catalog_invalid'})
+        self.skipped_entries = skipped
+        return entries
+
+    def _apply(self, entries: List[Tuple], fresh: Optional[Dict[Tuple, VPNNode]] = None) -> Dict[str, int]:
+        with self._lock:
+            current = self._nodes
+            nodes = {}
+            added, updated = [], 0
+            for country, host, port, protocol, region in entries:
+                key = _node_key(country, host, port, protocol)
+                if key in nodes:
+                    continue  # duplicate entry
+                node = current.get(key)
+                if node is None:
+                    node = fresh[key] if fresh else VPNNode(country, host, port, protocol, region)
+                    added.append(node)
+                elif node.region != region or node.country != country:
+                    self._unindex(node)
+                    node.region, node.country = region, country
+                    self._index(node)
+                    updated += 1
+                nodes[key] = node
+            removed = [node for key, node in current.items() if key not in nodes]
+            for node in removed:
+                self._unindex(node)
+                node._catalog = None
+            for node in added:
+                node._catalog = self
+                self._index(node)
+            self._nodes = nodes
+            self._snapshot = list(nodes.values())
+            self._listing = [{'country': n.country, 'host': n.host, 'port': n.port, 'protocol': n.protocol,
+                              'region': n.region} for n in self._snapshot]
+            self.reloads += 1
+        if (added or removed) and self.on_change:
+            self.on_change(added, removed)
+        return {'added': len(added), 'removed': len(removed), 'updated': updated}
+
+    def _index_keys(self, node: VPNNode):
+        yield 'country', node.country.lower()
+        if node.region:
+            yield 'region', node.region.lower()
+        yield 'protocol', node.protocol
+        yield 'status', node.status
+
+    def _index(self, node: VPNNode):
+        for field, value in self._index_keys(node):
+            self._indexes[field].setdefault(value, {})[node] = None
+
+    def _unindex(self, node: VPNNode):
+        for field, value in self._index_keys(node):
+            bucket = self._indexes[field].get(value)
+            if bucket is not None:
+                bucket.pop(node, None)
+                if not bucket:
+                    del self._indexes[field][value]
+
+    def _status_changed(self, node: VPNNode, previous: str):
+        with self._lock:
+            statuses = self._indexes['status']
+            bucket = statuses.get(previous)
+            if bucket is not None:
+                bucket.pop(node, None)
+                if not bucket:
+                    del statuses[previous]
+            statuses.setdefault(node.status, {})[node] = None
@@ -0,0 +1,143 @@
+import collections
+import logging
+import socket
+import threading
+import time
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamPool:
+    """Pre-established TCP connections to one VPNNode, kept warm by a background thread"""
+
+    def __init__(self, node, min_idle: int = 4, max_idle: int = 16,
+                 idle_timeout: float = 30.0, connect_timeout: float = 5.0,
+                 resolve: Optional[Callable[[str], List[str]]] = None):
+        self.node = node
+        self.resolve = resolve
+        self.min_idle = min_idle
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        # Grows toward max_idle on misses and decays back to min_idle when warm sockets go unused
+        self._target = min_idle
+        self._idle = collections.deque()  # (socket, connected_at), newest on the right
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """Start background replenishment"""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._replenish_loop, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stop replenishing and close every idle connection"""
+        self._running = False
+        self._wake.set()
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for sock, _ in idle:
+            sock.close()
+
+    @property
+    def idle_count(self) -> int:
+        with self._lock:
+            return len(self._idle)
+
+    def acquire(self) -> Optional[socket.socket]:
+        """Hand out a validated idle connection, or None if the pool is empty"""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    self.misses += 1
+                    self._target = min(self.max_idle, self._target + 1)
+                    self._wake.set()
+                    return None
+                sock, _ = self._idle.pop()
+            healthy = self._is_healthy(sock)
+            with self._lock:
+                if healthy:
+                    self.hits += 1
+                    refill = len(self._idle) < self._target
+                else:
+                    self.evicted += 1
+            if healthy:
+                if refill:
+                    self._wake.set()
+                return sock
+            sock.close()
+
+    def connect(self) -> socket.socket:
+        """Open a fresh blocking connection to the node"""
+        host = self.resolve(self.node.host)[0] if self.resolve else self.node.host
+        sock = socket.create_connection((host, self.node.port), timeout=self.connect_timeout)
+        sock.settimeout(None)
+        return sock
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'idle': len(self._idle),
+                'target': self._target,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evicted': self.evicted
+            }
+
+    @staticmethod
+    def _is_healthy(sock: socket.socket) -> bool:
+        """A pooled socket is usable if the peer has not closed or reset it while idle"""
+        try:
+            sock.setblocking(False)
+            try:
+                return sock.recv(1, socket.MSG_PEEK) != b''
+            except (BlockingIOError, InterruptedError):
+                return True
+            finally:
+                sock.setblocking(True)
+        except OSError:
+            return False
+
+    def _evict_stale(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        stale = []
+        with self._lock:
+            while self._idle and self._idle[0][1] < cutoff:
+                stale.append(self._idle.popleft()[0])
+            if stale:
+                self.evicted += len(stale)
+                self._target = max(self.min_idle, self._target - len(stale))
+        for sock in stale:
+            sock.close()
+
+    def _replenish_loop(self):
+        while self._running:
+            self._wake.clear()
+            self._evict_stale()
+            while self._running:
+                with self._lock:
+                    if len(self._idle) >= self._target:
+                        break
+                try:
+                    sock = self.connect()
+                except OSError as e:
+                    logger.warning("Upstream pool for %s:%s could not connect: %s", self.node.host, self.node.port, e,
+                                   extra={'event': 'pool_connect_failed'})
+                    break
+                with self._lock:
+                    if len(self._idle) < self.max_idle and self._running:
+                        self._idle.append((sock, time.monotonic()))
+                        sock = None
+                if sock:
+                    sock.close()
+            self._wake.wait(timeout=min(self.idle_timeout / 2, 5.0))
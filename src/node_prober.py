@@ -0,0 +1,189 @@
+import collections
+import errno
+import logging
+import math
+import selectors
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from relay import open_nonblocking
+
+logger = logging.getLogger(__name__)
+
+# Failures to open a probe socket that say nothing about the node
+LOCAL_RESOURCE_ERRORS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+
+
+class LatencyStats:
+    """EWMA and a bounded sample window of TCP connect RTTs for one node address"""
+    __slots__ = ('ewma', 'samples', 'probes', 'failures', 'consecutive_failures', 'last_probe')
+
+    def __init__(self, history: int):
+        self.ewma = None
+        self.samples = collections.deque(maxlen=history)
+        self.probes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_probe = None
+
+    def record(self, rtt_ms: Optional[float], alpha: float):
+        self.probes += 1
+        self.last_probe = time.time()
+        if rtt_ms is None:
+            self.failures += 1
+            self.consecutive_failures += 1
+            return
+        self.consecutive_failures = 0
+        self.samples.append(rtt_ms)
+        self.ewma = rtt_ms if self.ewma is None else alpha * rtt_ms + (1 - alpha) * self.ewma
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+    def to_dict(self) -> Dict:
+        return {
+            'ewma_ms': self.ewma,
+            'p50_ms': self.percentile(50),
+            'p90_ms': self.percentile(90),
+            'probes': self.probes,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures
+        }
+
+
+class NodeProber:
+    """Measures connect RTT to every node concurrently and scores nodes for auto-selection"""
+
+    def __init__(self, nodes: Callable[[], List], interval: float = 30.0, timeout: float = 2.0,
+                 alpha: float = 0.3, history: int = 32, load_penalty_ms: float = 5.0, concurrency: int = 256):
+        self.nodes = nodes
+        self.interval = interval
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.alpha = alpha
+        self.history = history
+        self.load_penalty_ms = load_penalty_ms
+        self.stats: Dict[Tuple[str, int], LatencyStats] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Probe in the background every interval seconds"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._probe_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _probe_loop(self):
+        while not self._stop.is_set():
+            try:
+                self.probe_all()
+            except Exception as e:
+                logger.error("Node probe failed: %s", e, extra={'event': 'probe_failed'})
+            self._stop.wait(self.interval)
+
+    def probe_all(self) -> Dict[Tuple[str, int], Optional[float]]:
+        """Connect to every distinct node address, at most concurrency at a time
+
+        Each probe gets its own timeout and a finished one makes room for the next,
+        so a catalog of a few hundred addresses completes within about one timeout.
+        Addresses left unprobed because this process ran out of sockets are omitted
+        from the result and keep their previous status.
+        """
+        nodes = list(self.nodes())
+        pending = collections.deque({(node.host, node.port) for node in nodes})
+        results = {}
+        selector = selectors.DefaultSelector()
+        in_flight = collections.deque()  # (deadline, sock), in start order and so in deadline order
+        try:
+            while pending or in_flight:
+                while pending and len(in_flight) < self.concurrency:
+                    address = pending.popleft()
+                    started = time.perf_counter()
+                    try:
+                        sock = open_nonblocking(address)
+                    except OSError as e:
+                        if e.errno in LOCAL_RESOURCE_ERRORS:
+                            # Our fd table is full, not the node's fault: retry once others finish
+                            pending.appendleft(address)
+                            break
+                        results[address] = None
+                        continue
+                    selector.register(sock, selectors.EVENT_WRITE, (address, started))
+                    in_flight.append((started + self.timeout, sock))
+                if not in_flight:
+                    logger.warning("Could not probe %d nodes: out of sockets", len(pending),
+                                   extra={'event': 'probe_skipped'})
+                    break
+                remaining = in_flight[0][0] - time.perf_counter()
+                for key, _ in selector.select(max(0.0, remaining)):
+                    address, started = key.data
+                    rtt_ms = (time.perf_counter() - started) * 1000
+                    sock = key.fileobj
+                    results[address] = None if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) else rtt_ms
+                    selector.unregister(sock)
+                    sock.close()
+                now = time.perf_counter()
+                while in_flight and (in_flight[0][1].fileno() < 0 or in_flight[0][0] <= now):
+                    _, sock = in_flight.popleft()
+                    if sock.fileno() >= 0:
+                        address, _ = selector.get_key(sock).data
+                        results[address] = None  # timed out
+                        selector.unregister(sock)
+                        sock.close()
+                # Finished probes deeper in the queue only leave closed sockets behind
+                in_flight = collections.deque(entry for entry in in_flight if entry[1].fileno() >= 0)
+        finally:
+            for _, sock in in_flight:
+                if sock.fileno() >= 0:
+                    sock.close()
+            selector.close()
+
+        with self._lock:
+            for address, rtt_ms in results.items():
+                stats = self.stats.get(address)
+                if stats is None:
+                    stats = self.stats[address] = LatencyStats(self.history)
+                stats.record(rtt_ms, self.alpha)
+        for node in nodes:
+            stats = self.stats.get((node.host, node.port))
+            if stats is None:
+                continue
+            node.status = 'offline' if stats.consecutive_failures else 'online'
+            if stats.ewma is not None:
+                node.latency = round(stats.ewma, 2)
+        return results
+
+    def get_stats(self, node) -> Optional[LatencyStats]:
+        return self.stats.get((node.host, node.port))
+
+    def score(self, node) -> float:
+        """Lower is better: smoothed RTT plus a jitter term and a per-connection load penalty"""
+        stats = self.get_stats(node)
+        if stats is None or stats.ewma is None or stats.consecutive_failures:
+            return math.inf
+        p90 = stats.percentile(90)
+        jitter = max(0.0, p90 - stats.ewma) if p90 is not None else 0.0
+        return stats.ewma + 0.5 * jitter + node.load * self.load_penalty_ms
+
+    def best_node(self, nodes: List):
+        """Pick the best-scoring reachable node, probing first if nothing has been measured yet
+
+        That first probe_all() runs on the calling thread and takes up to about timeout.
+        """
+        if not any(self.get_stats(node) for node in nodes):
+            self.probe_all()
+        best = min(nodes, key=self.score, default=None)
+        if best is None or math.isinf(self.score(best)):
+            return None
+        return best
@@ -0,0 +1,214 @@
+"""Bundled node-side endpoint for VPNNode(protocol='tunnel')
+
+Accepts framed, optionally compressed and encrypted tunnel connections from
+VPNHandler and relays each one to --forward, or to the host:port the client
+names when --allow-targets is given (split-tunnel mode). Multiplexed tunnels
+carry many streams, each opened to its own target the same way. Give the same --psk as
+VPNHandler.tunnel_psk so only your clients can use the node and the key
+exchange cannot be intercepted; without one, encrypted tunnels are refused.
+
+    python node_server.py --port 9000 --forward 127.0.0.1:8081 --psk secret
+    python node_server.py --port 9000 --allow-targets --require-encryption
+"""
+import argparse
+import ipaddress
+import logging
+import socket
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Union
+
+from compression import CompressionStats, FrameError
+from forwarding import forward_stream
+from mux import MuxSession
+from relay import open_nonblocking
+from tunnel import CIPHERS, PeerClosed, TicketIssuer, TunnelError, accept_tunnel
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_address(value: str) -> tuple:
+    host, _, port = value.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError(f"Expected host:port, got {value!r}")
+    return host.strip('[]'), int(port)
+
+
+class NodeServer:
+    """Thread-per-connection tunnel endpoint"""
+
+    def __init__(self, host: str = '0.0.0.0', port: int = 9000, forward: Optional[str] = None,
+                 allow_targets: bool = False, buffer_size: int = 65536, connect_timeout: float = 5.0,
+                 psk: Optional[str] = None, mtu: int = 1500, require_encryption: bool = False):
+        self.host = host
+        self.port = port
+        self.forward = _parse_address(forward) if forward else None
+        self.allow_targets = allow_targets
+        self.buffer_size = buffer_size
+        self.connect_timeout = connect_timeout
+        self.psk = psk
+        self.mtu = mtu
+        if require_encryption and not psk:
+            raise ValueError("Encrypted tunnels need a pre-shared key (--psk)")
+        self.ciphers = tuple(c for c in CIPHERS if c != 'none') if require_encryption else tuple(CIPHERS)
+        self.tickets = TicketIssuer()
+        self.stats = CompressionStats()
+        self.resumed_handshakes = 0
+        self.active_connections = 0
+        self.mux_sessions = set()
+        # Name lookups for multiplexed streams, kept off the session loops
+        self._lookups = None
+        self._lookups_lock = threading.Lock()
+        self.server = None
+        self._running = False
+        self._thread = None
+
+    def bind(self):
+        """Open the listening socket; port 0 picks a free port"""
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((self.host, self.port))
+        self.server.listen(1024)
+        self.port = self.server.getsockname()[1]
+        self._running = True
+        logger.info("Tunnel node listening on %s:%s", self.host, self.port)
+
+    def start(self):
+        """Bind and serve on a background thread"""
+        self.bind()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def serve_forever(self):
+        while self._running:
+            try:
+                sock, address = self.server.accept()
+            except OSError:
+                if self._running:
+                    logger.exception("Tunnel node accept failed")
+                    continue
+                break
+            threading.Thread(target=self._handle, args=(sock, address), daemon=True).start()
+
+    def stop(self):
+        self._running = False
+        if self.server:
+            self.server.close()
+        for session in list(self.mux_sessions):
+            session.stop()
+        with self._lookups_lock:
+            lookups, self._lookups = self._lookups, None
+        if lookups:
+            lookups.shutdown(wait=False, cancel_futures=True)
+
+    def _target(self, requested: Optional[str]) -> tuple:
+        if requested:
+            if not self.allow_targets:
+                raise TunnelError(f"Client asked for {requested} but targets are not allowed")
+            return _parse_address(requested)
+        if not self.forward:
+            raise TunnelError("No target requested and no --forward configured")
+        return self.forward
+
+    def _handle(self, tunnel: socket.socket, address):
+        upstream = None
+        self.active_connections += 1
+        try:
+            tunnel.settimeout(self.connect_timeout)
+            pipeline, requested, resumed, early, multiplexed = accept_tunnel(
+                tunnel, self.tickets, self.psk, self.stats, self.mtu, self.ciphers)
+            if resumed:
+                self.resumed_handshakes += 1
+            if multiplexed:
+                tunnel.settimeout(None)
+                tunnel.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self._serve_mux(tunnel, pipeline, early)
+                return
+            upstream = socket.create_connection(self._target(requested), timeout=self.connect_timeout)
+            if early:
+                upstream.sendall(early)
+            tunnel.settimeout(None)
+            upstream.settimeout(None)
+            for sock in (tunnel, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            downstream = threading.Thread(target=self._pump, args=(upstream, tunnel, pipeline.encode),
+                                          daemon=True)
+            downstream.start()
+            self._pump(tunnel, upstream, pipeline.decode)
+            downstream.join()
+        except PeerClosed:
+            # Health checks such as NodeProber connect and close without a handshake
+            logger.debug("Connection from %s closed before the handshake", address)
+        except Exception as e:
+            logger.warning("Tunnel from %s failed: %s", address, e)
+        finally:
+            tunnel.close()
+            if upstream:
+                upstream.close()
+            self.active_connections -= 1
+
+    def _serve_mux(self, tunnel: socket.socket, pipeline, early: bytes):
+        session = MuxSession(tunnel, pipeline, on_open=self._open_stream, buffer_size=self.buffer_size)
+        self.mux_sessions.add(session)
+        try:
+            session.run(early)
+        finally:
+            self.mux_sessions.discard(session)
+
+    def _open_stream(self, requested: Optional[str]) -> Union[socket.socket, Future]:
+        """Connecting socket for one stream of a multiplexed tunnel
+
+        Runs on the session loop, so a host name is looked up on a worker thread and
+        the session gets a Future of the socket instead.
+        """
+        host, port = self._target(requested)
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            with self._lookups_lock:
+                if self._lookups is None:
+                    self._lookups = ThreadPoolExecutor(8, thread_name_prefix='node-lookup')
+                return self._lookups.submit(self._connect_stream, host, port)
+        return self._connect_stream(host, port)
+
+    @staticmethod
+    def _connect_stream(host: str, port: int) -> socket.socket:
+        sock = open_nonblocking((socket.gethostbyname(host), port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _pump(self, source: socket.socket, destination: socket.socket, transform):
+        try:
+            forward_stream(source, destination, self.buffer_size, running=lambda: self._running,
+                           transform=transform)
+            destination.shutdown(socket.SHUT_WR)
+        except (OSError, FrameError, TunnelError) as e:
+            logger.debug("Tunnel pump stopped: %s", e)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--forward', help="host:port every tunnel is relayed to")
+    parser.add_argument('--allow-targets', action='store_true',
+                        help="Honour the target host:port sent by split-tunnel clients")
+    parser.add_argument('--psk', help="Pre-shared key mixed into every tunnel key derivation")
+    parser.add_argument('--mtu', type=int, default=1500, help="Encrypted records are sized to fit one packet")
+    parser.add_argument('--require-encryption', action='store_true')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+    server = NodeServer(args.host, args.port, args.forward, args.allow_targets, psk=args.psk, mtu=args.mtu,
+                        require_encryption=args.require_encryption)
+    server.bind()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+import ipaddress
+import socket
+import struct
+from typing import Tuple
+
+SOCKS_VERSION = 5
+CMD_CONNECT = 1
+CMD_UDP_ASSOCIATE = 3
+
+# SOCKS5 reply codes
+REP_SUCCEEDED = 0
+REP_GENERAL_FAILURE = 1
+REP_NOT_ALLOWED = 2
+REP_HOST_UNREACHABLE = 4
+REP_CONNECTION_REFUSED = 5
+REP_COMMAND_NOT_SUPPORTED = 7
+REP_ADDRESS_NOT_SUPPORTED = 8
+
+_HTTP_STATUS = {
+    REP_SUCCEEDED: b'200 Connection Established',
+    REP_NOT_ALLOWED: b'403 Forbidden',
+    REP_HOST_UNREACHABLE: b'502 Bad Gateway',
+    REP_CONNECTION_REFUSED: b'502 Bad Gateway',
+    REP_COMMAND_NOT_SUPPORTED: b'405 Method Not Allowed',
+}
+
+MAX_HTTP_HEADER = 16384
+
+
+class ProxyProtocolError(Exception):
+    """The client spoke something other than SOCKS5 or an HTTP CONNECT request"""
+
+
+class ProxyRequest:
+    """Destination requested by a SOCKS5 or HTTP CONNECT client"""
+    __slots__ = ('protocol', 'command', 'host', 'port', 'leftover')
+
+    def __init__(self, protocol: str, command: int, host: str, port: int, leftover: bytes = b''):
+        self.protocol = protocol
+        self.command = command
+        self.host = host
+        self.port = port
+        self.leftover = leftover
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ProxyProtocolError("Client closed during proxy handshake")
+        data += chunk
+    return bytes(data)
+
+
+def read_proxy_request(sock: socket.socket) -> ProxyRequest:
+    """Run the server side of the handshake up to the point where a target is known"""
+    first = _recv_exactly(sock, 1)
+    if first[0] == SOCKS_VERSION:
+        return _read_socks5(sock)
+    return _read_http_connect(sock, first)
+
+
+def _read_socks5(sock: socket.socket) -> ProxyRequest:
+    nmethods = _recv_exactly(sock, 1)[0]
+    methods = _recv_exactly(sock, nmethods)
+    if 0 not in methods:
+        sock.sendall(b'\x05\xff')
+        raise ProxyProtocolError("SOCKS5 client offers no supported authentication method")
+    sock.sendall(b'\x05\x00')
+
+    version, command, _, atyp = _recv_exactly(sock, 4)
+    if version != SOCKS_VERSION:
+        raise ProxyProtocolError(f"Bad SOCKS version {version}")
+    if atyp == 1:
+        host = socket.inet_ntop(socket.AF_INET, _recv_exactly(sock, 4))
+    elif atyp == 4:
+        host = socket.inet_ntop(socket.AF_INET6, _recv_exactly(sock, 16))
+    elif atyp == 3:
+        host = _recv_exactly(sock, _recv_exactly(sock, 1)[0]).decode('idna')
+    else:
+        send_reply(sock, ProxyRequest('socks5', command, '', 0), REP_ADDRESS_NOT_SUPPORTED)
+        raise ProxyProtocolError(f"Unsupported SOCKS address type {atyp}")
+    port = struct.unpack('!H', _recv_exactly(sock, 2))[0]
+    return ProxyRequest('socks5', command, host, port)
+
+
+def _read_http_connect(sock: socket.socket, data: bytes) -> ProxyRequest:
+    data = bytearray(data)
+    while b'\r\n\r\n' not in data:
+        if len(data) > MAX_HTTP_HEADER:
+            raise ProxyProtocolError("HTTP proxy request header too large")
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ProxyProtocolError("Client closed during proxy handshake")
+        data += chunk
+    header, leftover = bytes(data).split(b'\r\n\r\n', 1)
+    request_line = header.split(b'\r\n', 1)[0].decode('latin-1')
+    parts = request_line.split()
+    if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+        raise ProxyProtocolError(f"Malformed proxy request line: {request_line[:80]!r}")
+    method, authority, _ = parts
+    if method.upper() != 'CONNECT':
+        sock.sendall(b'HTTP/1.1 405 Method Not Allowed\r\nContent-Length: 0\r\n\r\n')
+        raise ProxyProtocolError(f"Only CONNECT is supported, got {method}")
+    host, _, port = authority.rpartition(':')
+    if not host or not port.isdigit():
+        raise ProxyProtocolError(f"Bad CONNECT authority {authority!r}")
+    return ProxyRequest('http', CMD_CONNECT, host.strip('[]'), int(port), leftover)
+
+
+def send_reply(sock: socket.socket, request: ProxyRequest, code: int, bound=('0.0.0.0', 0)):
+    """Tell the client whether its request succeeded, in the protocol it used"""
+    if request.protocol == 'http':
+        status = _HTTP_STATUS.get(code, b'502 Bad Gateway')
+        sock.sendall(b'HTTP/1.1 ' + status + b'\r\n\r\n')
+        return
+    address = ipaddress.ip_address(bound[0])
+    atyp = b'\x01' if address.version == 4 else b'\x04'
+    sock.sendall(bytes((SOCKS_VERSION, code, 0)) + atyp + address.packed + struct.pack('!H', bound[1]))
+
+
+def pack_udp_header(host: str, port: int) -> bytes:
+    """SOCKS5 UDP request header (RSV, FRAG=0, address) for a datagram to or from host:port"""
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        name = host.encode('idna')
+        return b'\x00\x00\x00\x03' + bytes((len(name),)) + name + struct.pack('!H', port)
+    atyp = b'\x01' if address.version == 4 else b'\x04'
+    return b'\x00\x00\x00' + atyp + address.packed + struct.pack('!H', port)
+
+
+def parse_udp_header(data) -> Tuple[str, int, int]:
+    """(host, port, payload offset) of a SOCKS5 UDP datagram; fragments are not supported"""
+    if len(data) < 4 or data[2] != 0:
+        raise ProxyProtocolError("Short or fragmented SOCKS5 UDP datagram")
+    atyp = data[3]
+    if atyp == 1:
+        end = 8
+    elif atyp == 4:
+        end = 20
+    elif atyp == 3 and len(data) > 4:
+        end = 5 + data[4]
+    else:
+        raise ProxyProtocolError(f"Unsupported SOCKS address type {atyp}")
+    if len(data) < end + 2:
+        raise ProxyProtocolError("Truncated SOCKS5 UDP header")
+    if atyp == 3:
+        host = bytes(data[5:end]).decode('idna')
+    else:
+        host = socket.inet_ntop(socket.AF_INET if atyp == 1 else socket.AF_INET6, data[4:end])
+    return host, (data[end] << 8) | data[end + 1], end + 2
+
+
+def reply_code_for(error: OSError) -> int:
+    """Map a connect failure to the closest SOCKS5 reply code"""
+    if isinstance(error, ConnectionRefusedError):
+        return REP_CONNECTION_REFUSED
+    if isinstance(error, (socket.gaierror, socket.timeout, TimeoutError)):
+        return REP_HOST_UNREACHABLE
+    return REP_GENERAL_FAILURE
@@ -0,0 +1,631 @@
+import collections
+import errno
+import logging
+import selectors
+import socket
+import threading
+import time
+from typing import Callable, Optional, Tuple
+
+from lifecycle import CONNECT
+
+logger = logging.getLogger(__name__)
+
+# connect_ex() results that mean "handshake still in progress" on POSIX and Windows
+CONNECT_PENDING = {
+    errno.EINPROGRESS,
+    errno.EWOULDBLOCK,
+    errno.EALREADY,
+    getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK),
+}
+
+_ACCEPT = object()
+_WAKEUP = object()
+
+
+def open_nonblocking(address) -> socket.socket:
+    """Start a non-blocking TCP connect and return the socket"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    err = sock.connect_ex(address)
+    if err and err not in CONNECT_PENDING:
+        sock.close()
+        raise OSError(err, f"Connect to {address[0]}:{address[1]} failed")
+    return sock
+
+
+class _Endpoint:
+    """One side of a relayed connection and the bytes waiting to be written to it"""
+    __slots__ = ('sock', 'conn', 'peer', 'outbuf', 'eof', 'shut_wr', 'connecting', 'events', 'codec',
+                 'stalled')
+
+    def __init__(self, sock: socket.socket, conn: '_Connection', connecting: bool = False):
+        self.sock = sock
+        self.conn = conn
+        self.peer = None
+        self.outbuf = bytearray()
+        self.eof = False
+        self.shut_wr = False
+        self.connecting = connecting
+        self.events = 0
+        # Rewrites bytes read from this side before they are queued for the peer
+        self.codec = None
+        # Last time a write to this side made progress while outbuf was non-empty
+        self.stalled = None
+
+
+class _Connection:
+    """A client socket paired with its upstream node socket"""
+    __slots__ = ('client', 'upstream', 'address', 'node', 'tried', 'closed', 'stats', 'connect_started',
+                 'opened', 'bytes_up', 'bytes_down', 'stage', 'held', 'last_active', 'half_closed', 'trace')
+
+    def __init__(self, client_sock: socket.socket, upstream_sock: socket.socket, address, node):
+        self.client = _Endpoint(client_sock, self)
+        self.upstream = _Endpoint(upstream_sock, self, connecting=True)
+        self.client.peer = self.upstream
+        self.upstream.peer = self.client
+        self.address = address
+        self.node = node
+        self.tried = [node]
+        self.closed = False
+        self.stats = None
+        self.connect_started = time.perf_counter()
+        self.opened = False
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.stage = None
+        # Client bytes read before a failover to a staged node, encoded once its stage is ready
+        self.held = b''
+        self.last_active = time.monotonic()
+        self.half_closed = None
+        self.trace = None
+
+    @property
+    def finished(self) -> bool:
+        return (self.client.eof and self.upstream.eof
+                and not self.client.outbuf and not self.upstream.outbuf)
+
+
+class _UpstreamConnectFailed(OSError):
+    pass
+
+
+class SelectorRelay:
+    """Single-threaded relay multiplexing every client<->node pair on one selector
+
+    connect_upstream(client_address, exclude) returns a (socket, node) pair with the
+    socket connected or connecting, skipping nodes in exclude. release_upstream(node,
+    failed) is called once per node handed out, when its connection ends or fails.
+
+    With accept_handler set, accepted clients are handed to it (blocking) instead, e.g.
+    to run a proxy handshake on a worker thread; it must finish with adopt() or abandon().
+
+    open_stage(node) may return a tunnel stage (preamble, ready, encode, decode,
+    take_outgoing) for nodes that speak the framed tunnel protocol; client reads wait
+    until such an upstream has connected and finished its handshake.
+
+    Each side buffers at most about buffer_size bytes for its peer before the relay
+    stops reading from it. With a lifecycle manager, connections are swept against
+    its TimeoutPolicy and drain() lets live connections finish before the loop exits.
+    A tracer (diagnostics.ConnectionTracer) gets per-connection timings while enabled.
+    """
+
+    def __init__(self, listener: socket.socket,
+                 connect_upstream: Callable[[tuple, list], Tuple[socket.socket, object]],
+                 max_connections: int = 1024, buffer_size: int = 65536,
+                 on_error: Optional[Callable[[str, Exception], None]] = None,
+                 release_upstream: Optional[Callable[[object, bool], None]] = None,
+                 max_attempts: int = 3, metrics=None,
+                 tune_socket: Optional[Callable[[socket.socket], None]] = None,
+                 accept_handler: Optional[Callable[[socket.socket, tuple], None]] = None,
+                 open_stage: Optional[Callable[[object], object]] = None, lifecycle=None, tracer=None):
+        self.listener = listener
+        self.tracer = tracer
+        self.lifecycle = lifecycle
+        self._now = time.monotonic()
+        self._next_sweep = 0.0
+        self._drain_deadline = None
+        self._retiring = {}  # node -> [deadline, live connections at the last sweep]
+        self._retire_lock = threading.Lock()
+        self._next_retire_check = 0.0
+        self.accept_handler = accept_handler
+        self.open_stage = open_stage
+        self._handoffs = collections.deque()
+        self.metrics = metrics
+        self.tune_socket = tune_socket
+        self.connect_upstream = connect_upstream
+        self.release_upstream = release_upstream
+        self.max_attempts = max_attempts
+        self.max_connections = max_connections
+        self.buffer_size = buffer_size
+        self.on_error = on_error
+        self.active_connections = 0
+        self.total_connections = 0
+        self._running = False
+        self._accepting = False
+        self._connections = set()
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+
+    def run(self):
+        """Run the event loop until stop() is called"""
+        self._running = True
+        self.listener.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, _WAKEUP)
+        self._set_accepting(True)
+        try:
+            while self._running:
+                timeout = 1.0
+                if self._drain_deadline is not None:
+                    timeout = max(0.0, min(timeout, self._drain_deadline - self._now))
+                if self._retiring:
+                    timeout = max(0.0, min(timeout, self._next_retire_check - self._now))
+                events = self._selector.select(timeout=timeout)
+                self._now = time.monotonic()
+                for key, mask in events:
+                    if key.data is _ACCEPT:
+                        self._accept()
+                    elif key.data is _WAKEUP:
+                        self._drain_wakeup()
+                    else:
+                        self._service(key.data, mask)
+                if self.lifecycle and self._now >= self._next_sweep:
+                    self._next_sweep = self._now + self.lifecycle.sweep_interval
+                    self._sweep()
+                if self._retiring and self._now >= self._next_retire_check:
+                    self._sweep_retired()
+                if self._drain_deadline is not None:
+                    if not self.active_connections:
+                        break
+                    if self._now >= self._drain_deadline:
+                        self._abort_remaining()
+                        break
+        except Exception as e:
+            if self._running:
+                self._report("Relay loop error", e)
+        finally:
+            self._shutdown()
+
+    def stop(self):
+        """Ask the event loop to exit; safe to call from any thread"""
+        self._running = False
+        self._wake()
+
+    def drain(self, timeout: float):
+        """Stop accepting and exit once live connections finish or timeout passes; thread-safe"""
+        self._drain_deadline = time.monotonic() + timeout
+        self._wake()
+
+    def retire(self, node, timeout: float):
+        """Let node's live connections finish for up to timeout seconds, then close them; thread-safe
+
+        New connections are unaffected: the caller stops handing node out first.
+        """
+        with self._retire_lock:
+            self._retiring[node] = [time.monotonic() + timeout, None]
+            self._next_retire_check = 0.0
+        self._wake()
+
+    def retiring(self) -> dict:
+        """{node: live connections} for nodes still draining after retire()"""
+        with self._retire_lock:
+            return {node: live for node, (_, live) in self._retiring.items()}
+
+    def _sweep_retired(self):
+        """Close retired nodes' connections past their deadline; scans at most every 0.25 s"""
+        with self._retire_lock:
+            retiring = list(self._retiring.items())
+        self._next_retire_check = min([self._now + 0.25] + [deadline for _, (deadline, _) in retiring
+                                                            if deadline > self._now])
+        for node, entry in retiring:
+            conns = [conn for conn in self._connections if conn.node is node and not conn.closed]
+            entry[1] = len(conns)
+            if conns and self._now < entry[0]:
+                continue
+            if conns:
+                logger.warning("Node %s drain deadline passed, closed %d connections", node.country, len(conns),
+                               extra={'event': 'drain_aborted', 'node': node.country})
+                if self.lifecycle:
+                    self.lifecycle.aborted_on_drain += len(conns)
+                for conn in conns:
+                    self._close(conn)
+            else:
+                logger.info("Node %s drained", node.country, extra={'event': 'node_drained', 'node': node.country})
+            with self._retire_lock:
+                if self._retiring.get(node) is entry:
+                    del self._retiring[node]
+
+    def _sweep(self):
+        """Close or retry connections that passed a deadline of the lifecycle policy"""
+        policy = self.lifecycle.policy
+        now = self._now
+        for conn in list(self._connections):
+            if conn.closed:
+                continue
+            if conn.upstream.connecting:
+                if policy.connect and time.perf_counter() - conn.connect_started > policy.connect:
+                    self.lifecycle.record_timeout(CONNECT)
+                    if not self._retry_upstream(conn, OSError(errno.ETIMEDOUT, "Upstream connect timed out")):
+                        self._close(conn)
+                continue
+            stalled = [ep.stalled for ep in (conn.client, conn.upstream) if ep.outbuf and ep.stalled]
+            reason = policy.expired(now, conn.last_active, conn.half_closed, min(stalled) if stalled else None)
+            if reason:
+                self.lifecycle.record_timeout(reason)
+                if conn.stats:
+                    conn.stats.relay_errors.add()
+                self._close(conn)
+
+    def _abort_remaining(self):
+        if self._connections:
+            logger.warning("Drain deadline passed, aborted %d connections", len(self._connections),
+                           extra={'event': 'drain_aborted'})
+            if self.lifecycle:
+                self.lifecycle.aborted_on_drain += len(self._connections)
+        for conn in list(self._connections):
+            self._close(conn)
+
+    def _report(self, error_msg: str, exc: Exception):
+        logger.error("%s: %s", error_msg, exc, extra={'event': 'relay_error'})
+        if self.on_error:
+            self.on_error(error_msg, exc)
+
+    def _set_accepting(self, accepting: bool):
+        """Register or unregister the listener so the backlog absorbs clients above the cap"""
+        if accepting == self._accepting:
+            return
+        if accepting:
+            self._selector.register(self.listener, selectors.EVENT_READ, _ACCEPT)
+        else:
+            self._selector.unregister(self.listener)
+        self._accepting = accepting
+
+    def _wake(self):
+        try:
+            self._wakeup_w.send(b'\0')
+        except OSError:
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_r.recv(512):
+                pass
+        except OSError:
+            pass
+        while self._handoffs:
+            handoff = self._handoffs.popleft()
+            if handoff is None:
+                self._release_slot()
+            else:
+                self._adopt(*handoff)
+        if self._drain_deadline is not None:
+            self._set_accepting(False)
+
+    def adopt(self, client_sock: socket.socket, upstream_sock: socket.socket, address, node,
+              leftover: bytes = b'', stage=None, trace=None):
+        """Take over an already-connected pair from an accept_handler; thread-safe
+
+        A stage's preamble must already have been sent.
+        """
+        handoff = (client_sock, upstream_sock, address, node, leftover, stage, trace)
+        if not self._running:
+            self._discard(handoff)
+            return
+        self._handoffs.append(handoff)
+        self._wake()
+
+    def abandon(self):
+        """Give back the slot of a client the accept_handler gave up on; thread-safe"""
+        self._handoffs.append(None)
+        self._wake()
+
+    def _adopt(self, client_sock, upstream_sock, address, node, leftover, stage, trace):
+        client_sock.setblocking(False)
+        upstream_sock.setblocking(False)
+        conn = _Connection(client_sock, upstream_sock, address, node)
+        conn.trace = trace
+        conn.upstream.connecting = False
+        self._attach_stage(conn, stage)
+        if leftover:
+            conn.upstream.outbuf += stage.encode(leftover) if stage else leftover
+        conn.opened = True
+        if self.metrics:
+            conn.stats = self.metrics.node(node)
+        self._connections.add(conn)
+        self._update_interest(conn.client)
+        self._update_interest(conn.upstream)
+
+    def _discard(self, handoff):
+        client_sock, upstream_sock, _, node, _, _, _ = handoff
+        client_sock.close()
+        upstream_sock.close()
+        if self.release_upstream:
+            self.release_upstream(node, False)
+        if self.metrics:
+            self.metrics.node(node).connections_closed.add()
+
+    def _attach_stage(self, conn: _Connection, stage):
+        conn.stage = stage
+        conn.client.codec = stage.encode if stage else None
+        conn.upstream.codec = stage.decode if stage else None
+
+    def _open_stage(self, conn: _Connection):
+        """Fresh stage for conn.node, with its preamble queued ahead of any client data"""
+        # Plain upstreams may already hold raw client bytes; staged ones only their preamble
+        pending = conn.held + bytes(conn.upstream.outbuf) if conn.stage is None else conn.held
+        conn.held = b''
+        stage = self.open_stage(conn.node) if self.open_stage else None
+        self._attach_stage(conn, stage)
+        if stage:
+            conn.upstream.outbuf = bytearray(stage.preamble)
+            if pending and stage.ready:
+                conn.upstream.outbuf += stage.encode(pending)
+            else:
+                # Not a byte may follow the hello before the handshake and open message
+                conn.held = pending
+        else:
+            conn.upstream.outbuf = bytearray(pending)
+
+    def _release_slot(self):
+        self.active_connections -= 1
+        if (self._running and self._drain_deadline is None
+                and self.active_connections < self.max_connections):
+            self._set_accepting(True)
+
+    def _accept(self):
+        while self.active_connections < self.max_connections:
+            try:
+                client_sock, address = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            if self.accept_handler:
+                self.active_connections += 1
+                self.total_connections += 1
+                if self.tune_socket:
+                    self.tune_socket(client_sock)
+                client_sock.setblocking(True)
+                try:
+                    self.accept_handler(client_sock, address)
+                except Exception as e:
+                    client_sock.close()
+                    self._release_slot()
+                    self._report("Proxy connection error", e)
+                continue
+            client_sock.setblocking(False)
+            trace = self.tracer.begin(address) if self.tracer else None
+            try:
+                upstream_sock, node = self.connect_upstream(address, [])
+            except Exception as e:
+                client_sock.close()
+                self._report("Proxy connection error", e)
+                continue
+            conn = _Connection(client_sock, upstream_sock, address, node)
+            conn.trace = trace
+            try:
+                self._open_stage(conn)
+            except Exception as e:
+                # e.g. an encrypted tunnel node without a pre-shared key
+                client_sock.close()
+                upstream_sock.close()
+                if self.release_upstream:
+                    self.release_upstream(node, True)
+                self._report("Proxy connection error", e)
+                continue
+            if self.tune_socket:
+                self.tune_socket(client_sock)
+                self.tune_socket(upstream_sock)
+            if self.metrics:
+                conn.stats = self.metrics.node(node)
+            self._connections.add(conn)
+            self.active_connections += 1
+            self.total_connections += 1
+            logger.debug("New connection from %s", address, extra={'event': 'connection_accepted'})
+            self._update_interest(conn.client)
+            self._update_interest(conn.upstream)
+        self._set_accepting(False)
+
+    def _update_interest(self, ep: _Endpoint):
+        events = 0
+        if ep.connecting or ep.outbuf:
+            events |= selectors.EVENT_WRITE
+        stage = ep.conn.stage
+        if (not ep.connecting and not ep.eof and len(ep.peer.outbuf) < self.buffer_size
+                and not (stage and ep is ep.conn.client and (ep.peer.connecting or not stage.ready))):
+            events |= selectors.EVENT_READ
+        if events == ep.events:
+            return
+        if not ep.events:
+            self._selector.register(ep.sock, events, ep)
+        elif not events:
+            self._selector.unregister(ep.sock)
+        else:
+            self._selector.modify(ep.sock, events, ep)
+        ep.events = events
+
+    def _service(self, ep: _Endpoint, mask: int):
+        conn = ep.conn
+        try:
+            if mask & selectors.EVENT_WRITE:
+                self._on_writable(ep)
+            if mask & selectors.EVENT_READ and not conn.closed:
+                self._on_readable(ep)
+        except _UpstreamConnectFailed as e:
+            if not self._retry_upstream(conn, e):
+                self._close(conn)
+            return
+        except OSError as e:
+            if e.errno not in (errno.ECONNRESET, errno.EPIPE):
+                logger.warning("Relay connection %s failed: %s", conn.address, e,
+                               extra={'event': 'relay_connection_failed'})
+            if conn.stats:
+                conn.stats.relay_errors.add()
+            self._close(conn)
+            return
+        except Exception as e:
+            # e.g. a corrupt tunnel frame: drop this connection, keep the loop alive
+            logger.warning("Relay connection %s failed: %s", conn.address, e,
+                           extra={'event': 'relay_connection_failed'})
+            if conn.stats:
+                conn.stats.relay_errors.add()
+            self._close(conn)
+            return
+        if conn.closed:
+            return
+        if conn.finished:
+            self._close(conn)
+            return
+        self._update_interest(ep)
+        self._update_interest(ep.peer)
+
+    def _on_writable(self, ep: _Endpoint):
+        if ep.connecting:
+            err = ep.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise _UpstreamConnectFailed(err, "Upstream connect failed")
+            ep.connecting = False
+            conn = ep.conn
+            conn.opened = True
+            if conn.stats:
+                conn.stats.connections_opened.add()
+                conn.stats.connect_latency.observe((time.perf_counter() - conn.connect_started) * 1000)
+            if conn.trace:
+                conn.trace.connected = time.perf_counter()
+        if ep.outbuf:
+            try:
+                sent = ep.sock.send(ep.outbuf)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            del ep.outbuf[:sent]
+            if sent:
+                ep.conn.last_active = self._now
+                ep.stalled = self._now if ep.outbuf else None
+        self._propagate_eof(ep)
+
+    def _on_readable(self, ep: _Endpoint):
+        peer = ep.peer
+        n = ep.sock.recv_into(self._buffer)
+        conn = ep.conn
+        if not n:
+            ep.eof = True
+            if conn.half_closed is None:
+                conn.half_closed = self._now
+            self._propagate_eof(peer)
+            return
+        conn.last_active = self._now
+        if ep is conn.client:
+            conn.bytes_up += n
+            if conn.stats:
+                conn.stats.bytes_out.add(n)
+        else:
+            conn.bytes_down += n
+            if conn.stats:
+                conn.stats.bytes_in.add(n)
+            if conn.trace and conn.trace.first_byte is None:
+                conn.trace.first_byte = time.perf_counter()
+        data = self._view[:n]
+        if ep.codec:
+            # One recv drains every small write queued in the kernel, so they share a frame
+            data = ep.codec(data)
+            if ep is conn.upstream:
+                # Handshake replies can leave the stage with its own bytes for the node
+                outgoing = conn.stage.take_outgoing()
+                if outgoing:
+                    ep.outbuf += outgoing
+                if conn.held and conn.stage.ready:
+                    ep.outbuf += conn.stage.encode(conn.held)
+                    conn.held = b''
+            n = len(data)
+            if not n:
+                return
+        sent = 0
+        if not peer.outbuf and not peer.connecting:
+            try:
+                sent = peer.sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+        if sent < n:
+            if not peer.outbuf:
+                peer.stalled = self._now
+            peer.outbuf += data[sent:]
+
+    def _retry_upstream(self, conn: _Connection, error: OSError) -> bool:
+        """Swap a failed upstream connect for the next candidate node; nothing was sent yet"""
+        ep = conn.upstream
+        if ep.events:
+            self._selector.unregister(ep.sock)
+            ep.events = 0
+        ep.sock.close()
+        failed_node, conn.node = conn.node, None
+        if conn.stats:
+            conn.stats.connect_errors.add()
+        if self.release_upstream:
+            self.release_upstream(failed_node, True)
+        if len(conn.tried) >= self.max_attempts:
+            self._report("Proxy connection error", error)
+            return False
+        try:
+            ep.sock, conn.node = self.connect_upstream(conn.address, conn.tried)
+        except Exception as e:
+            self._report("Proxy connection error", e)
+            return False
+        conn.tried.append(conn.node)
+        try:
+            self._open_stage(conn)
+        except Exception as e:
+            self._report("Proxy connection error", e)
+            return False
+        if self.tune_socket:
+            self.tune_socket(ep.sock)
+        conn.connect_started = time.perf_counter()
+        if self.metrics:
+            conn.stats = self.metrics.node(conn.node)
+        ep.connecting = True
+        self._update_interest(ep)
+        self._update_interest(conn.client)
+        return True
+
+    def _propagate_eof(self, ep: _Endpoint):
+        """Half-close ep once its peer hit EOF and everything it sent has been flushed"""
+        if ep.peer.eof and not ep.outbuf and not ep.connecting and not ep.shut_wr:
+            ep.shut_wr = True
+            try:
+                ep.sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def _close(self, conn: _Connection):
+        if conn.closed:
+            return
+        conn.closed = True
+        for ep in (conn.client, conn.upstream):
+            if ep.events:
+                self._selector.unregister(ep.sock)
+                ep.events = 0
+            ep.sock.close()
+        if conn.node is not None and self.release_upstream:
+            self.release_upstream(conn.node, False)
+        if conn.opened and conn.stats:
+            conn.stats.connections_closed.add()
+        if conn.trace:
+            self.tracer.finish(conn.trace, conn.node, conn.bytes_up, conn.bytes_down)
+        logger.debug("Connection %s closed: %d bytes up, %d bytes down",
+                     conn.address, conn.bytes_up, conn.bytes_down)
+        self._connections.discard(conn)
+        self._release_slot()
+
+    def _shutdown(self):
+        while self._handoffs:
+            handoff = self._handoffs.popleft()
+            if handoff is not None:
+                self._discard(handoff)
+        for conn in list(self._connections):
+            self._close(conn)
+        if self._accepting:
+            self._set_accepting(False)
+        self._selector.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
@@ -0,0 +1,174 @@
+import collections
+import ipaddress
+import logging
+import threading
+from typing import Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+DIRECT = 'direct'
+VPN = 'vpn'
+ACTIONS = (DIRECT, VPN)
+
+
+class PrefixTable:
+    """Longest-prefix-match over IPv4/IPv6 CIDRs
+
+    Networks are stored in one hash table per prefix length, keyed by the masked
+    network integer. A lookup masks the address once per prefix length actually in
+    use, longest first, so it costs at most prefix-length probes and usually only a
+    handful, while 100k+ rules take one dict entry each.
+    """
+
+    def __init__(self):
+        # version -> {prefix_len: {network_int: action}}
+        self._tables = {4: {}, 6: {}}
+        self._lengths = {4: (), 6: ()}
+        self.size = 0
+
+    def add(self, cidr: str, action: str):
+        network = ipaddress.ip_network(cidr.strip(), strict=False)
+        table = self._tables[network.version].setdefault(network.prefixlen, {})
+        if int(network.network_address) not in table:
+            self.size += 1
+        table[int(network.network_address)] = action
+
+    def compile(self):
+        """Freeze the probe order after bulk loading"""
+        for version, tables in self._tables.items():
+            self._lengths[version] = tuple(sorted(tables, reverse=True))
+
+    def lookup(self, address) -> Optional[str]:
+        if not isinstance(address, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+            address = ipaddress.ip_address(address)
+        version = address.version
+        bits = 32 if version == 4 else 128
+        value = int(address)
+        tables = self._tables[version]
+        for length in self._lengths[version]:
+            network = value >> (bits - length) << (bits - length) if length else 0
+            action = tables[length].get(network)
+            if action is not None:
+                return action
+        return None
+
+
+class DomainSuffixIndex:
+    """Domain suffix rules; "example.com" also matches every subdomain, most specific wins"""
+
+    def __init__(self):
+        self._suffixes: Dict[str, str] = {}
+
+    @property
+    def size(self) -> int:
+        return len(self._suffixes)
+
+    def add(self, suffix: str, action: str):
+        self._suffixes[suffix.strip().lower().strip('.')] = action
+
+    def lookup(self, hostname: str) -> Optional[str]:
+        name = hostname.lower().rstrip('.')
+        suffixes = self._suffixes
+        while True:
+            action = suffixes.get(name)
+            if action is not None:
+                return action
+            dot = name.find('.')
+            if dot < 0:
+                return None
+            name = name[dot + 1:]
+
+
+class SplitTunnelRouter:
+    """Decides per destination whether a connection goes direct or through a VPN node"""
+
+    def __init__(self, default_action: str = VPN, cache_size: int = 65536):
+        if default_action not in ACTIONS:
+            raise ValueError(f"Unknown route action: {default_action}")
+        self.default_action = default_action
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._prefixes = PrefixTable()
+        self._domains = DomainSuffixIndex()
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add_rule(self, pattern: str, action: str):
+        """Add a CIDR, bare IP or domain suffix rule"""
+        if action not in ACTIONS:
+            raise ValueError(f"Unknown route action: {action}")
+        try:
+            self._prefixes.add(pattern, action)
+        except ValueError:
+            self._domains.add(pattern, action)
+
+    def load_rules(self, lines: Iterable[str], action: Optional[str] = None) -> int:
+        """Load "<cidr|domain> <direct|vpn>" lines, or bare patterns when action is given
+
+        Blank lines and '#' comments are ignored. Call compile() when done.
+        """
+        count = 0
+        for line in lines:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            parts = line.split()
+            self.add_rule(parts[0], action or (parts[1].lower() if len(parts) > 1 else self.default_action))
+            count += 1
+        return count
+
+    def load_file(self, path: str, action: Optional[str] = None) -> int:
+        with open(path, encoding='utf-8') as f:
+            count = self.load_rules(f, action)
+        self.compile()
+        logger.info("Loaded %d routing rules from %s", count, path)
+        return count
+
+    def compile(self):
+        self._prefixes.compile()
+        with self._lock:
+            self._cache.clear()
+
+    def __getstate__(self):
+        # Rules only: worker processes get the router pickled, and locks do not pickle
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_cache'] = collections.OrderedDict()
+        state['cache_hits'] = state['cache_misses'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def decide(self, host: str) -> str:
+        """Route action for a destination host (IP literal or hostname), cached per host"""
+        with self._lock:
+            action = self._cache.get(host)
+            if action is not None:
+                self._cache.move_to_end(host)
+                self.cache_hits += 1
+                return action
+        self.cache_misses += 1
+        try:
+            action = self._prefixes.lookup(host)
+        except ValueError:
+            action = self._domains.lookup(host)
+        action = action or self.default_action
+        with self._lock:
+            self._cache[host] = action
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return action
+
+    def stats(self) -> Dict:
+        return {
+            'default_action': self.default_action,
+            'cidr_rules': self._prefixes.size,
+            'domain_rules': self._domains.size,
+            'cache_entries': len(self._cache),
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses
+        }
+
@@ -1,13 +1,24 @@
 from http.server import HTTPServer, SimpleHTTPRequestHandler
 import socketserver
 import os
+from urllib.parse import urlsplit
+from static_assets import StaticAssets
 
 PORT = 8000
+assets = StaticAssets(os.path.dirname(os.path.abspath(__file__)))
 
 class Handler(SimpleHTTPRequestHandler):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=os.path.dirname(os.path.abspath(__file__)), **kwargs)
 
+    def do_GET(self):
+        if not assets.serve(self, urlsplit(self.path).path):
+            super().do_GET()
+
+    def do_HEAD(self):
+        if not assets.serve(self, urlsplit(self.path).path, head=True):
+            super().do_HEAD()
+
     def end_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
         super().end_headers()
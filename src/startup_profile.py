@@ -0,0 +1,80 @@
+import builtins
+import sys
+import threading
+import time
+from typing import List, Optional, Tuple
+
+# The control UI should be accepting connections within this long of launcher starting
+STARTUP_BUDGET_MS = 100.0
+
+
+class StartupProfile:
+    """Cold-start accounting: first-time import costs and named startup phases
+
+    While installed, builtins.__import__ is wrapped so every module imported for the
+    first time is timed, like python -X importtime: self time excludes the modules
+    it imported in turn, cumulative time includes them. Cached imports pass straight
+    through. Phases are marked in milliseconds since the profile was created.
+    """
+
+    def __init__(self, started: Optional[float] = None, budget_ms: float = STARTUP_BUDGET_MS):
+        self.started = started if started is not None else time.perf_counter()
+        self.budget_ms = budget_ms
+        self.imports: List[Tuple[str, float, float, int]] = []  # (module, self ms, cumulative ms, depth)
+        self.phases: List[Tuple[str, float]] = []
+        self._local = threading.local()
+        self._original = None
+
+    def install(self):
+        if self._original is None:
+            self._original = builtins.__import__
+            builtins.__import__ = self._import
+
+    def uninstall(self):
+        if self._original is not None:
+            builtins.__import__ = self._original
+            self._original = None
+
+    def mark(self, phase: str) -> float:
+        """Record that a phase finished now; returns milliseconds since start"""
+        elapsed = (time.perf_counter() - self.started) * 1000
+        self.phases.append((phase, elapsed))
+        return elapsed
+
+    def phase(self, name: str) -> Optional[float]:
+        return next((ms for phase, ms in self.phases if phase == name), None)
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return self._original(name, globals, locals, fromlist, level)
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []  # child time of each import in progress, per thread
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self._original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self.imports.append((name, (elapsed - children) * 1000, elapsed * 1000, len(stack)))
+
+    def report(self, top: int = 15, budget_phase: str = 'listening') -> str:
+        """Phase timeline, budget verdict and the slowest imports"""
+        lines = [f"Startup profile (ms since launcher start, budget {self.budget_ms:.0f} ms to {budget_phase})"]
+        for phase, ms in self.phases:
+            lines.append(f"  {phase:<24}{ms:>9.1f}")
+        reached = self.phase(budget_phase)
+        if reached is None:
+            lines.append(f"  {budget_phase} not reached")
+        else:
+            verdict = 'within' if reached <= self.budget_ms else 'OVER'
+            lines.append(f"  {verdict} budget by {abs(self.budget_ms - reached):.1f} ms")
+        total = sum(self_ms for _, self_ms, _, _ in self.imports)
+        lines.append(f"Imports: {len(self.imports)} modules, {total:.1f} ms")
+        lines.append(f"  {'self ms':>9} {'cumul ms':>9}  module")
+        for name, self_ms, cumulative, depth in sorted(self.imports, key=lambda i: i[2], reverse=True)[:top]:
+            lines.append(f"  {self_ms:>9.1f} {cumulative:>9.1f}  {'  ' * depth}{name}")
+        return '\n'.join(lines)
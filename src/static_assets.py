@@ -0,0 +1,241 @@
+import gzip
+import hashlib
+import logging
+import os
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    import brotli as _brotli
+except ImportError:
+    _brotli = None
+
+CONTENT_TYPES = {
+    '.html': 'text/html; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+    '.js': 'application/javascript; charset=utf-8',
+    '.json': 'application/json',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.svg': 'image/svg+xml',
+    '.ico': 'image/x-icon',
+}
+# Already-compressed formats gain nothing from another pass
+COMPRESSIBLE = ('.html', '.css', '.js', '.json', '.svg', '.ico')
+MIN_COMPRESS_SIZE = 256
+# Identity bodies at least this large are sent with os.sendfile from a kept-open file
+SENDFILE_MIN_SIZE = 256 * 1024
+SENDFILE_AVAILABLE = hasattr(os, 'sendfile')
+
+
+class Asset:
+    """One static file: its identity body and precompressed variants, each with a strong ETag"""
+    __slots__ = ('name', 'content_type', 'cache_control', 'size', 'mtime', 'last_modified', 'variants', 'fd',
+                 'file_id')
+
+    def __init__(self, name: str, content_type: str, cache_control: str, size: int, mtime: float):
+        self.name = name
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.size = size
+        self.mtime = int(mtime)
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        # encoding -> (body or None when sent from fd, etag); 'identity' is always present
+        self.variants: Dict[str, Tuple[Optional[bytes], str]] = {}
+        self.fd = None
+        # (st_dev, st_ino, st_size, st_mtime_ns) of the file fd was opened on
+        self.file_id = None
+
+
+class StaticAssets:
+    """The control UI bundle held in memory, served with ETags, Cache-Control and 304s
+
+    Files are read from root (the PyInstaller _MEIPASS bundle when frozen) once, on
+    first request or preload(), and gzip and, when the brotli package is installed,
+    brotli variants are compressed at that point. A request then costs no disk I/O
+    or compression: the handler gets the variant the client accepts, or a 304 if
+    its If-None-Match / If-Modified-Since still holds. HTML is revalidated on every
+    load so a new build is picked up; other assets may be reused for max_age.
+    Files large enough to be sent from a kept-open fd are checked against their path
+    on every request and reloaded when they changed, so the body always matches the
+    Content-Length and ETag sent with it.
+    """
+
+    def __init__(self, root: str, max_age: int = 300):
+        self.root = os.path.abspath(root)
+        self.max_age = max_age
+        self.served = 0
+        self.not_modified = 0
+        self._assets: Dict[str, Asset] = {}
+        # Replaced sendfile assets whose fd a request may still be reading; reload() closes them
+        self._retired = []
+        self._lock = threading.Lock()
+
+    def preload(self, names=('index.html', 'app.js', 'styles.css', 'icon.ico')):
+        for name in names:
+            self.get(name)
+
+    def reload(self):
+        """Forget every cached asset so the next request reads it from root again"""
+        with self._lock:
+            assets, self._assets = self._assets, {}
+            retired, self._retired = self._retired, []
+        for asset in list(assets.values()) + retired:
+            if asset.fd is not None:
+                os.close(asset.fd)
+
+    def get(self, name: str) -> Optional[Asset]:
+        """The cached asset for a bare file name in root, loading it on first use"""
+        asset = self._assets.get(name)
+        if asset is not None and self._current(asset):
+            return asset
+        extension = os.path.splitext(name)[1].lower()
+        if (extension not in CONTENT_TYPES or name.startswith('.') or '/' in name or '\\' in name
+                or not os.path.isfile(os.path.join(self.root, name))):
+            return None
+        with self._lock:
+            cached = self._assets.get(name)
+            if cached is not None and self._current(cached):
+                return cached
+            if cached is not None:
+                logger.info("Static asset %s changed on disk, reloading", name)
+                self._retired.append(self._assets.pop(name))
+            try:
+                asset = self._load(name, extension)
+            except OSError as e:
+                logger.error("Failed to load static asset %s: %s", name, e)
+                return None
+            self._assets[name] = asset
+        return asset
+
+    def _current(self, asset: Asset) -> bool:
+        """Whether a sendfile asset's fd still is the file at its path, unchanged; in-memory ones always are"""
+        if asset.fd is None:
+            return True
+        try:
+            stat = os.stat(os.path.join(self.root, asset.name))
+        except OSError:
+            return False
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns) == asset.file_id
+
+    def serve(self, handler, path: str, head: bool = False) -> bool:
+        """Answer a GET or HEAD for path on a BaseHTTPRequestHandler; False if it is not an asset"""
+        asset = self.get(path.lstrip('/') or 'index.html')
+        if asset is None:
+            return False
+        encoding = self._negotiate(handler.headers.get('Accept-Encoding', ''), asset)
+        body, etag = asset.variants[encoding]
+        if self._not_modified(handler.headers, asset, etag):
+            self.not_modified += 1
+            handler.send_response(304)
+            self._send_validators(handler, asset, etag)
+            handler.end_headers()
+            return True
+        self.served += 1
+        handler.send_response(200)
+        handler.send_header('Content-Type', asset.content_type)
+        handler.send_header('Content-Length', str(asset.size if body is None else len(body)))
+        if encoding != 'identity':
+            handler.send_header('Content-Encoding', encoding)
+        self._send_validators(handler, asset, etag)
+        handler.end_headers()
+        if head:
+            return True
+        if body is None:
+            self._sendfile(handler, asset)
+        else:
+            handler.wfile.write(body)
+        return True
+
+    def _load(self, name: str, extension: str) -> Asset:
+        path = os.path.join(self.root, name)
+        fd = None
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            data = f.read()
+            if SENDFILE_AVAILABLE and len(data) >= SENDFILE_MIN_SIZE:
+                # The same open file the data, and so the ETag, came from
+                fd = os.dup(f.fileno())
+        cache_control = 'no-cache' if extension == '.html' else f'public, max-age={self.max_age}'
+        asset = Asset(name, CONTENT_TYPES[extension], cache_control, len(data), stat.st_mtime)
+        digest = hashlib.blake2b(data, digest_size=12).hexdigest()
+        if fd is not None:
+            asset.fd = fd
+            asset.file_id = (stat.st_dev, stat.st_ino, len(data), stat.st_mtime_ns)
+            asset.variants['identity'] = (None, f'"{digest}"')
+        else:
+            asset.variants['identity'] = (data, f'"{digest}"')
+        if extension in COMPRESSIBLE and len(data) >= MIN_COMPRESS_SIZE:
+            # mtime=0 keeps the gzip bytes, and so the ETag, identical across restarts
+            compressed = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+            if _brotli:
+                compressed['br'] = _brotli.compress(data, quality=11)
+            for encoding, body in compressed.items():
+                if len(body) < len(data):
+                    asset.variants[encoding] = (body, f'"{digest}-{encoding}"')
+        logger.debug("Loaded static asset %s (%d bytes, %s)", name, len(data), ', '.join(asset.variants))
+        return asset
+
+    @staticmethod
+    def _negotiate(accept_encoding: str, asset: Asset) -> str:
+        """Best precompressed variant the client accepts (br, then gzip), else identity"""
+        if len(asset.variants) == 1:
+            return 'identity'
+        accepted = set()
+        for item in accept_encoding.split(','):
+            coding, _, params = item.strip().partition(';')
+            q = params.strip()
+            if q.startswith('q='):
+                try:
+                    if float(q[2:]) <= 0:
+                        continue
+                except ValueError:
+                    continue
+            accepted.add(coding.strip().lower())
+        for encoding in ('br', 'gzip'):
+            if encoding in asset.variants and (encoding in accepted or '*' in accepted):
+                return encoding
+        return 'identity'
+
+    @staticmethod
+    def _not_modified(headers, asset: Asset, etag: str) -> bool:
+        if_none_match = headers.get('If-None-Match')
+        if if_none_match:
+            # Weak comparison, as RFC 9110 requires for If-None-Match
+            tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+            return '*' in tags or etag in tags
+        if_modified_since = headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                return parsedate_to_datetime(if_modified_since).timestamp() >= asset.mtime
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+        return False
+
+    @staticmethod
+    def _send_validators(handler, asset: Asset, etag: str):
+        handler.send_header('ETag', etag)
+        handler.send_header('Last-Modified', asset.last_modified)
+        handler.send_header('Cache-Control', asset.cache_control)
+        if len(asset.variants) > 1:
+            handler.send_header('Vary', 'Accept-Encoding')
+
+    @staticmethod
+    def _sendfile(handler, asset: Asset):
+        """Kernel-side copy from the asset file to the client socket"""
+        handler.wfile.flush()
+        out_fd = handler.connection.fileno()
+        offset = 0
+        while offset < asset.size:
+            sent = os.sendfile(out_fd, asset.fd, offset, asset.size - offset)
+            if not sent:
+                break
+            offset += sent
+        if offset < asset.size:
+            # Truncated since the check in get(): the client still waits for Content-Length bytes
+            logger.warning("Static asset %s shrank while being sent (%d of %d bytes)", asset.name, offset, asset.size)
+            handler.close_connection = True
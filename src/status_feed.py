@@ -0,0 +1,83 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class StatusFeed:
+    """Versioned, pre-serialised status snapshot shared by every control-UI client
+
+    A single background thread rebuilds the snapshot at most every interval seconds
+    (or immediately after refresh()), and only bumps the version when the serialised
+    body actually changed. Requests read the cached bytes; long-poll and SSE clients
+    block in wait_for_change() instead of polling.
+
+    Feed it state that only changes on real events; a build() that includes
+    per-second counters changes the version every tick and every waiting client
+    gets the full body again. Feeds without the background thread can be read
+    with snapshot(max_age) to rebuild on demand, at most once per max_age.
+    """
+
+    def __init__(self, build: Callable[[], Dict], interval: float = 1.0):
+        self.build = build
+        self.interval = interval
+        self.version = 0
+        self.body = b''
+        self.built_at = 0.0
+        self._boot_id = os.urandom(4).hex()
+        self._cond = threading.Condition()
+        self._wake = threading.Event()
+        self._thread = None
+
+    @property
+    def etag(self) -> str:
+        return f'"{self._boot_id}-{self.version}"'
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._refresh_loop, daemon=True)
+        self._thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error("Failed to refresh status snapshot: %s", e)
+
+    def refresh(self) -> bool:
+        """Rebuild the snapshot now; returns True if it changed"""
+        body = json.dumps(self.build(), sort_keys=True).encode('utf-8')
+        with self._cond:
+            self.built_at = time.monotonic()
+            if body == self.body:
+                return False
+            self.body = body
+            self.version += 1
+            self._cond.notify_all()
+        return True
+
+    def expire(self):
+        """Make the next snapshot(max_age) rebuild"""
+        self.built_at = 0.0
+
+    def snapshot(self, max_age: Optional[float] = None) -> Tuple[str, bytes]:
+        """Current (etag, body), building the first one, or one older than max_age seconds, on demand"""
+        if not self.version or (max_age is not None and time.monotonic() - self.built_at > max_age):
+            self.refresh()
+        with self._cond:
+            return self.etag, self.body
+
+    def wait_for_change(self, etag: Optional[str], timeout: float) -> Tuple[str, bytes]:
+        """Block until the snapshot's etag differs from etag or timeout elapses"""
+        self.snapshot()
+        with self._cond:
+            self._cond.wait_for(lambda: self.etag != etag, timeout=timeout)
+            return self.etag, self.body
@@ -0,0 +1,415 @@
+import hashlib
+import os
+import socket
+import struct
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from compression import Codec, CompressionStats, FrameDecoder, FrameEncoder, available_codecs, get_codec
+
+MAGIC = b'TVPN'
+VERSION = 3
+
+CIPHERS = {'none': 0, 'aes-256-gcm': 1, 'chacha20-poly1305': 2}
+_CIPHER_NAMES = {value: name for name, value in CIPHERS.items()}
+
+# Record: 2-byte ciphertext length (authenticated as associated data), ciphertext, 16-byte tag
+RECORD_HEADER = struct.Struct('!H')
+TAG_SIZE = 16
+# IPv4 + TCP headers, so a full record fits one packet at the configured MTU
+_PACKET_OVERHEAD = 40
+
+_MODE_FULL = 1
+_MODE_RESUMED = 2
+# Open message flags
+FLAG_MULTIPLEX = 0x01
+KEY_SIZE = 32
+TICKET_LIFETIME = 3600.0
+
+
+class TunnelError(Exception):
+    """The peer is not a tunnel endpoint, failed authentication or broke the protocol"""
+
+
+class PeerClosed(TunnelError):
+    """The peer closed without sending a byte, as a bare TCP connect probe does"""
+
+
+def _aead(cipher: str, key: bytes):
+    # cryptography is only needed once an encrypted tunnel is actually opened
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+    return AESGCM(key) if cipher == 'aes-256-gcm' else ChaCha20Poly1305(key)
+
+
+def _derive(secret: bytes, psk: Optional[bytes], info: bytes, length: int) -> bytes:
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    if isinstance(psk, str):
+        psk = psk.encode('utf-8')
+    salt = hashlib.sha256(psk).digest() if psk else None
+    return HKDF(algorithm=hashes.SHA256(), length=length, salt=salt, info=info).derive(secret)
+
+
+def _session_keys(secret: bytes, psk: Optional[bytes], transcript: bytes) -> Tuple[bytes, bytes, bytes]:
+    """(client->node key, node->client key, resumption secret) bound to the handshake transcript"""
+    material = _derive(secret, psk, b'tvpn session ' + hashlib.sha256(transcript).digest(), 3 * KEY_SIZE)
+    return material[:KEY_SIZE], material[KEY_SIZE:2 * KEY_SIZE], material[2 * KEY_SIZE:]
+
+
+def _x25519():
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+    return X25519PrivateKey, X25519PublicKey
+
+
+class RecordSealer:
+    """Encrypts a byte stream into AEAD records of at most record_size plaintext bytes
+
+    The cipher context is built once per direction and nonces are a 64-bit counter,
+    so a key never sees the same nonce twice.
+    """
+    __slots__ = ('aead', 'record_size', 'counter')
+
+    def __init__(self, aead, record_size: int):
+        self.aead = aead
+        self.record_size = record_size
+        self.counter = 0
+
+    def seal(self, data) -> bytes:
+        out = []
+        size = self.record_size
+        encrypt = self.aead.encrypt
+        pack = RECORD_HEADER.pack
+        view = memoryview(data)
+        counter = self.counter
+        for offset in range(0, len(view), size):
+            chunk = view[offset:offset + size]
+            header = pack(len(chunk) + TAG_SIZE)
+            out.append(header)
+            out.append(encrypt(counter.to_bytes(12, 'big'), chunk, header))
+            counter += 1
+        self.counter = counter
+        return b''.join(out)
+
+
+class RecordOpener:
+    """Reassembles and authenticates records from arbitrary stream chunks"""
+    __slots__ = ('aead', 'counter', '_buffer')
+
+    def __init__(self, aead):
+        self.aead = aead
+        self.counter = 0
+        self._buffer = bytearray()
+
+    def open(self, data) -> bytes:
+        from cryptography.exceptions import InvalidTag
+        buffer = self._buffer
+        buffer += data
+        out = []
+        offset = 0
+        header_size = RECORD_HEADER.size
+        decrypt = self.aead.decrypt
+        view = memoryview(buffer)
+        try:
+            while len(buffer) - offset >= header_size:
+                length, = RECORD_HEADER.unpack_from(buffer, offset)
+                end = offset + header_size + length
+                if end > len(buffer):
+                    break
+                out.append(decrypt(self.counter.to_bytes(12, 'big'), view[offset + header_size:end],
+                                   view[offset:offset + header_size]))
+                self.counter += 1
+                offset = end
+        except InvalidTag:
+            raise TunnelError("Tunnel record failed authentication (wrong PSK or tampering)")
+        finally:
+            view.release()  # a bytearray cannot be resized while exported
+        del buffer[:offset]
+        return b''.join(out)
+
+
+class SessionCache:
+    """Client-side resumption tickets, one per node address"""
+
+    def __init__(self):
+        self._tickets: Dict[tuple, Tuple[bytes, bytes, float]] = {}
+        self._lock = threading.Lock()
+        self.full_handshakes = 0
+        self.resumed_handshakes = 0
+
+    def get(self, key) -> Optional[Tuple[bytes, bytes]]:
+        with self._lock:
+            entry = self._tickets.get(key)
+            if entry and entry[2] > time.monotonic():
+                return entry[0], entry[1]
+            self._tickets.pop(key, None)
+        return None
+
+    def put(self, key, ticket: bytes, secret: bytes, lifetime: float):
+        with self._lock:
+            self._tickets[key] = (ticket, secret, time.monotonic() + lifetime)
+
+    def discard(self, key):
+        with self._lock:
+            self._tickets.pop(key, None)
+
+    def to_dict(self) -> Dict:
+        return {
+            'full_handshakes': self.full_handshakes,
+            'resumed_handshakes': self.resumed_handshakes,
+            'cached_tickets': len(self._tickets)
+        }
+
+
+class TicketIssuer:
+    """Node side: seals resumption secrets into tickets only this process can open"""
+
+    def __init__(self, lifetime: float = TICKET_LIFETIME):
+        self.lifetime = lifetime
+        self._key = os.urandom(KEY_SIZE)
+
+    def issue(self, secret: bytes) -> bytes:
+        nonce = os.urandom(12)
+        expires = struct.pack('!d', time.time() + self.lifetime)
+        return nonce + _aead('aes-256-gcm', self._key).encrypt(nonce, expires + secret, None)
+
+    def redeem(self, ticket: bytes) -> Optional[bytes]:
+        from cryptography.exceptions import InvalidTag
+        if len(ticket) < 12 + 8 + KEY_SIZE + TAG_SIZE:
+            return None
+        try:
+            plain = _aead('aes-256-gcm', self._key).decrypt(ticket[:12], ticket[12:], None)
+        except InvalidTag:
+            return None
+        if struct.unpack('!d', plain[:8])[0] < time.time():
+            return None
+        return plain[8:]
+
+
+def _open_message(codec_name: str, target: Optional[str], flags: int = 0) -> bytes:
+    codec = codec_name.encode('ascii')
+    target = (target or '').encode('idna')
+    return struct.pack('!BB', flags, len(codec)) + codec + struct.pack('!B', len(target)) + target
+
+
+def _parse_open_message(data: bytes) -> Tuple[int, str, Optional[str], bytes]:
+    """(flags, codec name, target, remaining bytes); raises IndexError while incomplete"""
+    flags, codec_len = data[0], data[1]
+    codec = bytes(data[2:2 + codec_len]).decode('ascii')
+    target_len = data[2 + codec_len]
+    end = 3 + codec_len + target_len
+    if len(data) < end:
+        raise IndexError("incomplete open message")
+    return flags, codec, bytes(data[3 + codec_len:end]).decode('idna') or None, bytes(data[end:])
+
+
+def record_size_for(mtu: int) -> int:
+    """Largest record plaintext that still fits one packet at mtu"""
+    return max(mtu - _PACKET_OVERHEAD - RECORD_HEADER.size - TAG_SIZE, 256)
+
+
+class _Pipeline:
+    """Compression frames inside optional AEAD records for one direction pair"""
+    __slots__ = ('encoder', 'decoder', 'sealer', 'opener')
+
+    def __init__(self, codec: Optional[Codec], stats: Optional[CompressionStats]):
+        self.encoder = FrameEncoder(codec, stats)
+        self.decoder = FrameDecoder(codec)
+        self.sealer = None
+        self.opener = None
+
+    def encode(self, data) -> bytes:
+        frames = self.encoder.encode(data)
+        return self.sealer.seal(frames) if self.sealer else frames
+
+    def decode(self, data) -> bytes:
+        if self.opener:
+            data = self.opener.open(data)
+            if not data:
+                return b''
+        return self.decoder.decode(data)
+
+
+class TunnelStage:
+    """Client end of one tunnel connection: handshake, compression and encryption
+
+    Send preamble first. With a cipher, the node answers with its key share (or
+    accepts a resumption ticket, skipping the key exchange) and the stage becomes
+    ready; take_outgoing() then holds the encrypted open message naming the codec
+    and target, which must be sent before any encode() output. Without a cipher
+    the open message travels in the preamble and the stage is ready at once.
+    A cipher needs psk, which is what authenticates the node's key share.
+    """
+
+    def __init__(self, codec: Optional[Codec], stats: Optional[CompressionStats] = None,
+                 target: Optional[str] = None, cipher: str = 'none', psk: Optional[bytes] = None,
+                 sessions: Optional[SessionCache] = None, session_key=None, mtu: int = 1500,
+                 multiplex: bool = False):
+        if cipher not in CIPHERS:
+            raise ValueError(f"Unknown tunnel encryption: {cipher}")
+        if cipher != 'none' and not psk:
+            # Nothing else authenticates the X25519 exchange: anyone on path could pose as the node
+            raise ValueError(f"Tunnel encryption {cipher} needs a pre-shared key")
+        self.cipher = cipher
+        self.psk = psk
+        self.sessions = sessions
+        self.session_key = session_key
+        self.record_size = record_size_for(mtu)
+        self.pipeline = _Pipeline(codec, stats)
+        self._open = _open_message(codec.name if codec else 'none', target,
+                                   FLAG_MULTIPLEX if multiplex else 0)
+        self._outgoing = b''
+        self._handshake = bytearray()
+        header = MAGIC + struct.pack('!BB', VERSION, CIPHERS[cipher])
+        if cipher == 'none':
+            self.ready = True
+            self.preamble = header + self._open
+            return
+        self.ready = False
+        private_key_type, _ = _x25519()
+        self._private = private_key_type.generate()
+        self._public = self._private.public_key().public_bytes_raw()
+        self._resume = sessions.get(session_key) if sessions else None
+        ticket = self._resume[0] if self._resume else b''
+        self._nonce = os.urandom(32)
+        self._hello = self._public + self._nonce + struct.pack('!H', len(ticket)) + ticket
+        self.preamble = header + self._hello
+
+    def encode(self, data) -> bytes:
+        return self.pipeline.encode(data)
+
+    def decode(self, data) -> bytes:
+        if self.ready:
+            return self.pipeline.decode(data)
+        self._handshake += data
+        if len(self._handshake) < 1 + 32 + 2:
+            return b''
+        mode = self._handshake[0]
+        ticket_len, = struct.unpack_from('!H', self._handshake, 33)
+        end = 35 + ticket_len
+        if len(self._handshake) < end:
+            return b''
+        key_share = bytes(self._handshake[1:33])
+        ticket = bytes(self._handshake[35:end])
+        rest = bytes(self._handshake[end:])
+        self._finish(mode, key_share, ticket)
+        self._handshake = bytearray()
+        return self.pipeline.decode(rest) if rest else b''
+
+    def _finish(self, mode: int, key_share: bytes, ticket: bytes):
+        transcript = self._hello + bytes((mode,)) + key_share
+        if mode == _MODE_RESUMED and self._resume:
+            secret = self._resume[1]
+            if self.sessions:
+                self.sessions.resumed_handshakes += 1
+        elif mode == _MODE_FULL:
+            _, public_key_type = _x25519()
+            secret = self._private.exchange(public_key_type.from_public_bytes(key_share))
+            if self.sessions:
+                self.sessions.full_handshakes += 1
+        else:
+            raise TunnelError(f"Bad tunnel handshake mode {mode}")
+        c2s, s2c, resumption = _session_keys(secret, self.psk, transcript)
+        self.pipeline.sealer = RecordSealer(_aead(self.cipher, c2s), self.record_size)
+        self.pipeline.opener = RecordOpener(_aead(self.cipher, s2c))
+        if self.sessions and ticket:
+            self.sessions.put(self.session_key, ticket, resumption, TICKET_LIFETIME)
+        self._outgoing = self.pipeline.sealer.seal(self._open)
+        self.ready = True
+
+    def take_outgoing(self) -> bytes:
+        """Bytes the stage itself needs sent to the node (the open message after the handshake)"""
+        data, self._outgoing = self._outgoing, b''
+        return data
+
+    def handshake(self, sock: socket.socket):
+        """Blocking form for threaded callers: send the preamble and wait until ready"""
+        sock.sendall(self.preamble)
+        while not self.ready:
+            data = sock.recv(4096)
+            if not data:
+                if self.sessions:
+                    self.sessions.discard(self.session_key)
+                raise TunnelError("Node closed the connection during the tunnel handshake")
+            if self.decode(data):
+                raise TunnelError("Node sent data before the tunnel was open")
+        sock.sendall(self.take_outgoing())
+
+
+def _recv_exactly(sock: socket.socket, size: int, first: bool = False) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            if first and not data:
+                raise PeerClosed("Peer closed before sending anything")
+            raise TunnelError("Peer closed during tunnel handshake")
+        data += chunk
+    return bytes(data)
+
+
+def accept_tunnel(sock: socket.socket, issuer: TicketIssuer, psk: Optional[bytes] = None,
+                  stats: Optional[CompressionStats] = None, mtu: int = 1500,
+                  allowed_ciphers=tuple(CIPHERS)) -> Tuple[_Pipeline, Optional[str], bool, bytes, bool]:
+    """Node side of the handshake; returns (pipeline, requested target, resumed, early data, multiplexed)
+
+    early data is client plaintext that arrived together with the open message.
+    multiplexed tunnels carry mux.MuxSession frames instead of a single stream.
+    """
+    magic, version, cipher_id = struct.unpack('!4sBB', _recv_exactly(sock, 6, first=True))
+    if magic != MAGIC:
+        raise TunnelError("Not a tunnel connection")
+    if version != VERSION:
+        raise TunnelError(f"Unsupported tunnel version {version}")
+    cipher = _CIPHER_NAMES.get(cipher_id)
+    if cipher is None or cipher not in allowed_ciphers:
+        raise TunnelError(f"Tunnel encryption {cipher or cipher_id} not allowed")
+    if cipher != 'none' and not psk:
+        raise TunnelError(f"Tunnel encryption {cipher} needs a pre-shared key on the node")
+
+    if cipher == 'none':
+        head = _recv_exactly(sock, 2)
+        codec = _recv_exactly(sock, head[1])
+        target_len = _recv_exactly(sock, 1)
+        target = _recv_exactly(sock, target_len[0])
+        flags, codec_name, target, _ = _parse_open_message(head + codec + target_len + target)
+        return _Pipeline(_node_codec(codec_name), stats), target, False, b'', bool(flags & FLAG_MULTIPLEX)
+
+    hello = _recv_exactly(sock, 32 + 32 + 2)
+    ticket = _recv_exactly(sock, struct.unpack_from('!H', hello, 64)[0])
+    hello += ticket
+    secret = issuer.redeem(ticket) if ticket else None
+    if secret is not None:
+        mode, key_share = _MODE_RESUMED, os.urandom(32)
+    else:
+        private_key_type, public_key_type = _x25519()
+        private = private_key_type.generate()
+        secret = private.exchange(public_key_type.from_public_bytes(hello[:32]))
+        mode, key_share = _MODE_FULL, private.public_key().public_bytes_raw()
+    c2s, s2c, resumption = _session_keys(secret, psk, hello + bytes((mode,)) + key_share)
+    new_ticket = issuer.issue(resumption)
+    sock.sendall(bytes((mode,)) + key_share + struct.pack('!H', len(new_ticket)) + new_ticket)
+
+    opener = RecordOpener(_aead(cipher, c2s))
+    received = bytearray()
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            raise TunnelError("Peer closed before opening the tunnel")
+        received += opener.open(data)
+        try:
+            flags, codec_name, target, rest = _parse_open_message(received)
+            break
+        except IndexError:
+            continue  # open message still incomplete
+    pipeline = _Pipeline(_node_codec(codec_name), stats)
+    pipeline.opener = opener
+    pipeline.sealer = RecordSealer(_aead(cipher, s2c), record_size_for(mtu))
+    early = pipeline.decoder.decode(rest) if rest else b''
+    return pipeline, target, mode == _MODE_RESUMED, early, bool(flags & FLAG_MULTIPLEX)
+
+
+def _node_codec(name: str) -> Optional[Codec]:
+    if name not in available_codecs():
+        raise TunnelError(f"Unsupported compression {name}")
+    return get_codec(name)
@@ -0,0 +1,465 @@
+import collections
+import logging
+import selectors
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from proxy_protocol import ProxyProtocolError, pack_udp_header, parse_udp_header
+
+logger = logging.getLogger(__name__)
+
+MAX_DATAGRAM = 65535
+# sendmsg() lets a SOCKS reply header and the payload go out without joining them first
+SENDMSG_AVAILABLE = hasattr(socket.socket, 'sendmsg')
+
+_FRONT = object()
+_WAKEUP = object()
+
+
+class _Association:
+    """A SOCKS5 UDP ASSOCIATE: the client allowed to send, alive while its TCP control connection is"""
+    __slots__ = ('control', 'host', 'port', 'flows')
+
+    def __init__(self, control: socket.socket, host: str, port: int):
+        self.control = control
+        self.host = host
+        self.port = port  # 0 until the first datagram shows which port the client sends from
+        self.flows = set()
+
+
+class _NatSocket:
+    """An upstream UDP socket; every flow on it has a distinct (destination, target) so replies map back"""
+    __slots__ = ('sock', 'family', 'destinations')
+
+    def __init__(self, sock: socket.socket, family: int):
+        self.sock = sock
+        self.family = family
+        self.destinations: Dict[tuple, int] = {}  # destination -> flows using it from this socket
+
+
+class _Flow:
+    """One client's datagrams to one target, and the NAT socket its replies come back on"""
+    __slots__ = ('client', 'target', 'destination', 'node', 'wrap', 'nat', 'reply_header', 'association',
+                 'stats', 'last_active')
+
+    def __init__(self, client, target, destination, node, wrap, nat, association):
+        self.client = client
+        self.target = target
+        self.destination = destination
+        self.node = node
+        self.wrap = wrap
+        self.nat = nat
+        self.association = association
+        # Replies to a SOCKS client carry their source; a wrapping node already adds it
+        self.reply_header = pack_udp_header(*destination[:2]) if association and not wrap else b''
+        self.stats = None
+        self.last_active = time.monotonic()
+
+    @property
+    def nat_key(self) -> tuple:
+        return self.nat, self.destination, self.target if self.wrap else None
+
+
+class UDPRelay:
+    """Datagram relay with a NAT table, running every flow on one selector thread
+
+    Clients send to a single front socket. In raw mode any client may send and
+    its datagrams are relayed as they are; in SOCKS mode only clients holding a
+    UDP ASSOCIATE may, and datagrams carry the RFC 1928 header naming their
+    target.
+
+    route(client, target) picks where a new flow goes and returns (destination,
+    node, wrap); target is None in raw mode and wrap keeps the SOCKS header on
+    datagrams sent to destination, for nodes that relay UDP themselves. It runs
+    on the loop thread, so it must not block, and raises OSError when there is
+    no route yet (the datagram is dropped and the client retries).
+
+    Flows share a small pool of upstream NAT sockets: a flow only needs a socket
+    on which no other flow talks to the same destination (and target), so the
+    pool grows with the number of clients per destination, not the number of
+    flows. Each readiness event drains up to batch datagrams into one reusable
+    buffer. Flows idle for idle_timeout seconds are expired.
+    """
+
+    def __init__(self, host: str, port: int, route: Callable[[tuple, Optional[tuple]], Tuple[tuple, object, bool]],
+                 socks: bool = False, metrics=None, idle_timeout: float = 60.0, max_sockets: int = 64,
+                 max_flows: int = 65536, batch: int = 64, reuse_port: bool = False,
+                 on_error: Optional[Callable[[str, Exception], None]] = None):
+        self.host = host
+        self.requested_port = port
+        self.route = route
+        self.socks = socks
+        self.metrics = metrics
+        self.idle_timeout = idle_timeout
+        self.max_sockets = max_sockets
+        self.max_flows = max_flows
+        self.batch = batch
+        self.reuse_port = reuse_port
+        self.on_error = on_error
+        self.port = None
+        self.flows_opened = 0
+        self.flows_expired = 0
+        self.packets_in = 0   # upstream -> client
+        self.packets_out = 0  # client -> upstream
+        self.dropped = collections.Counter()
+        self._flows: Dict[tuple, _Flow] = {}  # (client, target) -> flow
+        self._nat: Dict[tuple, _Flow] = {}    # (nat socket, destination, wrapped target) -> flow
+        self._nat_sockets: List[_NatSocket] = []
+        self._associations: Dict[tuple, _Association] = {}  # (host, port) of bound associations
+        self._unbound: Dict[str, List[_Association]] = {}   # host -> associations waiting for a port
+        self._lock = threading.Lock()
+        self._handoffs = collections.deque()
+        self._buffer = bytearray(MAX_DATAGRAM)
+        self._view = memoryview(self._buffer)
+        self._selector = selectors.DefaultSelector()
+        self._front = None
+        self._wakeup_r = self._wakeup_w = None
+        self._running = False
+        self._thread = None
+        self._now = time.monotonic()
+        self._next_sweep = 0.0
+
+    @property
+    def active_flows(self) -> int:
+        return len(self._flows)
+
+    def start(self):
+        """Bind the front socket and start the loop thread; raises OSError if the bind fails"""
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        front = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            if self.reuse_port and hasattr(socket, 'SO_REUSEPORT'):
+                front.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            front.bind((self.host, self.requested_port))
+        except OSError:
+            front.close()
+            raise
+        front.setblocking(False)
+        self._front = front
+        self.port = front.getsockname()[1]
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._selector.register(front, selectors.EVENT_READ, _FRONT)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, _WAKEUP)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='udp-relay', daemon=True)
+        self._thread.start()
+        logger.info("UDP relay listening on %s:%s (%s)", self.host, self.port, 'socks' if self.socks else 'raw',
+                    extra={'event': 'udp_relay_started'})
+
+    def stop(self, timeout: float = 5.0):
+        """Stop the loop and close every socket, control connections included"""
+        self._running = False
+        self._wake()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def associate(self, control: socket.socket, client_address, port: int = 0):
+        """Allow client_address's host to send from port (0: any) while control stays open; thread-safe
+
+        The relay owns control from here on and closes it when the association ends.
+        """
+        if not self._running:
+            control.close()
+            return
+        association = _Association(control, client_address[0], port)
+        with self._lock:
+            if port:
+                self._associations[(association.host, port)] = association
+            else:
+                self._unbound.setdefault(association.host, []).append(association)
+        self._handoffs.append(association)
+        self._wake()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            associations = len(self._associations) + sum(len(waiting) for waiting in self._unbound.values())
+        return {
+            'port': self.port,
+            'mode': 'socks' if self.socks else 'raw',
+            'flows': len(self._flows),
+            'flows_opened': self.flows_opened,
+            'flows_expired': self.flows_expired,
+            'associations': associations,
+            'nat_sockets': len(self._nat_sockets),
+            'packets_in': self.packets_in,
+            'packets_out': self.packets_out,
+            'dropped': dict(self.dropped)
+        }
+
+    def _run(self):
+        try:
+            while self._running:
+                events = self._selector.select(timeout=1.0)
+                self._now = time.monotonic()
+                for key, mask in events:
+                    if key.data is _FRONT:
+                        self._read_clients()
+                    elif key.data is _WAKEUP:
+                        self._drain_wakeup()
+                    elif isinstance(key.data, _NatSocket):
+                        self._read_upstream(key.data)
+                    else:
+                        self._read_control(key.data)
+                if self._now >= self._next_sweep:
+                    self._next_sweep = self._now + 1.0
+                    self._sweep()
+        except Exception as e:
+            if self._running:
+                logger.error("UDP relay loop error: %s", e, extra={'event': 'relay_error'})
+                if self.on_error:
+                    self.on_error("UDP relay loop error", e)
+        finally:
+            self._shutdown()
+
+    def _wake(self):
+        try:
+            self._wakeup_w.send(b'\0')
+        except (OSError, AttributeError):
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_r.recv(512):
+                pass
+        except OSError:
+            pass
+        while self._handoffs:
+            association = self._handoffs.popleft()
+            try:
+                # Left blocking: the reply may still be going out on another thread, and the loop
+                # only reads it once it is readable
+                self._selector.register(association.control, selectors.EVENT_READ, association)
+            except (OSError, ValueError):
+                self._release(association)
+
+    def _read_clients(self):
+        for _ in range(self.batch):
+            try:
+                n, client = self._front.recvfrom_into(self._buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue  # e.g. an ICMP error surfacing as ConnectionResetError on Windows
+            self._from_client(client, self._view[:n])
+
+    def _from_client(self, client, data: memoryview):
+        association = target = None
+        payload = data
+        if self.socks:
+            association = self._association_for(client)
+            if association is None:
+                self.dropped['unassociated'] += 1
+                return
+            try:
+                host, port, offset = parse_udp_header(data)
+            except (ProxyProtocolError, UnicodeError, ValueError):
+                self.dropped['malformed'] += 1
+                return
+            target = (host, port)
+            payload = data[offset:]
+        flow = self._flows.get((client, target))
+        if flow is None:
+            flow = self._open_flow(client, target, association)
+            if flow is None:
+                return
+        try:
+            # A wrapping node gets the datagram as the client sent it, header included
+            flow.nat.sock.sendto(data if flow.wrap else payload, flow.destination)
+        except BlockingIOError:
+            self.dropped['send_buffer_full'] += 1
+            return
+        except OSError as e:
+            self.dropped['send_error'] += 1
+            logger.debug("UDP send to %s failed: %s", flow.destination, e)
+            return
+        flow.last_active = self._now
+        self.packets_out += 1
+        if flow.stats:
+            flow.stats.bytes_out.add(len(payload))
+
+    def _read_upstream(self, nat: _NatSocket):
+        for _ in range(self.batch):
+            try:
+                n, source = nat.sock.recvfrom_into(self._buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue
+            data = self._view[:n]
+            source = source[:2]
+            flow = self._nat.get((nat, source, None))
+            if flow is None:
+                try:
+                    host, port, _ = parse_udp_header(data)
+                except (ProxyProtocolError, UnicodeError, ValueError):
+                    self.dropped['unmatched_reply'] += 1
+                    continue
+                flow = self._nat.get((nat, source, (host, port)))
+                if flow is None:
+                    self.dropped['unmatched_reply'] += 1
+                    continue
+            try:
+                if not flow.reply_header:
+                    self._front.sendto(data, flow.client)
+                elif SENDMSG_AVAILABLE:
+                    self._front.sendmsg([flow.reply_header, data], [], 0, flow.client)
+                else:
+                    self._front.sendto(flow.reply_header + data, flow.client)
+            except BlockingIOError:
+                self.dropped['send_buffer_full'] += 1
+                continue
+            except OSError as e:
+                self.dropped['send_error'] += 1
+                logger.debug("UDP send to client %s failed: %s", flow.client, e)
+                continue
+            flow.last_active = self._now
+            self.packets_in += 1
+            if flow.stats:
+                flow.stats.bytes_in.add(n)
+
+    def _read_control(self, association: _Association):
+        """Anything but EOF on a control connection is ignored; EOF or an error ends the association"""
+        try:
+            if association.control.recv(4096):
+                return
+        except InterruptedError:
+            return
+        except OSError:
+            pass
+        self._release(association)
+
+    def _association_for(self, client) -> Optional[_Association]:
+        host, port = client[0], client[1]
+        association = self._associations.get((host, port))
+        if association is not None:
+            return association
+        with self._lock:
+            waiting = self._unbound.get(host)
+            if not waiting:
+                return None
+            # The first datagram from a new port claims the oldest association without one
+            association = waiting.pop(0)
+            if not waiting:
+                del self._unbound[host]
+            association.port = port
+            self._associations[(host, port)] = association
+        return association
+
+    def _open_flow(self, client, target, association) -> Optional[_Flow]:
+        if len(self._flows) >= self.max_flows:
+            self.dropped['flow_limit'] += 1
+            return None
+        try:
+            destination, node, wrap = self.route(client, target)
+        except OSError as e:
+            self.dropped['no_route'] += 1
+            logger.debug("No UDP route for %s -> %s: %s", client, target, e)
+            return None
+        nat = self._nat_socket(destination, target if wrap else None)
+        if nat is None:
+            self.dropped['nat_exhausted'] += 1
+            return None
+        flow = _Flow(client, target, destination, node, wrap, nat, association)
+        self._flows[(client, target)] = flow
+        self._nat[flow.nat_key] = flow
+        nat.destinations[destination] = nat.destinations.get(destination, 0) + 1
+        if association:
+            association.flows.add(flow)
+        if self.metrics:
+            flow.stats = self.metrics.node(node)
+            flow.stats.udp_flows_opened.add()
+        self.flows_opened += 1
+        return flow
+
+    def _nat_socket(self, destination: tuple, wrapped_target: Optional[tuple]) -> Optional[_NatSocket]:
+        """A NAT socket on which (destination, wrapped_target) is free, opening one if none is"""
+        family = socket.AF_INET6 if ':' in destination[0] else socket.AF_INET
+        for nat in self._nat_sockets:
+            if nat.family != family:
+                continue
+            if wrapped_target is None:
+                # Plain replies are matched on source address alone, so it must be unused here
+                if destination not in nat.destinations:
+                    return nat
+            elif (nat, destination, None) not in self._nat and (nat, destination, wrapped_target) not in self._nat:
+                return nat
+        if len(self._nat_sockets) >= self.max_sockets:
+            return None
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            sock.bind(('::' if family == socket.AF_INET6 else '0.0.0.0', 0))
+        except OSError:
+            sock.close()
+            return None
+        nat = _NatSocket(sock, family)
+        self._nat_sockets.append(nat)
+        self._selector.register(sock, selectors.EVENT_READ, nat)
+        return nat
+
+    def _close_flow(self, flow: _Flow):
+        self._flows.pop((flow.client, flow.target), None)
+        self._nat.pop(flow.nat_key, None)
+        remaining = flow.nat.destinations.get(flow.destination, 1) - 1
+        if remaining:
+            flow.nat.destinations[flow.destination] = remaining
+        else:
+            flow.nat.destinations.pop(flow.destination, None)
+        if flow.association:
+            flow.association.flows.discard(flow)
+        if flow.stats:
+            flow.stats.udp_flows_closed.add()
+
+    def _release(self, association: _Association):
+        with self._lock:
+            if self._associations.get((association.host, association.port)) is association:
+                del self._associations[(association.host, association.port)]
+            waiting = self._unbound.get(association.host)
+            if waiting and association in waiting:
+                waiting.remove(association)
+                if not waiting:
+                    del self._unbound[association.host]
+        for flow in list(association.flows):
+            self._close_flow(flow)
+        try:
+            self._selector.unregister(association.control)
+        except (KeyError, ValueError):
+            pass
+        association.control.close()
+
+    def _sweep(self):
+        """Expire idle flows and close NAT sockets beyond the first that no flow uses any more"""
+        if self.idle_timeout:
+            cutoff = self._now - self.idle_timeout
+            expired = [flow for flow in self._flows.values() if flow.last_active < cutoff]
+            for flow in expired:
+                self._close_flow(flow)
+            self.flows_expired += len(expired)
+        for nat in self._nat_sockets[1:]:
+            if not nat.destinations:
+                self._nat_sockets.remove(nat)
+                self._selector.unregister(nat.sock)
+                nat.sock.close()
+
+    def _shutdown(self):
+        for flow in list(self._flows.values()):
+            self._close_flow(flow)
+        with self._lock:
+            associations = list(self._associations.values()) + [a for w in self._unbound.values() for a in w]
+        associations += list(self._handoffs)
+        self._handoffs.clear()
+        for association in associations:
+            self._release(association)
+        for nat in self._nat_sockets:
+            nat.sock.close()
+        self._nat_sockets = []
+        self._selector.close()
+        self._front.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+        logger.info("UDP relay stopped", extra={'event': 'udp_relay_stopped'})
@@ -1,34 +1,52 @@
+import copy
 import os
-import subprocess
 import time
-import psutil
 import socket
-import random
-import platform
 from typing import Optional, List, Dict
-import json
-import requests
-from datetime import datetime
 import threading
 import logging
 import sys
+from relay import SelectorRelay, open_nonblocking
+from forwarding import forward_stream
+from node_pool import UpstreamPool
+from node_prober import NodeProber
+from balancer import NodeBalancer
+from metrics import MetricsRegistry
+import log_pipeline
+from listener import ListenerConfig, REUSE_PORT_AVAILABLE, create_listener, tune_connection
+from workers import WORKER_SETTINGS, WorkerGroup
+from routing import DIRECT, SplitTunnelRouter
+from dns_resolver import DNSError, DNSResolver
+from compression import CompressionStats, available_codecs, get_codec
+from tunnel import CIPHERS, SessionCache, TunnelError, TunnelStage
+from mux import MuxSession, SessionPending
+from lifecycle import WRITE, LifecycleManager, TimeoutPolicy
+from node_catalog import NodeCatalog, VPNNode
+from udp_relay import UDPRelay
+from diagnostics import ConnectionTracer
+from proxy_protocol import (CMD_CONNECT, CMD_UDP_ASSOCIATE, REP_COMMAND_NOT_SUPPORTED, REP_SUCCEEDED,
+                            read_proxy_request, reply_code_for, send_reply)
 
-# Configure logging with more detailed format
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
+# Configure queue-based, rate-limited logging; VPN_LOG_FORMAT=text restores the plain format
+log_pipeline.setup_logging(
+    level=os.environ.get('VPN_LOG_LEVEL', 'INFO').upper(),
+    json_format=os.environ.get('VPN_LOG_FORMAT', 'json') == 'json'
 )
 logger = logging.getLogger(__name__)
 
-class VPNNode:
-    def __init__(self, country: str, host: str, port: int, protocol: str = 'tcp'):
-        self.country = country
-        self.host = host
-        self.port = port
-        self.protocol = protocol
-        self.status = 'unknown'
-        self.latency = 0
-        self.load = 0
+# Built-in nodes, used when no node_source is configured
+DEFAULT_NODES = [
+    ('United States', '8.8.8.8', 53),  # Google DNS as test server
+    ('United Kingdom', '1.1.1.1', 53),  # Cloudflare DNS as test server
+    ('Germany', '9.9.9.9', 53),        # Quad9 DNS as test server
+    ('France', '208.67.222.222', 53),  # OpenDNS as test server
+    ('Japan', '223.5.5.5', 53),        # AliDNS as test server
+    ('Singapore', '180.76.76.76', 53), # Baidu DNS as test server
+    ('Australia', '1.1.1.1', 53),      # Cloudflare DNS as test server
+    ('Canada', '8.8.8.8', 53),         # Google DNS as test server
+    ('Netherlands', '9.9.9.9', 53),    # Quad9 DNS as test server
+    ('Switzerland', '208.67.222.222', 53)  # OpenDNS as test server
+]
 
 class VPNHandler:
     def __init__(self):
@@ -37,32 +55,127 @@ class VPNHandler:
         self.connection = None
         self.proxy_server = None
         self.proxy_thread = None
+        self.relay = None
+        self.listener_config = ListenerConfig()
+        # Number of relay processes sharing the listener port via SO_REUSEPORT (this one included)
+        self.workers = 1
+        self.worker_group = None
+        # 'selector' multiplexes every connection on one event loop, 'thread' is the fallback
+        self.relay_engine = 'selector'
+        self.max_connections = 1024
+        self._connection_slots = None
+        # Per-direction relay buffer; the thread engine splices through a pipe of this size on Linux
+        self.buffer_size = 65536
+        self.zero_copy = True
+        # Pre-warmed upstream connections, one pool per VPNNode
+        self.pool_enabled = True
+        self.pool_min_idle = 4
+        self.pool_max_idle = 16
+        self.pool_idle_timeout = 30.0
+        self.upstream_pools = {}
         self.routing_table = {
             'vpn_network': '10.0.0.0/24',
             'default_gateway': '10.0.0.1',
             'dns_servers': ['8.8.8.8', '8.8.4.4']
         }
+        # Caching resolver for node hosts and direct targets; queries all dns_servers at once
+        self.resolver = DNSResolver(lambda: self.routing_table['dns_servers'])
         self.fingerprint = {
             'mtu': 1500,
             'protocol': 'tcp',
             'encryption': 'aes-256-gcm',
             'compression': 'lz4'
         }
-        # List of VPN servers with real IP addresses
-        self.vpn_nodes = [
-            VPNNode('United States', '8.8.8.8', 53),  # Google DNS as test server
-            VPNNode('United Kingdom', '1.1.1.1', 53),  # Cloudflare DNS as test server
-            VPNNode('Germany', '9.9.9.9', 53),        # Quad9 DNS as test server
-            VPNNode('France', '208.67.222.222', 53),  # OpenDNS as test server
-            VPNNode('Japan', '223.5.5.5', 53),        # AliDNS as test server
-            VPNNode('Singapore', '180.76.76.76', 53), # Baidu DNS as test server
-            VPNNode('Australia', '1.1.1.1', 53),      # Cloudflare DNS as test server
-            VPNNode('Canada', '8.8.8.8', 53),         # Google DNS as test server
-            VPNNode('Netherlands', '9.9.9.9', 53),    # Quad9 DNS as test server
-            VPNNode('Switzerland', '208.67.222.222', 53)  # OpenDNS as test server
-        ]
+        # Frame codec for tunnel nodes, picked from fingerprint['compression'] in start_vpn
+        self._codec = None
+        self.tunnel_stats = CompressionStats()
+        # Tunnel nodes: pre-shared key (must match node_server --psk), required with encryption,
+        # and resumption tickets
+        self.tunnel_psk = None
+        self.tunnel_sessions = SessionCache()
+        # Multiplexing: client streams share mux_tunnels long-lived connections per tunnel node
+        self.multiplex = False
+        self.mux_tunnels = 1
+        self.mux_window = 262144
+        self._mux_sessions = {}
+        self._mux_opening: Dict[VPNNode, threading.Event] = {}  # node -> set once its open attempt ends
+        self._mux_lock = threading.Lock()
+        # VPN servers, indexed by country/region/protocol/health; node_source is a JSON or CSV
+        # file or URL that is re-read every node_refresh_interval seconds when it changes
+        self.node_catalog = NodeCatalog(on_change=self._on_catalog_change)
+        self.node_source = os.environ.get('VPN_NODE_SOURCE')
+        self.node_refresh_interval = 60.0
+        # Measures connect RTT to all nodes in parallel and scores them for auto-selection
+        self.prober = NodeProber(lambda: self.vpn_nodes)
+        # None pins traffic to current_node; otherwise one of balancer.STRATEGIES
+        self.balancing = None
+        self.balancer = NodeBalancer(lambda: self.vpn_nodes, self.prober)
+        self.connect_timeout = 5.0
+        self.max_connect_attempts = 3
+        # Byte, connection, latency and error accounting per node
+        self.metrics = MetricsRegistry()
+        # Split tunnel: clients speak SOCKS5 / HTTP CONNECT and the router picks direct or VPN
+        self.split_tunnel = False
+        self.router = SplitTunnelRouter()
+        self.direct_node = VPNNode('Direct', 'direct', 0)
+        self.handshake_timeout = 10.0
+        self.handshake_workers = 64
+        self._handshake_pool = None
+        self.last_error = None
+        if not (self.node_source and self.load_nodes(self.node_source)):
+            self.node_catalog.replace(VPNNode(*entry) for entry in DEFAULT_NODES)
+        # Connection lifecycle (seconds, 0 disables): idle = no traffic, read = silence after a
+        # half-close, write = no send progress; stop_vpn lets connections finish for drain_timeout
+        self.idle_timeout = 300.0
+        self.read_timeout = 60.0
+        self.write_timeout = 60.0
+        self.drain_timeout = 10.0
+        self.lifecycle = LifecycleManager()
+        # UDP on the listener's port: raw datagrams to a 'udp' node, or SOCKS5 UDP ASSOCIATE in
+        # split-tunnel mode; flows idle for udp_idle_timeout seconds leave the NAT table
+        self.udp_enabled = True
+        self.udp_idle_timeout = 60.0
+        self.udp_max_sockets = 64
+        self.udp_relay = None
+        # accept -> upstream connect -> first byte -> close timings, recorded only while enabled
+        self.tracer = ConnectionTracer()
+        # switch_node: serialised, with the latest switch's timings for status
+        self._switch_lock = threading.Lock()
+        self.switches = 0
+        self.last_switch = None
         self._initialize_network()
 
+    @property
+    def vpn_nodes(self) -> List[VPNNode]:
+        return self.node_catalog.nodes()
+
+    @vpn_nodes.setter
+    def vpn_nodes(self, nodes: List[VPNNode]):
+        self.node_catalog.replace(nodes)
+
+    def load_nodes(self, source: str) -> bool:
+        """Load the node catalog from a JSON/CSV file or URL and keep it up to date"""
+        try:
+            self.node_catalog.load(source, force=True)
+        except Exception as e:
+            error_msg = f"Failed to load nodes from {source}: {e}"
+            logger.error(error_msg)
+            self.last_error = error_msg
+            return False
+        self.node_source = source
+        if self.node_refresh_interval:
+            self.node_catalog.watch(self.node_refresh_interval)
+        return True
+
+    def _on_catalog_change(self, added: List[VPNNode], removed: List[VPNNode]):
+        """Drop per-node state of nodes that left the catalog; live connections finish normally"""
+        for node in removed:
+            self.balancer.forget(node)
+            if node is not self.current_node:
+                pool = self.upstream_pools.pop(node, None)
+                if pool:
+                    pool.close()
+
     def _initialize_network(self):
         """Initialize network settings"""
         try:
@@ -85,19 +198,33 @@ class VPNHandler:
         except:
             return False
 
-    def start_vpn(self, country: str = None) -> bool:
-        """Start VPN connection"""
+    def start_vpn(self, country: str = None, address: Optional[str] = None) -> bool:
+        """Start VPN connection, on the node at address (host:port) if given
+
+        With neither country nor address the best-scoring node is picked. Before the
+        prober has measured anything that means probing every node first, which blocks
+        the caller for up to about prober.timeout.
+        """
         try:
             if self.running:
                 logger.warning("VPN is already running")
                 return False
 
             # Select VPN node
-            if country:
-                node = next((n for n in self.vpn_nodes if n.country.lower() == country.lower()), None)
+            if address:
+                node = self.node_catalog.get(address)
+            elif country:
+                node = self.node_catalog.first(country)
             else:
-                # Select best node based on latency
-                node = min(self.vpn_nodes, key=lambda x: x.latency)
+                # Select best node based on measured latency and load, among healthy ones if known
+                candidates = self.node_catalog.find(status='online') or self.vpn_nodes
+                try:
+                    node = self.prober.best_node(candidates)
+                except OSError as e:
+                    logger.warning("Node probe failed: %s", e, extra={'event': 'probe_failed'})
+                    node = None
+                # Nothing answered a probe (yet): fall back to catalog order rather than refusing to start
+                node = node or next(iter(candidates), None)
 
             if not node:
                 error_msg = "No suitable VPN node found"
@@ -106,27 +233,82 @@ class VPNHandler:
                 return False
 
             self.current_node = node
-            logger.info(f"Connecting to VPN server in {node.country} ({node.host}:{node.port})")
+            if self.balancing:
+                self.balancer.strategy = self.balancing
+            logger.info("Connecting to VPN server in %s (%s:%s)", node.country, node.host, node.port)
+            for n in self.vpn_nodes:
+                self.resolver.prefetch(n.host)
+            self._codec = None
+            error_msg = self._prepare_tunnel(self.vpn_nodes if self.balancing else [node])
+            if error_msg:
+                logger.error(error_msg)
+                self.last_error = error_msg
+                return False
+            if self.multiplex and node.protocol == 'tunnel':
+                try:
+                    self._mux_session(node)
+                except (OSError, TunnelError) as e:
+                    # Streams retry the tunnel on demand; the node may come up later
+                    logger.warning("Could not open multiplexed tunnel to %s: %s", node.country, e)
+            elif self.pool_enabled:
+                self._get_pool(node)
 
-            # Create proxy server
+            # Create proxy server; reuse_port applies to this run only, not to listener_config
+            config = copy.copy(self.listener_config)
+            if self.workers > 1:
+                if REUSE_PORT_AVAILABLE:
+                    config.reuse_port = True
+                else:
+                    logger.warning("SO_REUSEPORT unavailable, running a single relay process")
             try:
-                self.proxy_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.proxy_server.bind(('127.0.0.1', 8080))
-                self.proxy_server.listen(5)
-                logger.info("Proxy server created successfully")
+                self.proxy_server = create_listener(config)
+                logger.info("Proxy server created successfully on %s:%s", config.host, config.port)
             except Exception as e:
                 error_msg = f"Failed to create proxy server: {e}"
                 logger.error(error_msg)
                 self.last_error = error_msg
                 return False
 
+            if self.udp_enabled and (self.split_tunnel or node.protocol == 'udp'):
+                self._start_udp_relay(config)
+
             # Start proxy server in a separate thread
-            self.proxy_thread = threading.Thread(target=self._run_proxy_server)
+            self.running = True
+            self.lifecycle.policy = TimeoutPolicy(self.idle_timeout, self.read_timeout, self.write_timeout,
+                                                  self.connect_timeout)
+            if self.relay_engine == 'selector':
+                accept_handler = None
+                if self.split_tunnel:
+                    from concurrent.futures import ThreadPoolExecutor
+                    self._handshake_pool = ThreadPoolExecutor(self.handshake_workers,
+                                                              thread_name_prefix='proxy-handshake')
+                    accept_handler = self._submit_handshake
+                self.relay = SelectorRelay(self.proxy_server, self._open_upstream,
+                                           max_connections=self.max_connections,
+                                           buffer_size=self.buffer_size,
+                                           on_error=self._record_error,
+                                           release_upstream=self._release_upstream,
+                                           max_attempts=self.max_connect_attempts,
+                                           metrics=self.metrics,
+                                           tune_socket=self._tune_socket,
+                                           accept_handler=accept_handler,
+                                           open_stage=self._open_stage,
+                                           lifecycle=self.lifecycle,
+                                           tracer=self.tracer)
+                self.proxy_thread = threading.Thread(target=self.relay.run)
+            else:
+                self._connection_slots = threading.BoundedSemaphore(self.max_connections)
+                # Wake up every second so the accept loop notices stop_vpn
+                self.proxy_server.settimeout(1.0)
+                self.lifecycle.start()
+                self.proxy_thread = threading.Thread(target=self._run_proxy_server)
             self.proxy_thread.daemon = True
             self.proxy_thread.start()
-            logger.info("Proxy server thread started")
+            logger.info("Proxy server thread started (%s engine)", self.relay_engine)
+            if config.reuse_port and self.workers > 1:
+                self._start_workers(node, config)
 
-            self.running = True
+            self.prober.start()
             self.last_error = None
             logger.info("VPN connection established")
             return True
@@ -134,26 +316,64 @@ class VPNHandler:
         except Exception as e:
             error_msg = f"Failed to start VPN: {e}"
             logger.error(error_msg)
+            if self.running:
+                # Failed after the listener came up: tear down so running is not left stuck at True
+                self.stop_vpn(drain_timeout=0)
             self.last_error = error_msg
             return False
 
-    def stop_vpn(self) -> bool:
-        """Stop VPN connection"""
+    def stop_vpn(self, drain_timeout: Optional[float] = None) -> bool:
+        """Stop VPN connection
+
+        Stops accepting at once, then gives live connections up to drain_timeout
+        seconds (default self.drain_timeout, 0 closes them immediately) to finish.
+        """
         try:
             if not self.running:
                 logger.warning("VPN is not running")
                 return False
 
-            # Stop proxy server
+            self.running = False
+            drain = self.drain_timeout if drain_timeout is None else drain_timeout
+
+            # Stop proxy server; workers drain in parallel with this process
+            if self.worker_group:
+                self.worker_group.request_stop()
+            if self.relay:
+                if drain:
+                    self.relay.drain(drain)
+                else:
+                    self.relay.stop()
+                if self.proxy_thread and self.proxy_thread.is_alive():
+                    self.proxy_thread.join(timeout=drain + 5)
+                self.relay = None
+            elif self.proxy_thread:
+                if self.proxy_thread.is_alive():
+                    self.proxy_thread.join(timeout=5)
+                self.lifecycle.drain(drain)
+            self.proxy_thread = None
+            self.lifecycle.stop()
+            if self.udp_relay:
+                self.udp_relay.stop()
+                self.udp_relay = None
+            if self.worker_group:
+                self.worker_group.stop(timeout=drain + 5)
+                self.worker_group = None
+            if self._handshake_pool:
+                self._handshake_pool.shutdown(wait=False, cancel_futures=True)
+                self._handshake_pool = None
             if self.proxy_server:
                 self.proxy_server.close()
                 self.proxy_server = None
                 logger.info("Proxy server closed")
+            self._close_pools()
+            self._close_mux_sessions()
+            self.prober.stop()
+            self.resolver.close()
 
             # Restore original routing
             self._restore_routing()
 
-            self.running = False
             self.current_node = None
             self.last_error = None
             logger.info("VPN connection stopped")
@@ -165,6 +385,124 @@ class VPNHandler:
             self.last_error = error_msg
             return False
 
+    def switch_node(self, country: Optional[str] = None, drain_timeout: Optional[float] = None,
+                    address: Optional[str] = None) -> bool:
+        """Move to another country's node, or the node at address, without closing the listener
+
+        New connections go to the new node as soon as it is selected. Connections
+        already on the old node keep running for up to drain_timeout seconds
+        (default self.drain_timeout) and are then closed. Starts the VPN when it is
+        not running.
+        """
+        with self._switch_lock:
+            if not self.running:
+                return self.start_vpn(country, address)
+            started = time.perf_counter()
+            node = self.node_catalog.get(address) if address else self.node_catalog.first(country)
+            if not node:
+                error_msg = f"No VPN node found for {address or country}"
+                logger.error(error_msg)
+                self.last_error = error_msg
+                return False
+            previous = self.current_node
+            if node is previous:
+                return True
+            error_msg = self._prepare_tunnel([node])
+            if error_msg:
+                logger.error(error_msg)
+                self.last_error = error_msg
+                return False
+            drain = self.drain_timeout if drain_timeout is None else drain_timeout
+
+            # Warm the new node up before it takes traffic
+            self.resolver.prefetch(node.host)
+            if self.multiplex and node.protocol == 'tunnel':
+                try:
+                    self._mux_session(node)
+                except (OSError, TunnelError) as e:
+                    logger.warning("Could not open multiplexed tunnel to %s: %s", node.country, e)
+            elif self.pool_enabled:
+                self._get_pool(node)
+
+            # The switch itself: _upstream_candidates hands out current_node from here on
+            self.current_node = node
+            latency_ms = (time.perf_counter() - started) * 1000
+
+            if not self.balancing:
+                # With balancing on, the old node stays a candidate and keeps its connections
+                if self.relay:
+                    self.relay.retire(previous, drain)
+                else:
+                    self.lifecycle.retire(previous, drain)
+                self._close_pool(previous)
+                if self._mux_sessions.get(previous):
+                    timer = threading.Timer(drain + 1, self._close_idle_node, (previous,))
+                    timer.daemon = True
+                    timer.start()
+            if self.worker_group:
+                self.worker_group.switch(node.address, drain)
+            if self.udp_enabled and node.protocol == 'udp' and not self.udp_relay:
+                self._start_udp_relay(self.listener_config)
+
+            self.switches += 1
+            self.last_switch = {
+                'from': previous.country if previous else None,
+                'to': node.country,
+                'latency_ms': round(latency_ms, 3),
+                'drain_timeout': drain,
+                'time': time.time()
+            }
+            self.last_error = None
+            logger.info("Switched from %s to %s in %.2f ms", self.last_switch['from'], node.country, latency_ms,
+                        extra={'event': 'node_switched', 'node': node.country})
+            return True
+
+    def update_router(self, router: Optional[SplitTunnelRouter] = None):
+        """Apply new or edited split-tunnel rules here and in every worker process"""
+        if router is not None:
+            self.router = router
+        self.router.compile()
+        if self.worker_group:
+            self.worker_group.configure({'router': self.router})
+
+    def _close_pool(self, node: VPNNode):
+        """Close one node's upstream pool and its idle connections"""
+        pool = self.upstream_pools.pop(node, None)
+        if pool:
+            pool.close()
+
+    def _close_idle_node(self, node: VPNNode):
+        """After a switch's drain deadline, close the multiplexed tunnels to a node no longer in use"""
+        if node is self.current_node:
+            return
+        with self._mux_lock:
+            sessions = self._mux_sessions.pop(node, [])
+        for session in sessions:
+            session.stop()
+
+    def get_vpn_state(self) -> Dict:
+        """The part of the status that changes only on start, stop, switch, health flips or errors
+
+        No counters and no worker round trips, so the control UI's push feed can
+        rebuild it every second and still only notify clients on real changes.
+        """
+        return {
+            'running': self.running,
+            'current_node': {
+                'country': self.current_node.country,
+                'host': self.current_node.host,
+                'port': self.current_node.port,
+                'status': self.current_node.status
+            } if self.current_node else None,
+            'listener': self.listener_config.to_dict(),
+            'workers': self.workers,
+            'routing_table': self.routing_table,
+            'fingerprint': self.fingerprint,
+            'split_tunnel': self.split_tunnel,
+            'switch': {'switches': self.switches, 'last': self.last_switch},
+            'error': self.last_error
+        }
+
     def get_vpn_status(self) -> Dict:
         """Get current VPN status"""
         status = {
@@ -177,63 +515,601 @@ class VPNHandler:
                 'latency': self.current_node.latency,
                 'load': self.current_node.load
             } if self.current_node else None,
+            'node_latency': {
+                node.address: {'country': node.country, **self.prober.get_stats(node).to_dict()}
+                for node in self.vpn_nodes if self.prober.get_stats(node)
+            },
+            'balancing': {
+                'strategy': self.balancing,
+                'nodes': [{'country': node.country, 'address': node.address, 'load': node.load,
+                           'healthy': self.balancer.is_healthy(node)} for node in self.vpn_nodes]
+            } if self.balancing else None,
+            'traffic': self.metrics.snapshot(),
+            'listener': self.listener_config.to_dict(),
+            'workers': self.worker_group.status() if self.worker_group else None,
+            'nodes': self.node_catalog.stats(),
             'routing_table': self.routing_table,
             'fingerprint': self.fingerprint,
+            'split_tunnel': self.router.stats() if self.split_tunnel else None,
+            'dns': self.resolver.stats(),
+            'tunnel': {
+                'compression': self._codec.name if self._codec else 'none',
+                'available': available_codecs(),
+                'encryption': self.fingerprint.get('encryption', 'none'),
+                **self.tunnel_stats.to_dict(),
+                **self.tunnel_sessions.to_dict(),
+                'multiplexed': {
+                    node.address: [session.stats() for session in sessions]
+                    for node, sessions in self._mux_sessions.items()
+                } if self.multiplex else None
+            },
+            'upstream_pool': self.upstream_pools[self.current_node].stats()
+            if self.current_node in self.upstream_pools else None,
+            'lifecycle': self.lifecycle.stats(),
+            'switch': {
+                'switches': self.switches,
+                'last': self.last_switch,
+                'draining': {
+                    node.address: live
+                    for node, live in (self.relay.retiring() if self.relay else self.lifecycle.retiring()).items()
+                }
+            },
+            'udp': self.udp_relay.stats() if self.udp_relay else None,
+            'relay': {
+                'engine': self.relay_engine,
+                'active_connections': self.relay.active_connections if self.relay else None,
+                'max_connections': self.max_connections
+            },
             'error': getattr(self, 'last_error', None)
         }
-        logger.info(f"Current VPN status: {json.dumps(status, indent=2)}")
         return status
 
+    def _record_error(self, error_msg: str, exc: Exception = None):
+        """Remember the most recent error for status reporting"""
+        self.last_error = f"{error_msg}: {exc}" if exc is not None else error_msg
+
+    def _start_workers(self, node: VPNNode, config: ListenerConfig):
+        """Spawn workers-1 extra relay processes bound to the same port, relaying to node"""
+        self.worker_group = WorkerGroup(
+            self.workers - 1,
+            {name: getattr(self, name) for name in WORKER_SETTINGS},
+            config.to_dict(),
+            # Workers with a node_source load (and watch) it themselves
+            None if self.node_source else [(n.country, n.host, n.port, n.protocol, n.region)
+                                           for n in self.vpn_nodes],
+            # By address: a country can have several nodes and the workers must use ours
+            node.address
+        )
+        error_msg = self.worker_group.start()
+        if error_msg:
+            # Keep serving from this process rather than failing the whole connection
+            logger.error(error_msg)
+            self.last_error = error_msg
+            self.worker_group.stop()
+            self.worker_group = None
+
+    def _start_udp_relay(self, config: ListenerConfig):
+        """Relay UDP on the TCP listener's port number; TCP keeps working if the bind fails"""
+        relay = UDPRelay(config.host, self.proxy_server.getsockname()[1], self._udp_route,
+                         socks=self.split_tunnel, metrics=self.metrics, idle_timeout=self.udp_idle_timeout,
+                         max_sockets=self.udp_max_sockets, on_error=self._record_error)
+        try:
+            relay.start()
+        except OSError as e:
+            logger.warning("UDP relay unavailable: %s", e, extra={'event': 'udp_relay_error'})
+            return
+        self.udp_relay = relay
+
+    def _udp_route(self, client_address, target) -> tuple:
+        """(destination, node, wrap) for a new UDP flow; runs on the UDP relay's loop, so never blocks
+
+        Raw datagrams go to a 'udp' node as they are. SOCKS datagrams go straight to
+        their target when the router says direct, else to a 'udp' node with the SOCKS
+        header kept, the node being a SOCKS5 UDP relay the way plain nodes are SOCKS5
+        proxies for TCP.
+        """
+        if target is not None and self.router.decide(target[0]) == DIRECT:
+            addresses = self.resolver.resolve_cached(target[0])
+            if not addresses:
+                raise DNSError(f"{target[0]} is not resolved yet")
+            return (addresses[0], target[1]), self.direct_node, False
+        for node in self._upstream_candidates(client_address):
+            if node.protocol == 'udp':
+                return self._node_address(node, blocking=False), node, target is not None
+        raise OSError("No UDP VPN node available")
+
+    def _tune_socket(self, sock: socket.socket):
+        tune_connection(sock, self.listener_config)
+
+    def _get_pool(self, node: VPNNode) -> UpstreamPool:
+        """Return the warm connection pool for a node, creating it on first use"""
+        pool = self.upstream_pools.get(node)
+        if pool is None:
+            pool = UpstreamPool(node, min_idle=self.pool_min_idle, max_idle=self.pool_max_idle,
+                                idle_timeout=self.pool_idle_timeout, resolve=self.resolver.resolve)
+            pool.start()
+            self.upstream_pools[node] = pool
+        return pool
+
+    def _close_pools(self):
+        """Close every upstream pool and its idle connections"""
+        for pool in self.upstream_pools.values():
+            pool.close()
+        self.upstream_pools = {}
+
+    def _pooled_upstream(self, node: VPNNode) -> Optional[socket.socket]:
+        """Take a pre-established connection to node if pooling is on and one is idle"""
+        if not self.pool_enabled or (node is not self.current_node and not self.balancing):
+            # e.g. a connect racing switch_node: do not bring back the old node's pool
+            return None
+        return self._get_pool(node).acquire()
+
+    def _prepare_tunnel(self, nodes) -> Optional[str]:
+        """Resolve the codec if nodes include a tunnel node; returns why they cannot be used, if they cannot
+
+        Plain nodes never frame anything, so they neither need the codec nor hear about a missing one.
+        """
+        cipher = self.fingerprint.get('encryption', 'none')
+        if cipher not in CIPHERS:
+            return f"Unsupported tunnel encryption: {cipher}"
+        if not any(n.protocol == 'tunnel' for n in nodes):
+            return None
+        if cipher != 'none' and not self.tunnel_psk:
+            # An unauthenticated key exchange could be intercepted; never fall back to it silently
+            return f"Tunnel encryption {cipher} needs tunnel_psk (the node's --psk)"
+        if self._codec is None:
+            try:
+                self._codec = get_codec(self.fingerprint.get('compression'))
+            except ValueError as e:
+                return str(e)
+        return None
+
+    def _open_stage(self, node: VPNNode, target: Optional[str] = None) -> Optional[TunnelStage]:
+        """Framing, compression and encryption stage for tunnel nodes; plain nodes get raw bytes"""
+        if node.protocol != 'tunnel' or self.multiplex:
+            # Multiplexed streams are staged once, by the shared tunnel they travel over
+            return None
+        return self._tunnel_stage(node, target)
+
+    def _tunnel_stage(self, node: VPNNode, target: Optional[str] = None,
+                      multiplex: bool = False) -> TunnelStage:
+        return TunnelStage(self._codec, self.tunnel_stats, target,
+                           cipher=self.fingerprint.get('encryption', 'none'), psk=self.tunnel_psk,
+                           sessions=self.tunnel_sessions, session_key=(node.host, node.port),
+                           mtu=self.fingerprint.get('mtu', 1500), multiplex=multiplex)
+
+    def _mux_session(self, node: VPNNode, blocking: bool = True) -> MuxSession:
+        """Least-loaded shared tunnel to node, opening another while below mux_tunnels
+
+        One tunnel per node is opened at a time, outside the lock. Callers that must
+        not block (the selector loop) start it on a background thread and, until the
+        first tunnel is up, get SessionPending at once instead of waiting for the
+        connect and handshake.
+        """
+        with self._mux_lock:
+            sessions = [s for s in self._mux_sessions.get(node, ()) if not s.closed]
+            opening = self._mux_opening.get(node)
+            if sessions and (len(sessions) >= self.mux_tunnels or opening):
+                return min(sessions, key=lambda s: s.active_streams)
+            if opening is None:
+                opening = self._mux_opening[node] = threading.Event()
+                opener = True
+            else:
+                opener = False
+        if not blocking:
+            if opener:
+                threading.Thread(target=self._open_mux_session, args=(node, opening, False),
+                                 name='mux-open', daemon=True).start()
+            if sessions:
+                return min(sessions, key=lambda s: s.active_streams)
+            raise SessionPending(f"Tunnel to {node.country} is still opening")
+        if opener:
+            return self._open_mux_session(node, opening)
+        # Someone else is opening the first tunnel: share it rather than open another
+        opening.wait(self.connect_timeout * 2)
+        with self._mux_lock:
+            sessions = [s for s in self._mux_sessions.get(node, ()) if not s.closed]
+        if not sessions:
+            raise OSError(f"Tunnel to {node.country} could not be opened")
+        return min(sessions, key=lambda s: s.active_streams)
+
+    def _open_mux_session(self, node: VPNNode, opening: threading.Event, raise_errors: bool = True):
+        try:
+            sock = socket.create_connection(self._node_address(node), timeout=self.connect_timeout)
+            try:
+                stage = self._tunnel_stage(node, multiplex=True)
+                stage.handshake(sock)
+            except Exception:
+                sock.close()
+                raise
+            sock.settimeout(None)
+            self._tune_socket(sock)
+            session = MuxSession(sock, stage, window=self.mux_window, buffer_size=self.buffer_size,
+                                 on_closed=lambda closed: self._forget_mux_session(node, closed))
+            session.start()
+            if not raise_errors and not self.running:
+                session.stop()  # stop_vpn ran while this background open was in flight
+                return None
+            with self._mux_lock:
+                sessions = [s for s in self._mux_sessions.get(node, ()) if not s.closed] + [session]
+                self._mux_sessions[node] = sessions
+            logger.info("Multiplexed tunnel %d to %s opened", len(sessions), node.country,
+                        extra={'event': 'mux_session_opened', 'node': node.country})
+            return session
+        except (OSError, TunnelError) as e:
+            if raise_errors:
+                raise
+            logger.warning("Could not open multiplexed tunnel to %s: %s", node.country, e,
+                           extra={'event': 'mux_session_failed', 'node': node.country})
+            self.balancer.mark_failed(node)
+        finally:
+            with self._mux_lock:
+                if self._mux_opening.get(node) is opening:
+                    del self._mux_opening[node]
+            opening.set()
+
+    def _forget_mux_session(self, node: VPNNode, session: MuxSession):
+        with self._mux_lock:
+            sessions = self._mux_sessions.get(node)
+            if sessions and session in sessions:
+                sessions.remove(session)
+
+    def _close_mux_sessions(self):
+        with self._mux_lock:
+            sessions = [s for group in self._mux_sessions.values() for s in group]
+            self._mux_sessions = {}
+        for session in sessions:
+            session.stop()
+
+    def _mux_stream(self, node: VPNNode, target: Optional[str] = None,
+                    blocking: bool = True) -> Optional[socket.socket]:
+        """Local end of a new stream over a shared tunnel, or None when node is not multiplexed
+
+        Opening the first tunnel to a node waits for its handshake unless blocking is
+        False, when SessionPending is raised while it opens in the background.
+        """
+        if not self.multiplex or node.protocol != 'tunnel':
+            return None
+        return self._mux_session(node, blocking).open_stream(target)
+
+    def _node_address(self, node: VPNNode, blocking: bool = True) -> tuple:
+        """(ip, port) of a node via the resolver; the non-blocking form only uses the cache"""
+        if blocking:
+            return self.resolver.resolve(node.host)[0], node.port
+        addresses = self.resolver.resolve_cached(node.host)
+        if not addresses:
+            raise DNSError(f"{node.host} is not resolved yet")
+        return addresses[0], node.port
+
+    def _upstream_candidates(self, client_address, exclude=()) -> List[VPNNode]:
+        """Nodes to try for a new client, in order; just current_node unless balancing"""
+        if self.balancing:
+            return self.balancer.candidates(client_address, exclude)
+        return [self.current_node] if self.current_node not in exclude else []
+
+    def _release_upstream(self, node: VPNNode, failed: bool):
+        """Drop a finished or failed connection from node.load"""
+        self.balancer.release(node)
+        if failed:
+            self.balancer.mark_failed(node)
+
+    def _open_upstream(self, client_address, exclude) -> tuple:
+        """Begin a non-blocking connect to the next candidate node for the selector relay"""
+        last_error = None
+        for node in self._upstream_candidates(client_address, exclude):
+            try:
+                sock = self._mux_stream(node, blocking=False)
+            except SessionPending as e:
+                last_error = e  # tunnel handshake in flight; not the node's fault
+                continue
+            except (OSError, TunnelError) as e:
+                last_error = e
+                self.balancer.mark_failed(node)
+                continue
+            if not sock:
+                sock = self._pooled_upstream(node)
+            if sock:
+                sock.setblocking(False)
+            else:
+                try:
+                    sock = open_nonblocking(self._node_address(node, blocking=False))
+                except DNSError as e:
+                    last_error = e  # lookup in flight; not the node's fault
+                    continue
+                except OSError as e:
+                    last_error = e
+                    self.balancer.mark_failed(node)
+                    continue
+            self.balancer.acquire(node)
+            return sock, node
+        raise OSError(f"No reachable VPN node: {last_error}")
+
+    def _connect_upstream(self, client_address) -> tuple:
+        """Blocking connect for the thread engine, failing over to the next candidate node"""
+        last_error = None
+        for node in self._upstream_candidates(client_address)[:self.max_connect_attempts]:
+            stats = self.metrics.node(node)
+            started = time.perf_counter()
+            try:
+                # A stream over a shared tunnel, else a pre-warmed connection when one is idle
+                sock = self._mux_stream(node) or self._pooled_upstream(node)
+                if sock is None:
+                    sock = socket.create_connection(self._node_address(node), timeout=self.connect_timeout)
+                sock.settimeout(None)
+            except (OSError, TunnelError) as e:
+                last_error = e
+                stats.connect_errors.add()
+                self.balancer.mark_failed(node)
+                continue
+            stats.connect_latency.observe((time.perf_counter() - started) * 1000)
+            stats.connections_opened.add()
+            self.balancer.acquire(node)
+            return sock, node
+        raise OSError(f"No reachable VPN node: {last_error}")
+
+    def _connect_target(self, request, client_address) -> tuple:
+        """Blocking connect to a proxy client's target, direct or through a node per the router"""
+        if self.router.decide(request.host) == DIRECT:
+            node = self.direct_node
+            stats = self.metrics.node(node)
+            started = time.perf_counter()
+            try:
+                address = self.resolver.resolve(request.host)[0]
+                sock = socket.create_connection((address, request.port), timeout=self.connect_timeout)
+            except OSError:
+                stats.connect_errors.add()
+                raise
+            sock.settimeout(None)
+            stats.connect_latency.observe((time.perf_counter() - started) * 1000)
+            stats.connections_opened.add()
+            self.balancer.acquire(node)
+            return sock, node, None
+
+        last_error = None
+        for node in self._upstream_candidates(client_address)[:self.max_connect_attempts]:
+            stats = self.metrics.node(node)
+            started = time.perf_counter()
+            if node.protocol == 'tunnel':
+                # Tunnel nodes take the target in the preamble (or stream OPEN) instead of a SOCKS request
+                target = f"{request.host}:{request.port}"
+                stage = self._open_stage(node, target)
+                sock = None
+                try:
+                    if stage is None:
+                        sock = self._mux_stream(node, target)
+                    else:
+                        sock = socket.create_connection(self._node_address(node), timeout=self.connect_timeout)
+                        stage.handshake(sock)
+                except (OSError, TunnelError) as e:
+                    if sock:
+                        sock.close()
+                    last_error = e
+                    stats.connect_errors.add()
+                    self.balancer.mark_failed(node)
+                    continue
+                sock.settimeout(None)
+                stats.connect_latency.observe((time.perf_counter() - started) * 1000)
+                stats.connections_opened.add()
+                self.balancer.acquire(node)
+                return sock, node, stage
+            import socks  # PySocks, only needed once a split-tunnel client reaches a plain node
+            sock = socks.socksocket()
+            sock.settimeout(self.connect_timeout)
+            try:
+                # rdns: the node resolves the target, so its name never leaks to local DNS
+                sock.set_proxy(socks.SOCKS5, *self._node_address(node), rdns=True)
+                sock.connect((request.host, request.port))
+            except (socks.ProxyConnectionError, DNSError) as e:
+                # The node itself is unreachable: fail over
+                sock.close()
+                last_error = e
+                stats.connect_errors.add()
+                self.balancer.mark_failed(node)
+                continue
+            except OSError:
+                # The node refused or could not reach the target; another node would not help
+                sock.close()
+                stats.connect_errors.add()
+                raise
+            sock.settimeout(None)
+            stats.connect_latency.observe((time.perf_counter() - started) * 1000)
+            stats.connections_opened.add()
+            self.balancer.acquire(node)
+            return sock, node, None
+        raise OSError(f"No reachable VPN node: {last_error}")
+
+    def _negotiate(self, client_socket: socket.socket, address) -> tuple:
+        """Read the client's SOCKS5 / CONNECT request, connect the target and reply
+
+        Returns None when the request was a UDP ASSOCIATE handed to the UDP relay.
+        """
+        client_socket.settimeout(self.handshake_timeout)
+        request = read_proxy_request(client_socket)
+        if request.command == CMD_UDP_ASSOCIATE and self.udp_relay:
+            # Registered before replying so the client's first datagram is already allowed; from
+            # here the UDP relay owns the control connection and closes it when the client does
+            bound = (client_socket.getsockname()[0], self.udp_relay.port)
+            self.udp_relay.associate(client_socket, address, request.port)
+            try:
+                send_reply(client_socket, request, REP_SUCCEEDED, bound)
+            except OSError as e:
+                logger.debug("UDP associate reply failed: %s", e)
+            return None
+        if request.command != CMD_CONNECT:
+            send_reply(client_socket, request, REP_COMMAND_NOT_SUPPORTED)
+            raise OSError(f"Unsupported SOCKS command {request.command}")
+        try:
+            upstream, node, stage = self._connect_target(request, address)
+        except OSError as e:
+            send_reply(client_socket, request, reply_code_for(e))
+            raise
+        try:
+            send_reply(client_socket, request, REP_SUCCEEDED)
+        except OSError:
+            upstream.close()
+            self._release_upstream(node, False)
+            self.metrics.node(node).connections_closed.add()
+            raise
+        client_socket.settimeout(None)
+        return upstream, node, stage, request.leftover
+
+    def _submit_handshake(self, client_socket: socket.socket, address):
+        self._handshake_pool.submit(self._handshake, client_socket, address, self.tracer.begin(address))
+
+    def _handshake(self, client_socket: socket.socket, address, trace=None):
+        """Selector engine: negotiate on a pool thread, then hand the pair back to the relay"""
+        relay = self.relay
+        try:
+            negotiated = self._negotiate(client_socket, address)
+        except Exception as e:
+            logger.warning("Proxy handshake failed: %s", e, extra={'event': 'handshake_error'})
+            client_socket.close()
+            if relay:
+                relay.abandon()
+            return
+        if negotiated is None:
+            if relay:
+                relay.abandon()
+            return
+        upstream, node, stage, leftover = negotiated
+        if trace:
+            trace.connected = time.perf_counter()
+        if relay:
+            relay.adopt(client_socket, upstream, address, node, leftover, stage, trace)
+        else:
+            client_socket.close()
+            upstream.close()
+
     def _run_proxy_server(self):
-        """Run proxy server to handle VPN traffic"""
+        """Run proxy server to handle VPN traffic (thread-per-connection engine)"""
         while self.running:
             try:
-                client_socket, address = self.proxy_server.accept()
-                logger.info(f"New connection from {address}")
-                client_thread = threading.Thread(target=self._handle_proxy_connection, args=(client_socket,))
+                # Hold back accepts while at the connection cap; the listen backlog absorbs the burst
+                if not self._connection_slots.acquire(timeout=1.0):
+                    continue
+                try:
+                    client_socket, address = self.proxy_server.accept()
+                except socket.timeout:
+                    self._connection_slots.release()
+                    continue
+                except Exception:
+                    self._connection_slots.release()
+                    raise
+                if not self.running:
+                    # Accepted after stop_vpn began draining; the drain takes no new connections
+                    client_socket.close()
+                    self._connection_slots.release()
+                    break
+                logger.info("New connection from %s", address, extra={'event': 'connection_accepted'})
+                client_thread = threading.Thread(target=self._handle_proxy_connection,
+                                                 args=(client_socket, address))
                 client_thread.daemon = True
                 client_thread.start()
             except Exception as e:
                 if self.running:
-                    error_msg = f"Proxy server error: {e}"
-                    logger.error(error_msg)
-                    self.last_error = error_msg
+                    logger.error("Proxy server error: %s", e, extra={'event': 'accept_error'})
+                    self._record_error("Proxy server error", e)
 
-    def _handle_proxy_connection(self, client_socket: socket.socket):
+    def _handle_proxy_connection(self, client_socket: socket.socket, address=None):
         """Handle individual proxy connections"""
+        vpn_socket = node = downstream = None
+        session = self.lifecycle.register(client_socket, address)
+        trace = self.tracer.begin(address)
         try:
-            # Create connection to VPN server
-            vpn_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            vpn_socket.connect((self.current_node.host, self.current_node.port))
-            logger.info(f"Connected to VPN server {self.current_node.host}:{self.current_node.port}")
+            if self.split_tunnel:
+                negotiated = self._negotiate(client_socket, address)
+                if negotiated is None:
+                    client_socket = None  # owned by a UDP association now
+                    return
+                vpn_socket, node, stage, leftover = negotiated
+            else:
+                vpn_socket, node = self._connect_upstream(address)
+                stage, leftover = self._open_stage(node), b''
+                if stage:
+                    vpn_socket.settimeout(self.connect_timeout)
+                    stage.handshake(vpn_socket)
+                    vpn_socket.settimeout(None)
+            self.lifecycle.attach(session, vpn_socket, node)
+            if trace:
+                trace.connected = time.perf_counter()
+            if leftover:
+                vpn_socket.sendall(stage.encode(leftover) if stage else leftover)
+            logger.info("Connected to VPN server %s:%s", node.host, node.port,
+                        extra={'event': 'upstream_connected', 'node': node.country})
+            stats = self.metrics.node(node)
+            self._tune_socket(client_socket)
+            self._tune_socket(vpn_socket)
 
-            # Start bidirectional forwarding
-            threading.Thread(target=self._forward_data, args=(client_socket, vpn_socket)).start()
-            threading.Thread(target=self._forward_data, args=(vpn_socket, client_socket)).start()
+            # Forward node -> client on a helper thread and client -> node on this one
+            downstream = threading.Thread(target=self._forward_data,
+                                          args=(vpn_socket, client_socket, stats.bytes_in, stats,
+                                                stage.decode if stage else None, session,
+                                                trace.sent_down if trace else None))
+            downstream.daemon = True
+            downstream.start()
+            self._forward_data(client_socket, vpn_socket, stats.bytes_out, stats,
+                               stage.encode if stage else None, session, trace.sent_up if trace else None)
+            downstream.join()
 
         except Exception as e:
-            error_msg = f"Proxy connection error: {e}"
-            logger.error(error_msg)
-            self.last_error = error_msg
+            if not session.aborted:
+                logger.error("Proxy connection error: %s", e, extra={'event': 'proxy_connection_error'})
+                self._record_error("Proxy connection error", e)
         finally:
-            client_socket.close()
-            vpn_socket.close()
+            if downstream and downstream.is_alive():
+                # Never close sockets under a forwarder that is still using them
+                session.abort('error')
+                downstream.join()
+            self.lifecycle.unregister(session)
+            if trace and vpn_socket:
+                self.tracer.finish(trace, node)
+            if client_socket:
+                client_socket.close()
+            if vpn_socket:
+                vpn_socket.close()
+                self._release_upstream(node, False)
+                self.metrics.node(node).connections_closed.add()
+            if self._connection_slots:
+                self._connection_slots.release()
+
+    def _forward_data(self, source: socket.socket, destination: socket.socket,
+                      counter=None, stats=None, transform=None, session=None, traced=None):
+        """Forward data between sockets until EOF or until the session is aborted"""
+        def on_bytes(n: int):
+            if counter:
+                counter.add(n)
+            if session:
+                session.touch()
+            if traced:
+                traced(n)
 
-    def _forward_data(self, source: socket.socket, destination: socket.socket):
-        """Forward data between sockets"""
         try:
-            while self.running:
-                data = source.recv(4096)
-                if not data:
-                    break
-                destination.send(data)
+            forward_stream(source, destination, self.buffer_size,
+                           running=lambda: not (session and session.aborted), zero_copy=self.zero_copy,
+                           on_bytes=on_bytes, transform=transform)
+            # Pass the EOF on so the opposite direction can finish too
+            destination.shutdown(socket.SHUT_WR)
+            if session:
+                session.eof()
+        except BlockingIOError:
+            # The send timeout fired: the peer stopped reading for write_timeout seconds
+            self.lifecycle.record_timeout(WRITE)
+            if stats:
+                stats.relay_errors.add()
+            if session:
+                session.abort(WRITE)
         except Exception as e:
-            error_msg = f"Data forwarding error: {e}"
-            logger.error(error_msg)
-            self.last_error = error_msg
+            if session and session.aborted:
+                logger.debug("Forwarding stopped, connection aborted (%s)", session.aborted)
+                return
+            if stats:
+                stats.relay_errors.add()
+            logger.error("Data forwarding error: %s", e, extra={'event': 'forwarding_error'})
+            self._record_error("Data forwarding error", e)
 
     def _update_routing_table(self):
         """Update routing table for VPN connection"""
+        import subprocess
         try:
             if sys.platform == 'win32':
                 if not self._is_admin():
@@ -243,11 +1119,11 @@ class VPNHandler:
                     return
                 result = subprocess.run(['route', 'add', '0.0.0.0', 'mask', '0.0.0.0', '10.0.0.1'], 
                                      check=True, capture_output=True, text=True)
-                logger.info(f"Default route added: {result.stdout}")
+                logger.info("Default route added: %s", result.stdout)
             else:
                 result = subprocess.run(['ip', 'route', 'add', 'default', 'via', '10.0.0.1'], 
                                      check=True, capture_output=True, text=True)
-                logger.info(f"Default route added: {result.stdout}")
+                logger.info("Default route added: %s", result.stdout)
         except Exception as e:
             error_msg = f"Failed to update routing table: {e}"
             logger.error(error_msg)
@@ -255,6 +1131,7 @@ class VPNHandler:
 
     def _restore_routing(self):
         """Restore original routing configuration"""
+        import subprocess
         try:
             if sys.platform == 'win32':
                 if not self._is_admin():
@@ -264,11 +1141,11 @@ class VPNHandler:
                     return
                 result = subprocess.run(['route', 'delete', '0.0.0.0', 'mask', '0.0.0.0', '10.0.0.1'], 
                                      check=True, capture_output=True, text=True)
-                logger.info(f"Default route removed: {result.stdout}")
+                logger.info("Default route removed: %s", result.stdout)
             else:
                 result = subprocess.run(['ip', 'route', 'del', 'default', 'via', '10.0.0.1'], 
                                      check=True, capture_output=True, text=True)
-                logger.info(f"Default route removed: {result.stdout}")
+                logger.info("Default route removed: %s", result.stdout)
         except Exception as e:
             error_msg = f"Failed to restore routing: {e}"
             logger.error(error_msg)
@@ -0,0 +1,153 @@
+import logging
+import threading
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# VPNHandler attributes copied into every worker process
+WORKER_SETTINGS = (
+    'relay_engine', 'max_connections', 'buffer_size', 'zero_copy', 'pool_enabled',
+    'pool_min_idle', 'pool_max_idle', 'pool_idle_timeout', 'balancing', 'connect_timeout',
+    'max_connect_attempts', 'fingerprint', 'routing_table', 'tunnel_psk', 'multiplex', 'mux_tunnels',
+    'mux_window', 'idle_timeout', 'read_timeout', 'write_timeout', 'drain_timeout', 'node_source',
+    'node_refresh_interval', 'split_tunnel', 'router', 'handshake_timeout', 'handshake_workers'
+)
+
+
+def _worker_main(settings: Dict, listener: Dict, nodes: Optional[List], address: str, conn):
+    """Entry point of a worker process: run a full relay on the shared port and obey the parent"""
+    from vpn_handler import VPNHandler, VPNNode
+    from listener import ListenerConfig
+
+    handler = VPNHandler()
+    for name, value in settings.items():
+        setattr(handler, name, value)
+    handler.workers = 1
+    # The parent alone relays UDP: a SOCKS UDP association lives in the process that accepted it
+    handler.udp_enabled = False
+    handler.listener_config = ListenerConfig(**listener)
+    if nodes is None:
+        handler.load_nodes(handler.node_source)
+    else:
+        handler.vpn_nodes = [VPNNode(*node) for node in nodes]
+    started = handler.start_vpn(address=address)
+    conn.send(('ready', started, handler.last_error))
+    if not started:
+        return
+    try:
+        while True:
+            try:
+                command = conn.recv()
+            except EOFError:
+                break  # parent went away
+            if command == 'status':
+                conn.send(handler.get_vpn_status())
+            elif command == 'stop':
+                break
+            elif isinstance(command, tuple) and command[0] == 'switch':
+                handler.switch_node(address=command[1], drain_timeout=command[2])
+            elif isinstance(command, tuple) and command[0] == 'configure':
+                for name, value in command[1].items():
+                    setattr(handler, name, value)
+    finally:
+        handler.stop_vpn()
+
+
+class WorkerGroup:
+    """Extra proxy processes that bind the listener port with SO_REUSEPORT
+
+    The kernel spreads incoming connections across every process bound to the port,
+    so each worker's relay loop runs on its own core with its own GIL.
+    """
+
+    def __init__(self, count: int, settings: Dict, listener: Dict, nodes: Optional[List], address: str,
+                 start_timeout: float = 15.0):
+        self.count = count
+        self.settings = settings
+        self.listener = listener
+        self.nodes = nodes
+        self.address = address
+        self.start_timeout = start_timeout
+        self._workers = []  # (process, connection, lock)
+        self._stop_requested = False
+
+    def start(self) -> Optional[str]:
+        """Launch the workers; returns an error message if any failed to come up"""
+        import multiprocessing  # only paid for when workers > 1
+        ctx = multiprocessing.get_context('spawn')
+        for _ in range(self.count):
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=_worker_main, daemon=True,
+                                  args=(self.settings, self.listener, self.nodes, self.address, child_conn))
+            process.start()
+            child_conn.close()
+            self._workers.append((process, parent_conn, threading.Lock()))
+        for process, conn, _ in self._workers:
+            if not conn.poll(self.start_timeout):
+                return f"Worker {process.pid} did not start"
+            _, started, error = conn.recv()
+            if not started:
+                return f"Worker {process.pid} failed to start: {error}"
+        logger.info("Started %d relay worker processes", self.count)
+        return None
+
+    def status(self, timeout: float = 1.0) -> List[Dict]:
+        """Ask every worker for its status; unresponsive workers are reported as such"""
+        results = []
+        for process, conn, lock in self._workers:
+            entry = {'pid': process.pid, 'alive': process.is_alive()}
+            if entry['alive']:
+                with lock:
+                    try:
+                        # Discard a late reply left over from an earlier timed-out request
+                        while conn.poll():
+                            conn.recv()
+                        conn.send('status')
+                        if conn.poll(timeout):
+                            status = conn.recv()
+                            entry['relay'] = status.get('relay')
+                            entry['traffic'] = status.get('traffic', {}).get('totals')
+                            entry['error'] = status.get('error')
+                    except (EOFError, OSError):
+                        entry['alive'] = False
+            results.append(entry)
+        return results
+
+    def switch(self, address: str, drain_timeout: float):
+        """Tell every worker to switch to the node at address (host:port), without waiting for them"""
+        for process, conn, lock in self._workers:
+            with lock:
+                try:
+                    conn.send(('switch', address, drain_timeout))
+                except OSError:
+                    pass
+
+    def configure(self, settings: Dict):
+        """Replace settings (from WORKER_SETTINGS) in every running worker, without waiting for them"""
+        for process, conn, lock in self._workers:
+            with lock:
+                try:
+                    conn.send(('configure', settings))
+                except OSError:
+                    pass
+
+    def request_stop(self):
+        """Tell every worker to stop accepting and drain, without waiting for them"""
+        if self._stop_requested:
+            return
+        self._stop_requested = True
+        for process, conn, lock in self._workers:
+            with lock:
+                try:
+                    conn.send('stop')
+                except OSError:
+                    pass
+
+    def stop(self, timeout: float = 10.0):
+        self.request_stop()
+        for process, conn, _ in self._workers:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+            conn.close()
+        self._workers = []
@@ -0,0 +1,66 @@
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+# The modules live flat in src/, the way launcher.py runs them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+
+@pytest.fixture
+def echo_server():
+    """Port of a local TCP server echoing every connection back until EOF"""
+    server = socket.create_server(('127.0.0.1', 0), backlog=512)
+
+    def handle(conn):
+        with conn:
+            data = conn.recv(65536)
+            while data:
+                conn.sendall(data)
+                data = conn.recv(65536)
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield server.getsockname()[1]
+    server.close()
+
+
+@pytest.fixture
+def free_port():
+    """A local port nothing listens on (for listeners several processes bind)"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def roundtrip(port: int, payload: bytes = b'x' * 100000, timeout: float = 5.0) -> bytes:
+    """Send payload through the local port, half-close, and return everything read back"""
+    sock = socket.create_connection(('127.0.0.1', port), timeout=timeout)
+    with sock:
+        def send():
+            sock.sendall(payload)
+            sock.shutdown(socket.SHUT_WR)
+
+        sender = threading.Thread(target=send)
+        sender.start()
+        received = bytearray()
+        data = sock.recv(65536)
+        while data:
+            received += data
+            data = sock.recv(65536)
+        sender.join()
+    return bytes(received)
+
+
+@pytest.fixture(name='roundtrip')
+def roundtrip_fixture():
+    return roundtrip
@@ -0,0 +1,105 @@
+import sys
+import threading
+import time
+
+import pytest
+
+from balancer import NodeBalancer
+from node_catalog import VPNNode
+from node_prober import LatencyStats
+
+
+class FakeProber:
+    def __init__(self, latencies):
+        self.latencies = latencies
+
+    def get_stats(self, node):
+        stats = LatencyStats(4)
+        stats.record(self.latencies.get(node.host), 1.0)
+        return stats
+
+
+def _nodes(count=3):
+    return [VPNNode('US', f'192.0.2.{i}', 443) for i in range(1, count + 1)]
+
+
+def test_least_connections_then_latency():
+    nodes = _nodes()
+    prober = FakeProber({'192.0.2.1': 50.0, '192.0.2.2': 10.0, '192.0.2.3': 30.0})
+    balancer = NodeBalancer(lambda: nodes, prober)
+    assert [n.host for n in balancer.candidates()] == ['192.0.2.2', '192.0.2.3', '192.0.2.1']
+    balancer.acquire(nodes[1])
+    assert balancer.candidates()[0] is nodes[2]
+    balancer.release(nodes[1])
+    balancer.release(nodes[1])
+    assert nodes[1].load == 0
+
+
+def test_failed_and_offline_nodes_drop_out_until_cooled_down():
+    nodes = _nodes()
+    balancer = NodeBalancer(lambda: nodes, failure_cooldown=0.1)
+    balancer.mark_failed(nodes[0])
+    nodes[1].status = 'offline'
+    assert balancer.candidates() == [nodes[2]]
+    assert balancer.candidates(exclude=[nodes[2]]) == [nodes[0], nodes[1]]  # better than nothing
+    time.sleep(0.15)
+    assert balancer.candidates() == [nodes[0], nodes[2]]
+
+
+def test_latency_weighted_prefers_fast_nodes():
+    nodes = _nodes(2)
+    balancer = NodeBalancer(lambda: nodes, FakeProber({'192.0.2.1': 1.0, '192.0.2.2': 1000.0}),
+                            strategy='latency_weighted')
+    firsts = [balancer.candidates()[0] for _ in range(300)]
+    assert firsts.count(nodes[0]) > 250
+    assert all(len(balancer.candidates()) == 2 for _ in range(10))
+
+
+def test_consistent_hash_sticks_and_fails_over():
+    nodes = _nodes(5)
+    balancer = NodeBalancer(lambda: nodes, strategy='consistent_hash')
+    order = balancer.candidates(('10.0.0.7', 5000))
+    assert sorted(order, key=nodes.index) == nodes
+    assert balancer.candidates(('10.0.0.7', 6000)) == order
+    # Losing a node moves only its clients: the rest of the order is unchanged
+    balancer.mark_failed(order[0])
+    assert balancer.candidates(('10.0.0.7', 5000)) == order[1:]
+    spread = {balancer.candidates((f'10.0.{i}.1', 1))[0] for i in range(200)}
+    assert len(spread) >= 3
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        NodeBalancer(lambda: [], strategy='round_robin')
+
+
+def test_ring_rebuilds_race_with_lookups():
+    small, large = _nodes(2), _nodes(40)
+    current = [small]
+    balancer = NodeBalancer(lambda: current[0], strategy='consistent_hash', replicas=8)
+    errors = []
+    stop = threading.Event()
+
+    def lookup():
+        try:
+            while not stop.is_set():
+                order = balancer.candidates(('10.0.0.1', 1))
+                assert order and set(map(id, order)) <= set(map(id, small + large))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=lookup) for _ in range(4)]
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # switch threads often enough to land between two reads
+    try:
+        for thread in threads:
+            thread.start()
+        for i in range(300):
+            current[0] = large if i % 2 else small
+            time.sleep(0.001)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        sys.setswitchinterval(interval)
+    assert not errors
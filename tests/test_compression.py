@@ -0,0 +1,67 @@
+import logging
+import os
+
+import pytest
+
+from compression import FLAG_COMPRESSED, FRAME_HEADER, FRAME_MAX, CompressionStats, FrameDecoder, FrameEncoder, \
+    FrameError, get_codec
+
+TEXT = b'GET /index.html HTTP/1.1\r\nHost: example.com\r\n\r\n' * 200
+
+
+def _feed(decode, data, chunk):
+    return b''.join(decode(data[i:i + chunk]) for i in range(0, len(data), chunk))
+
+
+@pytest.mark.parametrize('codec_name', ['none', 'zlib'])
+@pytest.mark.parametrize('data', [b'', b'short', TEXT, os.urandom(5000), TEXT * 20])
+def test_frame_round_trip(codec_name, data):
+    codec = get_codec(codec_name)
+    frames = FrameEncoder(codec).encode(data)
+    assert _feed(FrameDecoder(codec).decode, frames, 7) == data
+
+
+def test_frames_split_at_frame_max():
+    data = os.urandom(FRAME_MAX * 2 + 10)
+    frames = FrameEncoder(None).encode(data)
+    assert len(frames) == len(data) + 3 * FRAME_HEADER.size
+    decoder = FrameDecoder(None)
+    assert decoder.decode(frames[:-1]) == data[:FRAME_MAX * 2]
+    assert decoder.pending == FRAME_HEADER.size + 9
+    assert decoder.decode(frames[-1:]) == data[FRAME_MAX * 2:]
+
+
+def test_compression_is_counted_and_skipped_for_random_data():
+    stats = CompressionStats()
+    encoder = FrameEncoder(get_codec('zlib'), stats)
+    compressed = encoder.encode(TEXT)
+    assert compressed[0] & FLAG_COMPRESSED and len(compressed) < len(TEXT)
+    assert not encoder.encode(os.urandom(4096))[0] & FLAG_COMPRESSED
+    assert stats.compressed_frames.value == 1 and stats.skipped_frames.value == 1
+
+
+def test_corrupt_frames_are_rejected():
+    with pytest.raises(FrameError):
+        FrameDecoder(None).decode(FRAME_HEADER.pack(FLAG_COMPRESSED, 3, 10) + b'abc')
+    with pytest.raises(FrameError):
+        FrameDecoder(get_codec('zlib')).decode(FRAME_HEADER.pack(FLAG_COMPRESSED, 3, 10) + b'abc')
+
+
+def test_codec_is_resolved_only_for_tunnel_nodes(caplog, free_port):
+    from vpn_handler import VPNHandler, VPNNode
+    handler = VPNHandler()
+    handler.pool_enabled = False
+    handler.multiplex = False
+    handler.listener_config.port = free_port
+    handler.prober.interval = 3600
+    handler.fingerprint.update(compression='lz4', encryption='none')
+    handler.vpn_nodes = [VPNNode('P', '127.0.0.1', 9), VPNNode('T', '127.0.0.1', 9, 'tunnel')]
+    try:
+        with caplog.at_level(logging.WARNING, logger='compression'):
+            assert handler.start_vpn('P'), handler.last_error
+        assert handler._codec is None
+        assert not [r for r in caplog.records if 'falling back' in r.getMessage()]
+        assert handler.switch_node('T', drain_timeout=0), handler.last_error
+        assert handler._codec is not None
+    finally:
+        handler.stop_vpn(drain_timeout=0)
@@ -0,0 +1,185 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+from dns_resolver import QTYPE_A, QTYPE_AAAA, DNSError, DNSResolver, _encode_name, build_query, parse_response
+
+
+def _answer(query: bytes, addresses=(), ttl=300, rcode=0, soa_minimum=None) -> bytes:
+    """Response to query answering A records with compression pointers back to the question"""
+    query_id, = struct.unpack_from('!H', query)
+    question = query[12:]
+    records = b''.join(struct.pack('!HHHIH', 0xC00C, QTYPE_A, 1, ttl, 4) + socket.inet_aton(address)
+                       for address in addresses)
+    authority = b''
+    if soa_minimum is not None:
+        rdata = b'\x02ns\x00\x04host\x00' + struct.pack('!IIIII', 1, 2, 3, 4, soa_minimum)
+        authority = struct.pack('!HHHIH', 0xC00C, 6, 1, ttl, len(rdata)) + rdata
+    header = struct.pack('!HHHHHH', query_id, 0x8180 | rcode, 1, len(addresses), 1 if authority else 0, 0)
+    return header + question + records + authority
+
+
+class FakeServer:
+    """UDP DNS server on localhost answering from a name -> addresses table"""
+
+    def __init__(self, zone, silent=False):
+        self.zone = zone
+        self.silent = silent
+        self.queries = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(0.1)
+        self.address = f"127.0.0.1:{self.sock.getsockname()[1]}"
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while not self._stop.is_set():
+            try:
+                query, client = self.sock.recvfrom(512)
+            except socket.timeout:
+                continue
+            self.queries += 1
+            if self.silent:
+                continue
+            labels, offset = [], 12
+            while query[offset]:
+                labels.append(query[offset + 1:offset + 1 + query[offset]].decode('ascii'))
+                offset += query[offset] + 1
+            addresses = self.zone.get('.'.join(labels))
+            if addresses is None:
+                self.sock.sendto(_answer(query, rcode=3, soa_minimum=60), client)
+            else:
+                self.sock.sendto(_answer(query, addresses), client)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.sock.close()
+
+
+@pytest.fixture
+def server():
+    server = FakeServer({'example.com': ['192.0.2.1', '192.0.2.2']})
+    yield server
+    server.close()
+
+
+def _resolver(server, **kwargs):
+    kwargs.setdefault('timeout', 0.5)
+    return DNSResolver(lambda: [server.address], hosts_file=None, **kwargs)
+
+
+def test_encode_name():
+    assert _encode_name('www.example.com.') == b'\x03www\x07example\x03com\x00'
+    assert _encode_name('bücher.de') == b'\x0dxn--bcher-kva\x02de\x00'
+    with pytest.raises(DNSError):
+        _encode_name('a..b')
+    with pytest.raises(DNSError):
+        _encode_name('x' * 64 + '.com')
+
+
+def test_build_query_layout():
+    query = build_query(0x1234, 'example.com', QTYPE_AAAA)
+    assert struct.unpack_from('!HHHHHH', query) == (0x1234, 0x0100, 1, 0, 0, 0)
+    assert query[12:] == _encode_name('example.com') + struct.pack('!HH', QTYPE_AAAA, 1)
+
+
+def test_parse_response_addresses_and_ttl():
+    query = build_query(7, 'example.com', QTYPE_A)
+    response = _answer(query, ['192.0.2.1', '192.0.2.2'], ttl=120)
+    assert parse_response(response, 7, QTYPE_A) == (['192.0.2.1', '192.0.2.2'], 120, 0)
+
+
+def test_parse_response_negative_ttl_from_soa():
+    query = build_query(7, 'missing.example', QTYPE_A)
+    assert parse_response(_answer(query, rcode=3, ttl=900, soa_minimum=60), 7, QTYPE_A) == ([], 60, 3)
+
+
+def test_parse_response_ignores_other_answers():
+    query = build_query(7, 'example.com', QTYPE_A)
+    assert parse_response(_answer(query, ['192.0.2.1']), 8, QTYPE_A) is None
+    assert parse_response(query, 7, QTYPE_A) is None  # a query, not a response
+    assert parse_response(b'\x00' * 5, 7, QTYPE_A) is None
+
+
+def test_resolve_caches_answers(server):
+    resolver = _resolver(server)
+    assert resolver.resolve('example.com') == ['192.0.2.1', '192.0.2.2']
+    assert resolver.resolve('EXAMPLE.com.') == ['192.0.2.1', '192.0.2.2']
+    assert server.queries == 1
+    stats = resolver.stats()
+    assert (stats['hits'], stats['misses']) == (1, 1)
+    resolver.close()
+
+
+def test_resolve_caches_nxdomain(server):
+    resolver = _resolver(server)
+    for _ in range(2):
+        with pytest.raises(DNSError, match='NXDOMAIN'):
+            resolver.resolve('missing.example')
+    assert server.queries == 1
+    assert resolver.stats()['negative_hits'] == 1
+    resolver.close()
+
+
+def test_ttl_is_clamped_to_min_ttl(server):
+    resolver = _resolver(server, min_ttl=0.2, max_ttl=0.2)
+    resolver.resolve('example.com')
+    time.sleep(0.3)
+    resolver.resolve('example.com')
+    assert server.queries == 2
+    resolver.close()
+
+
+def test_resolve_cached_never_blocks(server):
+    resolver = _resolver(server)
+    assert resolver.resolve_cached('example.com') is None
+    deadline = time.monotonic() + 2
+    while resolver.resolve_cached('example.com') is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert resolver.resolve_cached('example.com') == ['192.0.2.1', '192.0.2.2']
+    resolver.close()
+
+
+def test_ip_literals_and_hosts_file_skip_the_network(server, tmp_path):
+    hosts = tmp_path / 'hosts'
+    hosts.write_text('10.0.0.5 nas nas.lan # home\n::1 localhost6\n')
+    resolver = DNSResolver(lambda: [server.address], hosts_file=str(hosts))
+    assert resolver.resolve('192.0.2.9') == ['192.0.2.9']
+    assert resolver.resolve('NAS.lan') == ['10.0.0.5']
+    assert resolver.resolve('localhost6', QTYPE_AAAA) == ['::1']
+    assert server.queries == 0
+
+
+def test_no_answer_raises_and_is_not_cached():
+    server = FakeServer({}, silent=True)
+    try:
+        resolver = DNSResolver(lambda: [server.address], timeout=0.1, attempts=1, hosts_file=None)
+        for _ in range(2):
+            with pytest.raises(DNSError):
+                resolver.resolve('example.com')
+        assert resolver.stats()['timeouts'] == 2
+    finally:
+        server.close()
+
+
+def test_close_releases_queued_lookups():
+    server = FakeServer({}, silent=True)
+    try:
+        resolver = DNSResolver(lambda: [server.address], timeout=0.3, attempts=1, hosts_file=None)
+        for index in range(6):
+            resolver.prefetch(f'host{index}.example')
+        resolver.close()
+        # Only the two refreshes already running may still hold their names
+        assert len(resolver._inflight) <= 2
+        started = time.monotonic()
+        with pytest.raises(DNSError):
+            resolver.resolve('host5.example')
+        assert time.monotonic() - started < 1
+    finally:
+        server.close()
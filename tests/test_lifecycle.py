@@ -0,0 +1,123 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from lifecycle import CONNECT, IDLE, READ, WRITE, LifecycleManager, TimeoutPolicy
+from vpn_handler import VPNHandler, VPNNode
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_policy_deadlines():
+    policy = TimeoutPolicy(idle=10, read=5, write=2, connect=1)
+    assert policy.expired(100, last_active=95) is None
+    assert policy.expired(100, last_active=89) == IDLE
+    assert policy.expired(100, last_active=99, half_closed=94) is None
+    assert policy.expired(100, last_active=94, half_closed=90) == READ
+    assert policy.expired(100, last_active=99, stalled=97) == WRITE
+    assert TimeoutPolicy(idle=0).expired(1e9, last_active=0) is None
+    assert TimeoutPolicy().to_dict()[CONNECT] == 5.0
+
+
+@pytest.fixture
+def manager():
+    manager = LifecycleManager(TimeoutPolicy(idle=0.2, read=0, write=0), sweep_interval=0.05)
+    pairs = []
+
+    def session(node=None):
+        client, peer = socket.socketpair()
+        upstream, upstream_peer = socket.socketpair()
+        pairs.extend((client, peer, upstream, upstream_peer))
+        session = manager.register(client, ('127.0.0.1', 1))
+        manager.attach(session, upstream, node)
+        return session
+
+    manager.session = session
+    yield manager
+    manager.stop()
+    for sock in pairs:
+        sock.close()
+
+
+def test_reaper_aborts_idle_sessions(manager):
+    manager.start()
+    quiet, busy = manager.session(), manager.session()
+    deadline = time.monotonic() + 0.6
+    while time.monotonic() < deadline:
+        busy.touch()
+        time.sleep(0.02)
+    assert quiet.aborted == IDLE
+    assert busy.aborted is None
+    # An aborted client socket reads EOF, so a blocked forwarder returns
+    assert quiet.client.recv(1) == b''
+    assert manager.stats()['timeouts'][IDLE] == 1
+
+
+def test_drain_waits_for_sessions_then_aborts_the_rest(manager):
+    finishing, stuck = manager.session(), manager.session()
+    threading.Timer(0.1, manager.unregister, (finishing,)).start()
+    threading.Timer(0.3, manager.unregister, (stuck,)).start()
+    started = time.monotonic()
+    assert manager.drain(2.0)
+    assert 0.25 < time.monotonic() - started < 1.5
+
+    stuck = manager.session()
+    assert not manager.drain(0.1)
+    assert stuck.aborted == 'drain'
+    assert manager.aborted_on_drain == 1
+
+
+def test_retire_aborts_only_the_retired_node(manager):
+    old, new = VPNNode('US', '192.0.2.1', 443), VPNNode('DE', '192.0.2.2', 443)
+    on_old, on_new = manager.session(old), manager.session(new)
+    manager.policy.idle = 0
+    manager.start()
+    manager.retire(old, 0.2)
+    _wait_for(lambda: manager.retiring().get(old) == 1)
+    assert on_old.aborted is None
+    _wait_for(lambda: on_old.aborted == 'drain')
+    _wait_for(lambda: old not in manager.retiring())
+    assert on_new.aborted is None
+
+
+@pytest.mark.parametrize('engine', ['selector', 'thread'])
+def test_stop_vpn_drains_live_connections(engine, echo_server, free_port):
+    handler = VPNHandler()
+    handler.relay_engine = engine
+    handler.pool_enabled = False
+    handler.listener_config.port = free_port
+    handler.prober.interval = 3600
+    handler.vpn_nodes = [VPNNode('US', '127.0.0.1', echo_server)]
+    assert handler.start_vpn('US'), handler.last_error
+    live = socket.create_connection(('127.0.0.1', free_port), timeout=5)
+    stuck = socket.create_connection(('127.0.0.1', free_port), timeout=5)
+    with live, stuck:
+        for sock in (live, stuck):
+            sock.sendall(b'ping')
+            assert sock.recv(4) == b'ping'
+        stopper = threading.Thread(target=handler.stop_vpn, kwargs={'drain_timeout': 1.0})
+        started = time.monotonic()
+        stopper.start()
+        time.sleep(0.2)
+        # Still relayed while draining; no new connections are taken
+        live.sendall(b'more')
+        assert live.recv(4) == b'more'
+        with pytest.raises(OSError):
+            with socket.create_connection(('127.0.0.1', free_port), timeout=1) as late:
+                late.sendall(b'x')
+                if not late.recv(1):
+                    raise ConnectionResetError
+        live.close()
+        # The connection nobody closes is cut at the deadline
+        assert stuck.recv(1) == b''
+        stopper.join(10)
+        assert not stopper.is_alive()
+        assert 0.8 < time.monotonic() - started < 8
+    assert not handler.running
@@ -0,0 +1,54 @@
+import socket
+
+import pytest
+
+from listener import REUSE_PORT_AVAILABLE, ListenerConfig, create_listener, tune_connection
+from vpn_handler import VPNHandler, VPNNode
+
+
+def test_listener_and_connection_options():
+    config = ListenerConfig(port=0, backlog=16, recv_buffer=65536, keepalive_idle=30)
+    listener = create_listener(config)
+    with listener:
+        assert listener.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 65536
+        client = socket.create_connection(listener.getsockname())
+        with client:
+            tune_connection(client, config)
+            assert client.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+            assert client.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+    assert ListenerConfig(port=9).to_dict()['port'] == 9
+
+
+@pytest.mark.skipif(not REUSE_PORT_AVAILABLE, reason="needs SO_REUSEPORT")
+def test_reuse_port_lets_listeners_share_a_port(free_port):
+    config = ListenerConfig(port=free_port, reuse_port=True)
+    with create_listener(config), create_listener(config):
+        pass
+    with create_listener(ListenerConfig(port=free_port)):
+        with pytest.raises(OSError):
+            create_listener(ListenerConfig(port=free_port))
+
+
+@pytest.mark.skipif(not REUSE_PORT_AVAILABLE, reason="needs SO_REUSEPORT")
+def test_workers_relay_to_the_node_the_parent_picked(echo_server, free_port, roundtrip):
+    with socket.socket() as dead:
+        dead.bind(('127.0.0.1', 0))
+        dead_port = dead.getsockname()[1]
+    handler = VPNHandler()
+    handler.pool_enabled = False
+    handler.workers = 2
+    handler.listener_config.port = free_port
+    handler.prober.interval = 3600
+    # first('US') is the dead node; probing makes the parent pick the live one
+    handler.vpn_nodes = [VPNNode('US', '127.0.0.1', dead_port), VPNNode('US', '127.0.0.1', echo_server)]
+    try:
+        assert handler.start_vpn(), handler.last_error
+        assert handler.current_node.port == echo_server
+        assert handler.worker_group is not None
+        # The kernel spreads these across both processes; every one must reach the live node
+        for _ in range(40):
+            assert roundtrip(free_port, b'ping' * 1000) == b'ping' * 1000
+        assert sum(worker.get('alive', False) for worker in handler.worker_group.status()) == 1
+    finally:
+        handler.stop_vpn(drain_timeout=0)
+    assert not handler.listener_config.reuse_port  # only that run used SO_REUSEPORT
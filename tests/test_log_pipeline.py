@@ -0,0 +1,101 @@
+import io
+import json
+import logging
+import queue
+
+import log_pipeline
+from log_pipeline import DroppingQueueHandler, JsonFormatter, RateLimitFilter
+
+
+def _record(msg, *args, **extra):
+    record = logging.LogRecord('test', logging.INFO, __file__, 1, msg, args, None)
+    for key, value in extra.items():
+        setattr(record, key, value)
+    return record
+
+
+def test_rate_limit_is_per_template_and_reports_suppressed(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(log_pipeline.time, 'monotonic', lambda: now[0])
+    limiter = RateLimitFilter(rate=1.0, burst=2)
+    passed = [limiter.filter(_record("New connection from %s", i)) for i in range(5)]
+    assert passed == [True, True, False, False, False]
+    assert limiter.filter(_record("Other message"))
+
+    now[0] += 1.0
+    record = _record("New connection from %s", 'late')
+    assert limiter.filter(record)
+    assert record.suppressed == 3
+
+
+def test_event_field_is_the_type():
+    limiter = RateLimitFilter(rate=0.0, burst=1)
+    assert limiter.filter(_record("a", event='conn'))
+    assert not limiter.filter(_record("b", event='conn'))
+    assert limiter.filter(_record("b", event='other'))
+
+
+def test_sampling(monkeypatch):
+    limiter = RateLimitFilter(burst=1000, sample_rates={'noisy': 0.25})
+    draws = iter([0.1, 0.3, 0.2, 0.9])
+    monkeypatch.setattr(log_pipeline.random, 'random', lambda: next(draws))
+    assert [limiter.filter(_record("x", event='noisy')) for _ in range(4)] == [True, False, True, False]
+
+
+def test_buckets_are_bounded(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(log_pipeline.time, 'monotonic', lambda: now[0])
+    limiter = RateLimitFilter(rate=1.0, burst=1, max_buckets=8)
+    assert limiter.filter(_record("held", event='held'))
+    assert not limiter.filter(_record("held", event='held'))
+    for i in range(100):
+        now[0] += 0.01
+        limiter.filter(_record("unique message %d" % i))
+        assert len(limiter._buckets) <= 8
+    # Recent buckets are kept so a burst of one type is still limited
+    assert not limiter.filter(_record("unique message 99"))
+
+
+def test_refilled_buckets_are_pruned_first(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(log_pipeline.time, 'monotonic', lambda: now[0])
+    limiter = RateLimitFilter(rate=1.0, burst=1, max_buckets=4)
+    for i in range(4):
+        limiter.filter(_record("old %d" % i))
+    now[0] += 5.0
+    limiter.filter(_record("new"))
+    assert list(limiter._buckets) == [('test', 'new')]
+
+
+def test_json_formatter_includes_extra_fields():
+    line = JsonFormatter().format(_record("hello %s", 'world', event='greet', client='1.2.3.4'))
+    entry = json.loads(line)
+    assert entry['msg'] == 'hello world'
+    assert entry['event'] == 'greet'
+    assert entry['client'] == '1.2.3.4'
+    assert entry['level'] == 'INFO'
+
+
+def test_queue_handler_drops_when_full():
+    handler = DroppingQueueHandler(queue.Queue(maxsize=2))
+    for i in range(5):
+        handler.handle(_record("x %d", i))
+    assert handler.queue.qsize() == 2
+    assert handler.dropped == 3
+
+
+def test_setup_logging_writes_json_lines():
+    stream = io.StringIO()
+    root = logging.getLogger()
+    saved = root.handlers[:], root.level
+    try:
+        log_pipeline.setup_logging('INFO', stream=stream)
+        logging.getLogger('pipeline').info("Started on %s", 8080, extra={'event': 'start'})
+        log_pipeline.shutdown_logging()
+        entry = json.loads(stream.getvalue().splitlines()[-1])
+        assert entry['msg'] == 'Started on 8080'
+        assert entry['event'] == 'start'
+    finally:
+        log_pipeline.shutdown_logging()
+        root.handlers[:] = saved[0]
+        root.setLevel(saved[1])
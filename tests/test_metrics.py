@@ -0,0 +1,63 @@
+import threading
+
+from metrics import Histogram, MetricsRegistry, ShardedCounter
+from node_catalog import VPNNode
+
+
+def _run(threads):
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_counter_sums_threads_and_reuses_finished_shards():
+    counter = ShardedCounter()
+    barrier = threading.Barrier(8)
+
+    def work():
+        barrier.wait()
+        for _ in range(1000):
+            counter.add()
+
+    for _ in range(10):
+        _run([threading.Thread(target=work) for _ in range(8)])
+    counter.add(5)
+    assert counter.value == 80005
+    # 80 threads ran, at most 8 (plus this one) at a time
+    assert len(counter._shards) <= 9
+
+
+def test_histogram_quantiles():
+    histogram = Histogram(bounds=(1, 10, 100))
+    for value in (0.5, 5, 5, 50, 500):
+        histogram.observe(value)
+    totals = histogram.totals()
+    assert totals == [1, 2, 1, 1, 560.5, 5]
+    assert histogram.quantile(0.5) == 10
+    assert histogram.quantile(0.99) == float('inf')
+    assert Histogram().quantile(0.5) is None
+
+
+def test_registry_snapshot_and_prometheus():
+    registry = MetricsRegistry()
+    us, de = VPNNode('US', '192.0.2.1', 443), VPNNode('DE', '198.51.100.1', 443)
+    stats = registry.node(us)
+    assert registry.node(us) is stats
+    stats.connections_opened.add(3)
+    stats.connections_closed.add()
+    stats.bytes_in.add(100)
+    stats.connect_latency.observe(3)
+    registry.node(de).udp_flows_opened.add(2)
+
+    snapshot = registry.snapshot()
+    assert snapshot['nodes']['192.0.2.1:443']['active_connections'] == 2
+    assert snapshot['nodes']['198.51.100.1:443']['active_udp_flows'] == 2
+    assert snapshot['nodes']['198.51.100.1:443']['total_connections'] == 0
+    assert snapshot['totals']['bytes_in'] == 100
+    assert snapshot['totals']['total_udp_flows'] == 2
+
+    text = registry.prometheus()
+    assert 'vpn_connections_total{node="US",host="192.0.2.1",port="443"} 3' in text
+    assert 'vpn_active_udp_flows{node="DE",host="198.51.100.1",port="443"} 2' in text
+    assert 'vpn_connect_latency_ms_bucket{node="US",host="192.0.2.1",port="443",le="5"} 1' in text
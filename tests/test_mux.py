@@ -0,0 +1,137 @@
+import socket
+import struct
+import threading
+
+import pytest
+
+from mux import DATA, FRAME_HEADER, INITIAL_WINDOW, OPEN, WINDOW, MuxSession, encode_target
+
+
+def _read_frame(sock):
+    header = b''
+    while len(header) < FRAME_HEADER.size:
+        header += sock.recv(FRAME_HEADER.size - len(header))
+    kind, stream_id, length = FRAME_HEADER.unpack(header)
+    payload = b''
+    while len(payload) < length:
+        payload += sock.recv(length - len(payload))
+    return kind, stream_id, payload
+
+
+def test_encode_target():
+    assert encode_target(None) == b''
+    assert encode_target('example.com:443') == b'example.com:443'
+    assert encode_target('bücher.de:443') == b'xn--bcher-kva.de:443'
+
+
+@pytest.mark.parametrize('target', ['a' * 70 + '.com:1', 'x..y:1'])
+def test_encode_target_rejects_unsendable_names(target):
+    with pytest.raises(OSError):
+        encode_target(target)
+
+
+@pytest.fixture
+def raw_session():
+    tunnel, peer = socket.socketpair()
+    peer.settimeout(2)
+    session = MuxSession(tunnel, window=INITIAL_WINDOW)
+    session.start()
+    yield session, peer
+    session.stop()
+    peer.close()
+
+
+def test_open_frame_counts_encoded_bytes(raw_session):
+    session, peer = raw_session
+    session.open_stream('例え.テスト:80')
+    kind, stream_id, payload = _read_frame(peer)
+    assert (kind, stream_id) == (OPEN, 1)
+    assert payload == encode_target('例え.テスト:80')
+
+
+def test_data_frames_carry_stream_bytes(raw_session):
+    session, peer = raw_session
+    stream = session.open_stream('example.com:80')
+    stream.sendall(b'hello')
+    assert _read_frame(peer)[0] == OPEN
+    assert _read_frame(peer) == (DATA, 1, b'hello')
+
+
+def test_larger_window_is_granted_after_open():
+    tunnel, peer = socket.socketpair()
+    peer.settimeout(2)
+    session = MuxSession(tunnel, window=INITIAL_WINDOW * 4)
+    session.start()
+    session.open_stream('example.com:80')
+    assert _read_frame(peer)[0] == OPEN
+    kind, stream_id, payload = _read_frame(peer)
+    assert (kind, stream_id) == (WINDOW, 1)
+    assert struct.unpack('!I', payload)[0] == INITIAL_WINDOW * 3
+    session.stop()
+    peer.close()
+
+
+def test_open_after_stop_fails(raw_session):
+    session, _ = raw_session
+    session.stop()
+    session._thread.join(2)
+    with pytest.raises(OSError):
+        session.open_stream('example.com:80')
+
+
+@pytest.fixture(params=[4096, 1 << 20])
+def session_pair(request):
+    """Client and node sessions over one socketpair; the node upper-cases each stream's bytes
+
+    The client's window differs from the node's default one, as it may in the field.
+    """
+    opened = []
+
+    def on_open(target):
+        opened.append(target)
+        local, remote = socket.socketpair()
+        local.setblocking(False)
+
+        def echo():
+            data = remote.recv(65536)
+            while data:
+                remote.sendall(data.upper())
+                data = remote.recv(65536)
+            remote.close()
+        threading.Thread(target=echo, daemon=True).start()
+        return local
+
+    client_end, node_end = socket.socketpair()
+    node = MuxSession(node_end, on_open=on_open)
+    client = MuxSession(client_end, window=request.param)
+    node.start()
+    client.start()
+    yield client, opened
+    client.stop()
+    node.stop()
+
+
+@pytest.mark.parametrize('target', ['plain.example:80', 'bücher.de:443', '例え.テスト:80'])
+def test_streams_round_trip(session_pair, target):
+    client, opened = session_pair
+    stream = client.open_stream(target)
+    stream.settimeout(2)
+    stream.sendall(b'hi')
+    assert stream.recv(10) == b'HI'
+    assert opened == [target]
+    stream.close()
+
+
+def test_concurrent_streams_beyond_the_window(session_pair):
+    client, _ = session_pair
+    data = bytes(range(97, 123)) * 50000
+    streams = [client.open_stream(f'host{i}.example:80') for i in range(4)]
+    for stream in streams:
+        stream.settimeout(5)
+        threading.Thread(target=stream.sendall, args=(data,), daemon=True).start()
+    for stream in streams:
+        received = b''
+        while len(received) < len(data):
+            received += stream.recv(65536)
+        assert received == data.upper()
+        stream.close()
@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+
+from node_catalog import NodeCatalog, VPNNode
+
+
+def _write(path, nodes, mtime=None):
+    path.write_text(json.dumps(nodes))
+    if mtime is not None:
+        os.utime(path, ns=(mtime, mtime))
+
+
+NODES = [
+    {'country': 'US', 'host': '192.0.2.1', 'port': 443, 'region': 'West'},
+    {'country': 'US', 'host': '192.0.2.2', 'port': 443, 'protocol': 'tunnel'},
+    {'country': 'DE', 'host': '198.51.100.1', 'port': 8443},
+]
+
+
+def test_load_and_lookups(tmp_path):
+    path = tmp_path / 'nodes.json'
+    _write(path, NODES)
+    catalog = NodeCatalog()
+    assert catalog.load(str(path)) == {'added': 3, 'removed': 0, 'updated': 0}
+    assert catalog.first('us').address == '192.0.2.1:443'
+    assert [n.host for n in catalog.find(country='US', protocol='tunnel')] == ['192.0.2.2']
+    assert [n.host for n in catalog.find(region='west')] == ['192.0.2.1']
+    assert catalog.find(country='FR') == []
+    assert catalog.counts('protocol') == {'tcp': 2, 'tunnel': 1}
+    assert [entry['host'] for entry in catalog.listing()] == ['192.0.2.1', '192.0.2.2', '198.51.100.1']
+
+
+def test_csv_skips_invalid_rows(tmp_path):
+    path = tmp_path / 'nodes.csv'
+    path.write_text('country,host,port,protocol\nUS,192.0.2.1,443,tcp\nXX,,1,tcp\nDE,198.51.100.1,99999,tcp\n')
+    catalog = NodeCatalog()
+    catalog.load(str(path))
+    assert len(catalog) == 1
+    assert catalog.skipped_entries == 2
+
+
+def test_reload_applies_a_diff_and_keeps_node_objects(tmp_path):
+    path = tmp_path / 'nodes.json'
+    _write(path, NODES, mtime=1_000_000_000)
+    changes = []
+    catalog = NodeCatalog(on_change=lambda added, removed: changes.append((added, removed)))
+    catalog.load(str(path))
+    kept = catalog.first('DE')
+    kept.load = 7
+    assert catalog.load(str(path)) is None  # unchanged source
+    _write(path, NODES[1:] + [{'country': 'FR', 'host': '203.0.113.1', 'port': 443}], mtime=2_000_000_000)
+    assert catalog.load(str(path)) == {'added': 1, 'removed': 1, 'updated': 0}
+    assert catalog.first('DE') is kept and kept.load == 7
+    assert [n.host for n in catalog.find(country='US')] == ['192.0.2.2']
+    added, removed = changes[-1]
+    assert [n.host for n in added] == ['203.0.113.1'] and [n.host for n in removed] == ['192.0.2.1']
+    assert catalog.find(region='west') == []
+
+
+def test_watch_picks_up_edits(tmp_path):
+    path = tmp_path / 'nodes.json'
+    _write(path, NODES[:1], mtime=1_000_000_000)
+    catalog = NodeCatalog()
+    catalog.load(str(path))
+    reloaded = threading.Event()
+    catalog.on_change = lambda added, removed: reloaded.set()
+    catalog.watch(0.05)
+    try:
+        _write(path, NODES, mtime=2_000_000_000)
+        assert reloaded.wait(2)
+        assert len(catalog) == 3
+    finally:
+        catalog.stop()
+
+
+def test_status_index_follows_node_status():
+    catalog = NodeCatalog()
+    catalog.replace([VPNNode('US', '192.0.2.1', 443), VPNNode('US', '192.0.2.2', 443)])
+    first, second = catalog.nodes()
+    first.status = 'online'
+    assert catalog.find(status='online') == [first]
+    second.status = 'online'
+    first.status = 'offline'
+    assert catalog.find(country='us', status='online') == [second]
+    assert catalog.counts('status') == {'online': 1, 'offline': 1}
+
+
+def test_lookups_while_the_prober_flips_statuses():
+    catalog = NodeCatalog()
+    catalog.replace([VPNNode('US', f'192.0.2.{i}', 443) for i in range(1, 200)])
+    stop = threading.Event()
+
+    def flip():
+        statuses = ('online', 'offline', 'unknown')
+        i = 0
+        while not stop.is_set():
+            for node in catalog.nodes():
+                node.status = statuses[i % 3]
+                i += 1
+
+    thread = threading.Thread(target=flip)
+    thread.start()
+    try:
+        for _ in range(2000):
+            catalog.find(status='online')
+            catalog.counts('status')
+            catalog.stats()
+    finally:
+        stop.set()
+        thread.join()
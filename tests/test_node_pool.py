@@ -0,0 +1,89 @@
+import socket
+import sys
+import threading
+import time
+
+from node_catalog import VPNNode
+from node_pool import UpstreamPool
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_pool_fills_hands_out_and_grows_on_misses(echo_server):
+    pool = UpstreamPool(VPNNode('US', '127.0.0.1', echo_server), min_idle=2, max_idle=4)
+    assert pool.acquire() is None
+    assert pool.stats()['target'] == 3
+    pool.start()
+    try:
+        _wait_for(lambda: pool.idle_count == 3)
+        sock = pool.acquire()
+        with sock:
+            sock.sendall(b'ping')
+            assert sock.recv(4) == b'ping'
+        _wait_for(lambda: pool.idle_count == 3)
+        assert pool.stats() == {'idle': 3, 'target': 3, 'hits': 1, 'misses': 1, 'evicted': 0}
+    finally:
+        pool.close()
+    assert pool.idle_count == 0
+
+
+def test_closed_and_stale_connections_are_evicted():
+    server = socket.create_server(('127.0.0.1', 0))
+    accepted = []
+    pool = UpstreamPool(VPNNode('US', '127.0.0.1', server.getsockname()[1]), min_idle=1, max_idle=4,
+                        idle_timeout=60)
+    with server:
+        for _ in range(3):
+            pool._idle.append((pool.connect(), time.monotonic()))
+            accepted.append(server.accept()[0])
+    # The node closes the newest connection: acquire skips it and hands out the next one
+    accepted[-1].close()
+    time.sleep(0.05)
+    sock = pool.acquire()
+    assert sock is not None
+    sock.close()
+    assert pool.stats()['evicted'] == 1 and pool.stats()['hits'] == 1
+
+    pool._target = 3
+    pool.idle_timeout = 0
+    pool._evict_stale()
+    assert pool.stats() == {'idle': 0, 'target': 2, 'hits': 1, 'misses': 0, 'evicted': 2}
+    for conn in accepted:
+        conn.close()
+
+
+def test_counters_are_exact_under_concurrent_acquire(echo_server):
+    pool = UpstreamPool(VPNNode('US', '127.0.0.1', echo_server), min_idle=0, max_idle=64)
+    for _ in range(8):
+        pool._idle.append((pool.connect(), time.monotonic()))
+    hits = []
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        def work():
+            count = 0
+            for _ in range(2000):
+                sock = pool.acquire()
+                if sock:
+                    count += 1
+                    with pool._lock:
+                        pool._idle.append((sock, time.monotonic()))
+            hits.append(count)
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+        pool.close()
+    stats = pool.stats()
+    assert stats['hits'] == sum(hits)
+    assert stats['hits'] + stats['misses'] == 16000
+    assert stats['evicted'] == 0
@@ -0,0 +1,105 @@
+import logging
+import math
+import socket
+import time
+
+import node_prober
+from node_catalog import VPNNode
+from node_prober import NodeProber
+from node_server import NodeServer
+
+
+def _listener():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(64)
+    return sock
+
+
+def _closed_port() -> int:
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_probe_marks_nodes_online_and_offline():
+    server = _listener()
+    up = VPNNode('US', '127.0.0.1', server.getsockname()[1])
+    down = VPNNode('DE', '127.0.0.1', _closed_port())
+    prober = NodeProber(lambda: [up, down], timeout=2.0)
+    try:
+        results = prober.probe_all()
+    finally:
+        server.close()
+    assert results[(up.host, up.port)] is not None
+    assert results[(down.host, down.port)] is None
+    assert (up.status, down.status) == ('online', 'offline')
+    assert up.latency == round(prober.get_stats(up).ewma, 2)
+    assert prober.get_stats(down).consecutive_failures == 1
+    assert math.isinf(prober.score(down))
+    assert prober.best_node([down, up]) is up
+
+
+def test_best_node_probes_when_nothing_measured_and_may_find_nothing():
+    down = VPNNode('DE', '127.0.0.1', _closed_port())
+    prober = NodeProber(lambda: [down])
+    assert prober.best_node([down]) is None
+    assert prober.get_stats(down).probes == 1
+
+
+def test_score_adds_load_penalty():
+    servers = [_listener(), _listener()]
+    idle, busy = (VPNNode('US', '127.0.0.1', s.getsockname()[1]) for s in servers)
+    prober = NodeProber(lambda: [idle, busy], load_penalty_ms=1000.0)
+    try:
+        prober.probe_all()
+    finally:
+        for server in servers:
+            server.close()
+    busy.load = 5
+    assert prober.score(busy) > prober.score(idle)
+    assert prober.best_node([busy, idle]) is idle
+
+
+def test_probes_stay_within_concurrency(monkeypatch):
+    servers = [_listener() for _ in range(6)]
+    nodes = [VPNNode('US', '127.0.0.1', s.getsockname()[1]) for s in servers]
+    opened, peak = [], [0]
+
+    def counting_open(address):
+        sock = socket.socket()
+        sock.setblocking(False)
+        sock.connect_ex(address)
+        opened.append(sock)
+        peak[0] = max(peak[0], sum(1 for s in opened if s.fileno() >= 0))
+        return sock
+
+    monkeypatch.setattr(node_prober, 'open_nonblocking', counting_open)
+    prober = NodeProber(lambda: nodes, concurrency=2)
+    try:
+        results = prober.probe_all()
+    finally:
+        for server in servers:
+            server.close()
+    assert len(results) == 6 and all(rtt is not None for rtt in results.values())
+    assert peak[0] == 2
+
+
+def test_probe_of_tunnel_node_is_quiet(caplog):
+    server = NodeServer('127.0.0.1', 0, forward='127.0.0.1:1')
+    server.start()
+    node = VPNNode('US', '127.0.0.1', server.port, protocol='tunnel')
+    try:
+        with caplog.at_level(logging.DEBUG, logger='node_server'):
+            NodeProber(lambda: [node]).probe_all()
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline and not any(
+                    'closed before the handshake' in r.getMessage() for r in caplog.records):
+                time.sleep(0.01)
+    finally:
+        server.stop()
+    assert node.status == 'online'
+    assert any('closed before the handshake' in r.getMessage() for r in caplog.records)
+    assert not [r for r in caplog.records if r.name == 'node_server' and r.levelno >= logging.WARNING]
@@ -0,0 +1,112 @@
+import socket
+import struct
+
+import pytest
+
+from proxy_protocol import (CMD_CONNECT, CMD_UDP_ASSOCIATE, REP_CONNECTION_REFUSED, REP_HOST_UNREACHABLE,
+                            REP_SUCCEEDED, ProxyProtocolError, ProxyRequest, read_proxy_request, reply_code_for,
+                            send_reply)
+
+
+@pytest.fixture
+def pair():
+    client, server = socket.socketpair()
+    client.settimeout(2)
+    server.settimeout(2)
+    yield client, server
+    client.close()
+    server.close()
+
+
+def _socks5_request(client, command, atyp, address, port):
+    client.sendall(b'\x05\x01\x00' + bytes((5, command, 0, atyp)) + address + struct.pack('!H', port))
+
+
+def test_socks5_ipv4(pair):
+    client, server = pair
+    _socks5_request(client, CMD_CONNECT, 1, socket.inet_aton('10.1.2.3'), 443)
+    request = read_proxy_request(server)
+    assert (request.protocol, request.command, request.host, request.port) == ('socks5', CMD_CONNECT, '10.1.2.3', 443)
+    assert client.recv(2) == b'\x05\x00'
+
+
+def test_socks5_ipv6(pair):
+    client, server = pair
+    _socks5_request(client, CMD_CONNECT, 4, socket.inet_pton(socket.AF_INET6, '2001:db8::1'), 80)
+    request = read_proxy_request(server)
+    assert (request.host, request.port) == ('2001:db8::1', 80)
+
+
+def test_socks5_idn_domain(pair):
+    client, server = pair
+    name = 'bücher.de'.encode('idna')
+    _socks5_request(client, CMD_UDP_ASSOCIATE, 3, bytes((len(name),)) + name, 8080)
+    request = read_proxy_request(server)
+    assert (request.command, request.host, request.port) == (CMD_UDP_ASSOCIATE, 'bücher.de', 8080)
+
+
+def test_socks5_rejects_auth_only_clients(pair):
+    client, server = pair
+    client.sendall(b'\x05\x01\x02')
+    with pytest.raises(ProxyProtocolError):
+        read_proxy_request(server)
+    assert client.recv(2) == b'\x05\xff'
+
+
+def test_socks5_unsupported_address_type(pair):
+    client, server = pair
+    client.sendall(b'\x05\x01\x00\x05\x01\x00\x09')
+    with pytest.raises(ProxyProtocolError):
+        read_proxy_request(server)
+    client.recv(2)
+    assert client.recv(10)[1] != REP_SUCCEEDED
+
+
+def test_http_connect_keeps_leftover(pair):
+    client, server = pair
+    client.sendall(b'CONNECT example.com:443 HTTP/1.1\r\nHost: example.com:443\r\n\r\n\x16\x03\x01')
+    request = read_proxy_request(server)
+    assert (request.protocol, request.host, request.port) == ('http', 'example.com', 443)
+    assert request.leftover == b'\x16\x03\x01'
+
+
+def test_http_connect_ipv6_authority(pair):
+    client, server = pair
+    client.sendall(b'CONNECT [2001:db8::1]:8443 HTTP/1.1\r\n\r\n')
+    request = read_proxy_request(server)
+    assert (request.host, request.port) == ('2001:db8::1', 8443)
+
+
+def test_http_other_methods_get_405(pair):
+    client, server = pair
+    client.sendall(b'GET http://example.com/ HTTP/1.1\r\n\r\n')
+    with pytest.raises(ProxyProtocolError):
+        read_proxy_request(server)
+    assert client.recv(64).startswith(b'HTTP/1.1 405')
+
+
+@pytest.mark.parametrize('line', [b'CONNECT example.com HTTP/1.1', b'CONNECT example.com:https HTTP/1.1',
+                                  b'garbage'])
+def test_http_malformed_request(pair, line):
+    client, server = pair
+    client.sendall(line + b'\r\n\r\n')
+    with pytest.raises(ProxyProtocolError):
+        read_proxy_request(server)
+
+
+def test_send_reply_socks5(pair):
+    client, server = pair
+    send_reply(server, ProxyRequest('socks5', CMD_CONNECT, 'example.com', 443), REP_SUCCEEDED, ('127.0.0.1', 1080))
+    assert client.recv(10) == b'\x05\x00\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('!H', 1080)
+
+
+def test_send_reply_http(pair):
+    client, server = pair
+    send_reply(server, ProxyRequest('http', CMD_CONNECT, 'example.com', 443), REP_CONNECTION_REFUSED)
+    assert client.recv(64) == b'HTTP/1.1 502 Bad Gateway\r\n\r\n'
+
+
+def test_reply_codes():
+    assert reply_code_for(ConnectionRefusedError()) == REP_CONNECTION_REFUSED
+    assert reply_code_for(socket.timeout()) == REP_HOST_UNREACHABLE
+    assert reply_code_for(socket.gaierror()) == REP_HOST_UNREACHABLE
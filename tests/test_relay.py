@@ -0,0 +1,61 @@
+import socket
+import threading
+
+import pytest
+
+from vpn_handler import VPNHandler, VPNNode
+
+
+@pytest.fixture(params=['selector', 'thread'])
+def handler(request, echo_server, free_port):
+    """A running VPNHandler on free_port relaying to a local echo node with the given engine"""
+    handler = VPNHandler()
+    handler.relay_engine = request.param
+    handler.pool_enabled = False
+    handler.listener_config.port = free_port
+    handler.prober.interval = 3600
+    handler.vpn_nodes = [VPNNode('US', '127.0.0.1', echo_server)]
+    yield handler
+    handler.stop_vpn(drain_timeout=0)
+
+
+def test_relays_concurrent_connections(handler, free_port, roundtrip):
+    assert handler.start_vpn('US'), handler.last_error
+    payloads = [bytes([i]) * (50000 + i) for i in range(16)]
+    results = [None] * len(payloads)
+
+    def run(i):
+        results[i] = roundtrip(free_port, payloads[i])
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(payloads))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == payloads
+    traffic = handler.metrics.snapshot()['totals']
+    assert traffic['total_connections'] == 16
+    assert traffic['bytes_out'] == traffic['bytes_in'] == sum(map(len, payloads))
+
+
+def _echoes(sock: socket.socket, timeout: float) -> bool:
+    sock.settimeout(timeout)
+    try:
+        sock.sendall(b'ping')
+        return sock.recv(4) == b'ping'
+    except socket.timeout:
+        return False
+
+
+def test_max_connections_holds_back_accepts(handler, free_port):
+    handler.max_connections = 2
+    assert handler.start_vpn('US'), handler.last_error
+    first, second = (socket.create_connection(('127.0.0.1', free_port)) for _ in range(2))
+    with first, second:
+        assert _echoes(first, 5) and _echoes(second, 5)
+        # Connects into the listen backlog but is not relayed while both slots are taken
+        with socket.create_connection(('127.0.0.1', free_port)) as third:
+            assert not _echoes(third, 0.3)
+            first.close()
+            third.settimeout(5)
+            assert third.recv(4) == b'ping'
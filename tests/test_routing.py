@@ -0,0 +1,97 @@
+import pickle
+
+import pytest
+
+from routing import DIRECT, VPN, DomainSuffixIndex, PrefixTable, SplitTunnelRouter
+
+
+def test_prefix_table_longest_match():
+    table = PrefixTable()
+    table.add('10.0.0.0/8', VPN)
+    table.add('10.1.0.0/16', DIRECT)
+    table.add('10.1.2.3', VPN)
+    table.add('2001:db8::/32', DIRECT)
+    table.compile()
+    assert table.lookup('10.9.9.9') == VPN
+    assert table.lookup('10.1.9.9') == DIRECT
+    assert table.lookup('10.1.2.3') == VPN
+    assert table.lookup('2001:db8::1') == DIRECT
+    assert table.lookup('192.0.2.1') is None
+    assert table.size == 4
+
+
+def test_prefix_table_default_route():
+    table = PrefixTable()
+    table.add('0.0.0.0/0', DIRECT)
+    table.compile()
+    assert table.lookup('203.0.113.5') == DIRECT
+    assert table.lookup('::1') is None
+
+
+def test_domain_suffix_most_specific_wins():
+    index = DomainSuffixIndex()
+    index.add('example.com', DIRECT)
+    index.add('.vpn.example.com.', VPN)
+    assert index.lookup('example.com') == DIRECT
+    assert index.lookup('WWW.Example.COM.') == DIRECT
+    assert index.lookup('a.vpn.example.com') == VPN
+    assert index.lookup('notexample.com') is None
+
+
+def _router():
+    router = SplitTunnelRouter(VPN)
+    router.load_rules(['# comment', '', '192.168.0.0/16 direct', 'lan.example  DIRECT # home', 'tracker.example'])
+    router.compile()
+    return router
+
+
+def test_router_decisions():
+    router = _router()
+    assert router.decide('192.168.1.20') == DIRECT
+    assert router.decide('nas.lan.example') == DIRECT
+    assert router.decide('tracker.example') == VPN
+    assert router.decide('8.8.8.8') == VPN
+    assert router.stats()['cidr_rules'] == 1
+    assert router.stats()['domain_rules'] == 2
+
+
+def test_router_load_rules_with_action():
+    router = SplitTunnelRouter(VPN)
+    assert router.load_rules(['10.0.0.0/8', 'corp.example'], DIRECT) == 2
+    router.compile()
+    assert router.decide('10.2.3.4') == DIRECT
+    assert router.decide('git.corp.example') == DIRECT
+
+
+def test_router_cache_counts_and_bounds():
+    router = SplitTunnelRouter(DIRECT, cache_size=2)
+    router.compile()
+    for host in ('a.example', 'a.example', 'b.example', 'c.example'):
+        router.decide(host)
+    stats = router.stats()
+    assert (stats['cache_hits'], stats['cache_misses'], stats['cache_entries']) == (1, 3, 2)
+
+
+def test_compile_invalidates_cache():
+    router = SplitTunnelRouter(VPN)
+    router.compile()
+    assert router.decide('10.0.0.1') == VPN
+    router.add_rule('10.0.0.0/8', DIRECT)
+    router.compile()
+    assert router.decide('10.0.0.1') == DIRECT
+
+
+def test_router_rejects_unknown_actions():
+    with pytest.raises(ValueError):
+        SplitTunnelRouter('drop')
+    with pytest.raises(ValueError):
+        SplitTunnelRouter().add_rule('10.0.0.0/8', 'drop')
+
+
+def test_router_pickles_for_worker_processes():
+    router = _router()
+    router.decide('192.168.1.20')
+    copy = pickle.loads(pickle.dumps(router))
+    assert copy.decide('192.168.1.20') == DIRECT
+    assert copy.decide('nas.lan.example') == DIRECT
+    assert copy.stats()['cache_hits'] == 0
@@ -0,0 +1,139 @@
+import gzip
+import os
+import socket
+import threading
+
+import pytest
+
+from static_assets import SENDFILE_AVAILABLE, SENDFILE_MIN_SIZE, StaticAssets
+
+
+class _Handler:
+    """Enough of a BaseHTTPRequestHandler to serve into; the body arrives on peer"""
+
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+        self.status = None
+        self.sent_headers = {}
+        self.close_connection = False
+        self.connection, self.peer = socket.socketpair()
+        self.wfile = self.connection.makefile('wb')
+        self._body = bytearray()
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        while True:
+            data = self.peer.recv(65536)
+            if not data:
+                return
+            self._body += data
+
+    def send_response(self, status):
+        self.status = status
+
+    def send_header(self, name, value):
+        self.sent_headers[name] = value
+
+    def end_headers(self):
+        pass
+
+    def body(self) -> bytes:
+        self.wfile.close()
+        self.connection.close()
+        self._reader.join(5)
+        self.peer.close()
+        return bytes(self._body)
+
+
+def _serve(assets, path, headers=None, head=False):
+    handler = _Handler(headers)
+    assert assets.serve(handler, path, head)
+    return handler, handler.body()
+
+
+@pytest.fixture
+def root(tmp_path):
+    (tmp_path / 'index.html').write_text('<html>' + 'hello ' * 200 + '</html>')
+    (tmp_path / 'icon.png').write_bytes(b'\x89PNG' + os.urandom(100))
+    return tmp_path
+
+
+def test_serves_variants_with_validators(root):
+    assets = StaticAssets(str(root))
+    handler, body = _serve(assets, '/', {'Accept-Encoding': 'gzip, br;q=0'})
+    assert handler.status == 200
+    assert handler.sent_headers['Content-Encoding'] == 'gzip'
+    assert handler.sent_headers['Cache-Control'] == 'no-cache'
+    assert handler.sent_headers['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(body) == (root / 'index.html').read_bytes()
+
+    plain, body = _serve(assets, '/index.html')
+    assert 'Content-Encoding' not in plain.sent_headers
+    assert body == (root / 'index.html').read_bytes()
+    assert plain.sent_headers['ETag'] != handler.sent_headers['ETag']
+
+    image, _ = _serve(assets, '/icon.png', {'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in image.sent_headers
+    assert image.sent_headers['Cache-Control'] == 'public, max-age=300'
+
+
+def test_conditional_requests(root):
+    assets = StaticAssets(str(root))
+    first, _ = _serve(assets, '/index.html')
+    etag, last_modified = first.sent_headers['ETag'], first.sent_headers['Last-Modified']
+    for headers in ({'If-None-Match': etag}, {'If-None-Match': 'W/' + etag + ', "other"'},
+                    {'If-Modified-Since': last_modified}):
+        handler, body = _serve(assets, '/index.html', headers)
+        assert handler.status == 304 and body == b''
+    handler, _ = _serve(assets, '/index.html', {'If-None-Match': '"other"', 'If-Modified-Since': last_modified})
+    assert handler.status == 200
+    assert (assets.served, assets.not_modified) == (2, 3)
+
+
+def test_only_bare_known_files_are_assets(root):
+    (root / '.secret.json').write_text('{}')
+    assets = StaticAssets(str(root))
+    for path in ('/../index.html', '/.secret.json', '/missing.css', '/notes.txt', '/sub/index.html'):
+        handler = _Handler()
+        assert not assets.serve(handler, path)
+        handler.body()
+
+
+@pytest.mark.skipif(not SENDFILE_AVAILABLE, reason="needs os.sendfile")
+def test_sendfile_asset_follows_changes_on_disk(root):
+    path = root / 'app.js'
+    path.write_bytes(b'a' * SENDFILE_MIN_SIZE)
+    assets = StaticAssets(str(root))
+    handler, body = _serve(assets, '/app.js')
+    assert body == b'a' * SENDFILE_MIN_SIZE
+    old_etag = handler.sent_headers['ETag']
+
+    # Replaced by a new build: renamed over, so the kept fd still reads the old file
+    new = root / 'app.js.new'
+    new.write_bytes(b'b' * (SENDFILE_MIN_SIZE + 10))
+    os.replace(new, path)
+    handler, body = _serve(assets, '/app.js')
+    assert body == b'b' * (SENDFILE_MIN_SIZE + 10)
+    assert handler.sent_headers['Content-Length'] == str(SENDFILE_MIN_SIZE + 10)
+    assert handler.sent_headers['ETag'] != old_etag
+
+    # Rewritten in place
+    path.write_bytes(b'c' * SENDFILE_MIN_SIZE)
+    handler, body = _serve(assets, '/app.js')
+    assert body == b'c' * SENDFILE_MIN_SIZE
+    assets.reload()
+
+
+@pytest.mark.skipif(not SENDFILE_AVAILABLE, reason="needs os.sendfile")
+def test_short_sendfile_closes_the_connection(root):
+    path = root / 'app.js'
+    path.write_bytes(b'a' * SENDFILE_MIN_SIZE)
+    assets = StaticAssets(str(root))
+    asset = assets.get('app.js')
+    os.truncate(path, 100)
+    handler = _Handler()
+    assets._sendfile(handler, asset)
+    assert handler.close_connection
+    assert handler.body() == b'a' * 100
+    assets.reload()
@@ -0,0 +1,88 @@
+import socket
+import threading
+
+import pytest
+
+from vpn_handler import VPNHandler, VPNNode
+
+
+def _named_server(name: bytes):
+    """Local node that greets every connection with name, then echoes"""
+    server = socket.create_server(('127.0.0.1', 0))
+
+    def handle(conn):
+        with conn:
+            try:
+                conn.sendall(name)
+                data = conn.recv(65536)
+                while data:
+                    conn.sendall(data)
+                    data = conn.recv(65536)
+            except OSError:
+                pass  # reset when a drain aborts the connection
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server
+
+
+@pytest.fixture(params=['selector', 'thread'])
+def handler(request, free_port):
+    servers = [_named_server(b'US'), _named_server(b'DE')]
+    handler = VPNHandler()
+    handler.relay_engine = request.param
+    handler.pool_enabled = False
+    handler.listener_config.port = free_port
+    handler.prober.interval = 3600
+    handler.vpn_nodes = [VPNNode(country, '127.0.0.1', server.getsockname()[1])
+                         for country, server in zip(('US', 'DE'), servers)]
+    yield handler
+    handler.stop_vpn(drain_timeout=0)
+    for server in servers:
+        server.close()
+
+
+def _connect(port: int) -> socket.socket:
+    return socket.create_connection(('127.0.0.1', port), timeout=5)
+
+
+def test_switch_moves_new_connections_and_drains_old_ones(handler, free_port):
+    assert handler.start_vpn('US'), handler.last_error
+    with _connect(free_port) as old:
+        assert old.recv(2) == b'US'
+        assert handler.switch_node('DE', drain_timeout=0.5)
+        assert handler.current_node.country == 'DE'
+        with _connect(free_port) as new:
+            assert new.recv(2) == b'DE'
+        # The old connection keeps working until the drain deadline, then is closed
+        old.sendall(b'ping')
+        assert old.recv(4) == b'ping'
+        assert old.recv(1) == b''
+    assert handler.switches == 1
+    assert (handler.last_switch['from'], handler.last_switch['to']) == ('US', 'DE')
+    assert handler.last_switch['drain_timeout'] == 0.5
+
+
+def test_switch_to_current_or_unknown_node(handler, free_port):
+    assert handler.start_vpn('US'), handler.last_error
+    assert handler.switch_node('US')
+    assert handler.switches == 0
+    assert not handler.switch_node('FR')
+    assert 'FR' in handler.last_error
+    assert handler.current_node.country == 'US'
+    with _connect(free_port) as sock:
+        assert sock.recv(2) == b'US'
+
+
+def test_switch_starts_the_vpn_when_stopped(handler, free_port):
+    assert handler.switch_node('DE'), handler.last_error
+    assert handler.running
+    with _connect(free_port) as sock:
+        assert sock.recv(2) == b'DE'
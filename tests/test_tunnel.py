@@ -0,0 +1,193 @@
+import os
+import socket
+import threading
+
+import pytest
+
+from compression import get_codec
+from lifecycle import LifecycleManager, TimeoutPolicy
+from relay import SelectorRelay, open_nonblocking
+from tunnel import RecordOpener, RecordSealer, SessionCache, TicketIssuer, TunnelError, TunnelStage, \
+    accept_tunnel, record_size_for, _aead
+
+TEXT = b'GET /index.html HTTP/1.1\r\nHost: example.com\r\n\r\n' * 200
+
+
+def _feed(decode, data, chunk):
+    return b''.join(decode(data[i:i + chunk]) for i in range(0, len(data), chunk))
+
+
+@pytest.mark.parametrize('cipher', ['aes-256-gcm', 'chacha20-poly1305'])
+def test_records_round_trip_in_arbitrary_chunks(cipher):
+    key = os.urandom(32)
+    sealed = RecordSealer(_aead(cipher, key), 256).seal(TEXT)
+    assert _feed(RecordOpener(_aead(cipher, key)).open, sealed, 13) == TEXT
+
+
+def test_tampered_record_fails_authentication():
+    key = os.urandom(32)
+    sealed = bytearray(RecordSealer(_aead('aes-256-gcm', key), 256).seal(b'secret'))
+    sealed[-1] ^= 1
+    with pytest.raises(TunnelError):
+        RecordOpener(_aead('aes-256-gcm', key)).open(bytes(sealed))
+
+
+def test_record_size_fits_the_mtu():
+    assert record_size_for(1500) < 1500
+    assert record_size_for(100) == 256
+
+
+def _connect(stage, issuer, node_psk=None, early=b''):
+    """Handshake stage against accept_tunnel over a socketpair; returns (client, node, accept result)"""
+    client, node = socket.socketpair()
+    client.settimeout(2)
+    node.settimeout(2)
+    result = {}
+
+    def accept():
+        try:
+            result['tunnel'] = accept_tunnel(node, issuer, node_psk)
+        except TunnelError as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=accept)
+    thread.start()
+    stage.handshake(client)
+    if early:
+        client.sendall(stage.encode(early))
+    thread.join(2)
+    return client, node, result
+
+
+@pytest.mark.parametrize('cipher', ['none', 'aes-256-gcm', 'chacha20-poly1305'])
+def test_tunnel_round_trip(cipher):
+    stage = TunnelStage(get_codec('zlib'), target='bücher.de:443', cipher=cipher, psk=b'psk', multiplex=True)
+    client, node, result = _connect(stage, TicketIssuer(), b'psk')
+    pipeline, target, resumed, early, multiplexed = result['tunnel']
+    assert (target, resumed, multiplexed) == ('bücher.de:443', False, True)
+    client.sendall(stage.encode(TEXT))
+    received = early
+    while len(received) < len(TEXT):
+        received += pipeline.decode(node.recv(65536))
+    assert received == TEXT
+    node.sendall(pipeline.encode(b'pong'))
+    assert stage.decode(client.recv(4096)) == b'pong'
+    client.close()
+    node.close()
+
+
+def test_tunnel_resumes_with_a_ticket():
+    issuer, sessions = TicketIssuer(), SessionCache()
+    for expected in (False, True):
+        stage = TunnelStage(None, cipher='aes-256-gcm', psk=b'psk', sessions=sessions, session_key=('node', 1))
+        client, node, result = _connect(stage, issuer, b'psk')
+        assert result['tunnel'][2] is expected
+        client.close()
+        node.close()
+    assert (sessions.full_handshakes, sessions.resumed_handshakes) == (1, 1)
+
+
+def test_tunnel_with_wrong_psk_is_refused():
+    stage = TunnelStage(None, cipher='aes-256-gcm', psk=b'client')
+    client, node, result = _connect(stage, TicketIssuer(), b'node')
+    assert isinstance(result.get('error'), TunnelError)
+    client.close()
+    node.close()
+
+
+def test_unknown_cipher():
+    with pytest.raises(ValueError):
+        TunnelStage(None, cipher='rot13')
+
+
+@pytest.mark.parametrize('cipher', ['aes-256-gcm', 'chacha20-poly1305'])
+def test_encryption_without_psk_is_refused(cipher):
+    with pytest.raises(ValueError):
+        TunnelStage(None, cipher=cipher)
+    stage = TunnelStage(None, cipher=cipher, psk=b'psk')
+    client, node, result = _connect_refused(stage)
+    assert 'pre-shared key' in str(result.get('error'))
+    client.close()
+    node.close()
+
+
+def _connect_refused(stage):
+    """Send stage's hello to a node without a PSK, which must refuse it before answering"""
+    client, node = socket.socketpair()
+    node.settimeout(2)
+    client.sendall(stage.preamble)
+    result = {}
+    try:
+        accept_tunnel(node, TicketIssuer())
+    except TunnelError as e:
+        result['error'] = e
+    return client, node, result
+
+
+def _stuck_socket():
+    """A socket that never turns writable, so the relay sees a node that never finishes connecting"""
+    sock, peer = socket.socketpair()
+    sock.setblocking(False)
+    try:
+        while True:
+            sock.send(bytes(65536))
+    except BlockingIOError:
+        pass
+    return sock, peer
+
+
+def test_failover_from_plain_to_encrypted_node():
+    node_listener = socket.create_server(('127.0.0.1', 0))
+    received = {}
+
+    def serve_node():
+        sock, _ = node_listener.accept()
+        with sock:
+            pipeline, _, _, early, _ = accept_tunnel(sock, TicketIssuer(), b'psk')
+            data = early
+            while len(data) < 11:
+                data += pipeline.decode(sock.recv(4096))
+            received['data'] = data
+            sock.sendall(pipeline.encode(data.upper()))
+            sock.recv(1)
+
+    node_thread = threading.Thread(target=serve_node, daemon=True)
+    node_thread.start()
+    stuck, stuck_peer = _stuck_socket()
+
+    def connect_upstream(address, tried):
+        if not tried:
+            return stuck, 'plain'
+        return open_nonblocking(node_listener.getsockname()), 'tunnel'
+
+    def open_stage(node):
+        return TunnelStage(None, cipher='aes-256-gcm', psk=b'psk') if node == 'tunnel' else None
+
+    listener = socket.create_server(('127.0.0.1', 0))
+    relay = SelectorRelay(listener, connect_upstream, open_stage=open_stage,
+                          lifecycle=LifecycleManager(TimeoutPolicy(connect=0.3), sweep_interval=0.1))
+    relay_thread = threading.Thread(target=relay.run, daemon=True)
+    relay_thread.start()
+    try:
+        client = socket.create_connection(listener.getsockname(), timeout=5)
+        # Read by the relay while the plain node is still connecting, then carried over
+        client.sendall(b'secret data')
+        assert client.recv(64) == b'SECRET DATA'
+        assert received['data'] == b'secret data'
+        client.close()
+    finally:
+        relay.stop()
+        relay_thread.join(5)
+        node_thread.join(5)
+        stuck_peer.close()
+        node_listener.close()
+
+
+def test_handler_will_not_start_an_unauthenticated_encrypted_tunnel():
+    from vpn_handler import VPNHandler, VPNNode
+    handler = VPNHandler()
+    handler.vpn_nodes = [VPNNode('T', '127.0.0.1', 9, 'tunnel')]
+    assert handler.fingerprint['encryption'] != 'none'
+    assert not handler.start_vpn('T')
+    assert 'tunnel_psk' in handler.last_error
+    assert not handler.running
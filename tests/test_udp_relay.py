@@ -0,0 +1,17 @@
+import pytest
+
+from proxy_protocol import ProxyProtocolError, pack_udp_header, parse_udp_header
+
+
+@pytest.mark.parametrize('host', ['192.0.2.7', '2001:db8::7', 'example.com', 'bücher.de'])
+def test_udp_header_round_trip(host):
+    datagram = pack_udp_header(host, 5353) + b'payload'
+    parsed_host, port, offset = parse_udp_header(datagram)
+    assert (parsed_host, port, datagram[offset:]) == (host, 5353, b'payload')
+
+
+@pytest.mark.parametrize('data', [b'\x00\x00', b'\x00\x00\x01\x01' + bytes(6), b'\x00\x00\x00\x01\x7f\x00',
+                                  b'\x00\x00\x00\x09' + bytes(8)])
+def test_udp_header_rejects_bad_datagrams(data):
+    with pytest.raises(ProxyProtocolError):
+        parse_udp_header(data)